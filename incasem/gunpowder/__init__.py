@@ -39,5 +39,18 @@ from .reject import Reject
 from .downsample import Downsample
 from .zarr_write import ZarrWrite
 from .uint8_to_float import Uint8ToFloat
+from .cpu_affinity import CpuAffinity
+from .scan import Scan
+from .prefetch import Prefetch
+from .shared_batch_buffer import SharedBatchBuffer
+from .shared_memory_pre_cache import SharedMemoryPreCache
+from .skip_masked_blocks import SkipMaskedBlocks
+from .translate import Translate
+from .route_by_roi import RouteByRoi
+from .accumulate_totals import AccumulateTotals
+from .confusion_counts import ConfusionCounts
+from .stack_samples import StackSamples
+from .take_sample import TakeSample
+from .cache_batches import CacheBatches
 
 from . import torch
@@ -0,0 +1,91 @@
+import logging
+import multiprocessing
+from typing import Dict, List, Tuple
+
+import numpy as np
+import gunpowder as gp
+
+logger = logging.getLogger(__name__)
+
+
+class AccumulateTotals(gp.BatchFilter):
+    """Base class of nodes that add up totals over all batches passing
+    through, to compute metrics of a whole ROI without assembling it in
+    memory.
+
+    The totals are kept in shared memory, created in ``setup`` before
+    ``gp.Scan`` forks its workers, hence the blocks of all workers add up.
+    ``reset`` sets them to zero, e.g. before each scan.
+
+    Subclasses implement ``accumulate``, which returns the increments of the
+    totals for a batch.
+
+    Args:
+
+        inputs (``list`` of :class:`ArrayKey`):
+
+            Arrays that have to be part of each request.
+
+        totals (``dict``, ``string`` -> (``tuple``, ``dtype``)):
+
+            Shape and dtype of each total, by name.
+    """
+
+    def __init__(
+            self,
+            inputs: List[gp.ArrayKey],
+            totals: Dict[str, Tuple[tuple, np.dtype]]):
+        self._required = list(inputs)
+        self._totals_spec = {
+            name: (tuple(shape), np.dtype(dtype))
+            for name, (shape, dtype) in totals.items()
+        }
+
+    def setup(self):
+        # a single lock for all totals, hence they are read consistently
+        self._lock = multiprocessing.Lock()
+        self._shared = {
+            name: multiprocessing.RawArray(
+                np.ctypeslib.as_ctypes_type(dtype),
+                int(np.prod(shape, dtype=np.int64))
+            )
+            for name, (shape, dtype) in self._totals_spec.items()
+        }
+
+    def prepare(self, request):
+        for key in self._required:
+            if key not in request:
+                raise ValueError(
+                    f"{key} has to be requested by {type(self).__name__}.")
+
+        deps = gp.BatchRequest()
+        for key, spec in request.items():
+            deps[key] = spec.copy()
+        return deps
+
+    def process(self, batch, request):
+        increments = self.accumulate(batch)
+        with self._lock:
+            for name, increment in increments.items():
+                self._view(name)[...] += increment
+
+    def accumulate(self, batch):
+        """Increments of the totals for ``batch``, by name."""
+        raise NotImplementedError(
+            "Class %s does not implement 'accumulate'" % self.name())
+
+    def reset(self):
+        with self._lock:
+            for name in self._shared:
+                self._view(name)[...] = 0
+
+    def totals(self):
+        """Copies of all totals, by name."""
+        with self._lock:
+            return {
+                name: self._view(name).copy() for name in self._shared
+            }
+
+    def _view(self, name):
+        shape, dtype = self._totals_spec[name]
+        return np.frombuffer(self._shared[name], dtype=dtype).reshape(shape)
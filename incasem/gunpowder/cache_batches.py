@@ -0,0 +1,127 @@
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import gunpowder as gp
+from gunpowder.profiling import Timing
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBatches(gp.BatchFilter):
+    """Read each requested array once over its whole ROI provided upstream,
+    and answer all requests by cropping the cached arrays, instead of
+    running the upstream pipeline again.
+
+    Only for deterministic upstream pipelines that compute every voxel
+    independently of the requested ROI, e.g. the sources of a validation
+    dataset. The first request for an array fills its cache in tiles of the
+    requested shape, hence overlapping requests, like the context of
+    scanned blocks, are read and stored only once, at the dtype provided
+    upstream. The returned arrays are copies, downstream nodes can modify
+    them. Graphs are requested upstream.
+
+    Args:
+
+        cache_dir (``string``, optional):
+
+            If given, the arrays are stored in ``.npy`` files in a new
+            temporary directory in ``cache_dir`` and memory-mapped, instead
+            of kept in memory. The directory is removed in ``teardown``.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self._cache = {}
+        self._tmp_dir = None
+
+    def teardown(self):
+        self._cache = {}
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir)
+            self._tmp_dir = None
+
+    def provide(self, request):
+        timing = Timing(self)
+        timing.start()
+
+        if request.graph_specs:
+            upstream_request = gp.BatchRequest()
+            for key, spec in request.graph_specs.items():
+                upstream_request[key] = spec.copy()
+            batch = self.get_upstream_provider().request_batch(
+                upstream_request)
+        else:
+            batch = gp.Batch()
+
+        for key, spec in request.array_specs.items():
+            if key not in self._cache:
+                self._cache[key] = self._fill(key, spec.roi.get_shape())
+            batch[key] = self._crop(self._cache[key], spec.roi)
+
+        timing.stop()
+        batch.profiling_stats.add(timing)
+
+        return batch
+
+    def _fill(self, key, tile_shape):
+        roi = self.spec[key].roi
+        if roi is None or roi.unbounded():
+            raise ValueError(f"{key} has no bounded ROI to cache.")
+        voxel_size = self.spec[key].voxel_size
+        tile_shape = gp.Coordinate(tile_shape)
+        num_tiles = -(-roi.get_shape() // tile_shape)
+        logger.debug(f"Caching {key} in {roi}")
+
+        data = None
+        spec = None
+        for index in np.ndindex(*num_tiles):
+            tile = gp.Roi(
+                roi.get_offset() + gp.Coordinate(index) * tile_shape,
+                tile_shape
+            ).intersect(roi)
+
+            tile_request = gp.BatchRequest()
+            tile_request[key] = gp.ArraySpec(roi=tile)
+            array = self.get_upstream_provider().request_batch(
+                tile_request)[key]
+
+            if data is None:
+                spec = array.spec.copy()
+                spec.roi = roi
+                shape = array.data.shape[:-roi.dims()] + \
+                    tuple(roi.get_shape() / voxel_size)
+                data = self._allocate(key, shape, array.data.dtype)
+
+            slices = ((tile - roi.get_offset()) / voxel_size).to_slices()
+            data[(Ellipsis,) + slices] = array.data
+
+        if isinstance(data, np.memmap):
+            data.flush()
+        return gp.Array(data, spec)
+
+    def _allocate(self, key, shape, dtype):
+        if self.cache_dir is None:
+            return np.empty(shape, dtype=dtype)
+
+        if self._tmp_dir is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # concurrent runs can share cache_dir
+            self._tmp_dir = tempfile.mkdtemp(
+                prefix='cache_batches_', dir=self.cache_dir)
+        return np.lib.format.open_memmap(
+            os.path.join(self._tmp_dir, f"{key}.npy"),
+            mode='w+',
+            dtype=dtype,
+            shape=shape
+        )
+
+    def _crop(self, array, roi):
+        spec = array.spec.copy()
+        spec.roi = roi
+        slices = (
+            (roi - array.spec.roi.get_offset()) / spec.voxel_size
+        ).to_slices()
+        return gp.Array(np.array(array.data[(Ellipsis,) + slices]), spec)
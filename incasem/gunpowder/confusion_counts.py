@@ -0,0 +1,103 @@
+import logging
+from typing import List
+
+import numpy as np
+import gunpowder as gp
+
+from incasem.metrics import confusion_counts, thresholded_counts
+from .accumulate_totals import AccumulateTotals
+
+logger = logging.getLogger(__name__)
+
+
+class ConfusionCounts(AccumulateTotals):
+    """Accumulate per-class confusion counts of all batches passing through,
+    to compute metrics over a whole ROI without assembling it in memory.
+
+    For every batch, the argmax confusion matrix (see
+    ``incasem.metrics.confusion_counts``) and the per class counts of the
+    prediction thresholded at ``threshold`` (see
+    ``incasem.metrics.thresholded_counts``) are added to totals in shared
+    memory, see :class:`AccumulateTotals`.
+
+    The labels, predictions and masks have to be part of each request.
+
+    Args:
+
+        labels (:class:`ArrayKey`):
+
+            The target labels.
+
+        predictions (:class:`ArrayKey`):
+
+            Channel-first class probabilities, either float or uint8 scaled
+            to [0, 255].
+
+        num_classes (``int``):
+
+            Number of channels of ``predictions``.
+
+        masks (``list`` of :class:`ArrayKey`, optional):
+
+            Only voxels that are non-zero in all masks are counted.
+
+        threshold (``float``, optional):
+
+            Probability threshold of the thresholded counts.
+    """
+
+    def __init__(
+            self,
+            labels: gp.ArrayKey,
+            predictions: gp.ArrayKey,
+            num_classes: int,
+            masks: List[gp.ArrayKey] = None,
+            threshold: float = 0.5):
+        self.labels = labels
+        self.predictions = predictions
+        self.num_classes = num_classes
+        self.masks = [] if masks is None else list(masks)
+        self.threshold = threshold
+
+        super().__init__(
+            inputs=[self.labels, self.predictions] + self.masks,
+            totals={
+                'confusion': ((num_classes, num_classes), np.int64),
+                'thresholded': ((num_classes, 2, 2), np.int64),
+                'num_batches': ((), np.int64),
+            }
+        )
+
+    def accumulate(self, batch):
+        mask = np.ones(batch[self.labels].data.shape, dtype=bool)
+        for key in self.masks:
+            mask &= batch[key].data.astype(bool)
+
+        probabilities = batch[self.predictions].data
+        if probabilities.dtype == np.uint8:
+            probabilities = probabilities / 255.0
+
+        confusion = confusion_counts(
+            batch[self.labels].data, probabilities, mask)
+        thresholded = thresholded_counts(
+            batch[self.labels].data, probabilities, self.threshold, mask)
+
+        return {
+            'confusion': confusion,
+            'thresholded': thresholded,
+            'num_batches': 1,
+        }
+
+    @property
+    def num_batches(self):
+        return int(self.totals()['num_batches'])
+
+    @property
+    def confusion(self):
+        """Accumulated argmax confusion matrix, (true, predicted)."""
+        return self.totals()['confusion']
+
+    @property
+    def thresholded(self):
+        """Accumulated thresholded counts, (class, true, predicted)."""
+        return self.totals()['thresholded']
@@ -0,0 +1,72 @@
+import logging
+import multiprocessing
+import os
+from typing import List
+
+import gunpowder as gp
+
+logger = logging.getLogger(__name__)
+
+
+class CpuAffinity(gp.BatchFilter):
+    """Pin every process that requests batches through this node to its own
+    subset of CPU cores.
+
+    Useful with ``gp.Scan(num_workers > 1)``, where each worker is a separate
+    process. The first request in a process assigns it the next
+    ``cores_per_process`` cores from ``cores``, wrapping around if there are
+    more processes than cores. Only supported on Linux, a no-op otherwise.
+
+    Args:
+
+        cores (``list`` of ``int``):
+
+            The cores to distribute among the processes.
+
+        cores_per_process (``int``):
+
+            Number of cores each process is pinned to.
+    """
+
+    def __init__(self, cores: List[int], cores_per_process: int = 1):
+        self.cores = list(cores)
+        self.cores_per_process = max(1, int(cores_per_process))
+
+        self._pinned_pid = None
+
+    def setup(self):
+        # created before Scan forks its workers, hence shared among them
+        self._counter = multiprocessing.Value('i', 0)
+
+    def prepare(self, request):
+        pid = os.getpid()
+        if self._pinned_pid != pid:
+            self._pin(pid)
+            self._pinned_pid = pid
+
+        deps = gp.BatchRequest()
+        for key, spec in request.items():
+            deps[key] = spec.copy()
+        return deps
+
+    def process(self, batch, request):
+        pass
+
+    def _pin(self, pid):
+        if not hasattr(os, 'sched_setaffinity'):
+            logger.warning("CPU affinity is not supported on this platform.")
+            return
+        if not self.cores:
+            return
+
+        with self._counter.get_lock():
+            index = self._counter.value
+            self._counter.value += 1
+
+        first = (index * self.cores_per_process) % len(self.cores)
+        cores = [
+            self.cores[(first + i) % len(self.cores)]
+            for i in range(self.cores_per_process)
+        ]
+        os.sched_setaffinity(0, cores)
+        logger.info(f"Pinned process {pid} to cores {cores}")
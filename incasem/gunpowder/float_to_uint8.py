@@ -1,3 +1,4 @@
+import copy
 import logging
 
 import numpy as np
@@ -12,12 +13,42 @@ class FloatToUint8(gp.BatchFilter):
 
     Args:
         array (gp.ArrayKey):
+        output_array (gp.ArrayKey): optional, ArrayKey for the scaled array
     """
 
-    def __init__(self, array: gp.ArrayKey):
+    def __init__(
+            self,
+            array: gp.ArrayKey,
+            output_array: gp.ArrayKey = None):
         self.array = array
+        self.output_array = output_array
+
+    def setup(self):
+        if self.output_array:
+            self.enable_autoskip()
+            spec = self.spec[self.array].copy()
+            spec.dtype = np.uint8
+            self.provides(self.output_array, spec)
+
+    def prepare(self, request):
+        if self.output_array:
+            deps = gp.BatchRequest()
+            deps[self.array] = request[self.output_array].copy()
+            return deps
 
     def process(self, batch, request):
         data_float = batch[self.array].data
-        batch[self.array].data = img_as_ubyte(data_float)
-        batch[self.array].spec.dtype = np.uint8
+
+        if not self.output_array:
+            batch[self.array].data = img_as_ubyte(data_float)
+            batch[self.array].spec.dtype = np.uint8
+            return
+
+        outputs = gp.Batch()
+        spec = copy.deepcopy(batch[self.array].spec)
+        spec.dtype = np.uint8
+        outputs[self.output_array] = gp.Array(
+            data=img_as_ubyte(data_float),
+            spec=spec
+        )
+        return outputs
@@ -16,8 +16,11 @@ from gunpowder.nodes.batch_filter import BatchFilter
 from gunpowder.producer_pool import ProducerPool, WorkersDied, NoResult
 from gunpowder.array import ArrayKey
 from gunpowder.array_spec import ArraySpec
+from gunpowder.batch import Batch
 from gunpowder.batch_request import BatchRequest
 
+from .shared_batch_buffer import SharedBatchBuffer
+
 logger = logging.getLogger(__name__)
 
 
@@ -52,7 +55,9 @@ class GenericTrain(BatchFilter):
             in the given :class:`ArraySpec` will be used.
 
         spawn_subprocess (bool, optional): Whether to run the ``train_step`` in
-            a separate process. Default is false.
+            a separate process. Default is false. The arrays of each batch
+            are passed to it in shared memory, see
+            :class:`SharedBatchBuffer`, and only valid during ``train_step``.
     '''
 
     def __init__(
@@ -70,6 +75,7 @@ class GenericTrain(BatchFilter):
         self.gradients = gradients
         self.array_specs = {} if array_specs is None else array_specs
         self.spawn_subprocess = spawn_subprocess
+        self.batch_buffer = None
 
         self.provided_arrays = list(
             self.outputs.values()) + list(self.gradients.values())
@@ -141,6 +147,8 @@ class GenericTrain(BatchFilter):
             except NoResult:
                 pass
             self.worker.stop()
+            if self.batch_buffer is not None:
+                self.batch_buffer.close()
         else:
             self.stop()
 
@@ -150,12 +158,18 @@ class GenericTrain(BatchFilter):
 
         if self.spawn_subprocess:
 
-            self.batch_in.put((batch, request))
+            if self.batch_buffer is None:
+                # batches are trained on one at a time, one slot suffices
+                self.batch_buffer = SharedBatchBuffer(batch, num_slots=1)
+            shared_batch = self.batch_buffer.pack(batch)
+
+            self.batch_in.put((shared_batch, request))
 
             try:
                 out = self.worker.get()
             except WorkersDied:
                 raise TrainProcessDied()
+            self.batch_buffer.release(shared_batch.slot)
 
             for array_key in self.provided_arrays:
                 if array_key in request:
@@ -234,13 +248,22 @@ class GenericTrain(BatchFilter):
             self.start()
             self.initialized = True
 
-        batch, request = self.batch_in.get()
+        shared_batch, request = self.batch_in.get()
 
         # stop signal
-        if batch is None:
+        if shared_batch is None:
             self.stop()
             return None
 
+        batch = SharedBatchBuffer.unpack(shared_batch)
         self.train_step(batch, request)
 
-        return batch
+        # only send back what is used by process, not the inputs
+        out = Batch()
+        for array_key in self.provided_arrays:
+            if array_key in batch.arrays:
+                out.arrays[array_key] = batch.arrays[array_key]
+        out.loss = batch.loss
+        out.iteration = batch.iteration
+
+        return out
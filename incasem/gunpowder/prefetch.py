@@ -0,0 +1,139 @@
+import logging
+import multiprocessing
+import time
+
+import gunpowder as gp
+from gunpowder.producer_pool import ProducerPool
+
+from .scan import shift_request
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetch(gp.BatchFilter):
+    """Read ahead the batches that a downstream :class:`Scan` with a single
+    worker will request, in the same order.
+
+    Pass this node as ``prefetch`` to the :class:`Scan`, which hands over its
+    shifts in ``schedule`` before requesting the first chunk. The shifted
+    ``reference`` requests are handed to ``num_workers`` reader processes.
+    Their results are held until they are requested downstream; at most
+    ``cache_size`` finished batches are waiting at any time. Requests that
+    are not part of the schedule are passed upstream directly.
+
+    Args:
+
+        reference (:class:`BatchRequest`):
+
+            The part of the downstream :class:`Scan` reference that is
+            requested from upstream of this node, i.e. the same ROIs.
+
+        num_workers (``int``):
+
+            Number of reader processes.
+
+        cache_size (``int``):
+
+            How many prefetched batches to hold at most.
+
+        exclude (``callable``, optional):
+
+            Called with each scheduled request, those for which it returns
+            ``True`` are not read ahead, e.g. because a downstream node will
+            not request them.
+    """
+
+    def __init__(
+            self,
+            reference,
+            num_workers=1,
+            cache_size=10,
+            exclude=None):
+        self.reference = reference.copy()
+        self.num_workers = max(1, num_workers)
+        self.cache_size = cache_size
+        self.exclude = exclude
+
+        self._pending = set()
+        self._prefetched = {}
+
+    def setup(self):
+        self.request_queue = multiprocessing.Queue(maxsize=0)
+        self.workers = ProducerPool(
+            [self._worker_get_chunk for _ in range(self.num_workers)],
+            queue_size=self.cache_size,
+        )
+        self.workers.start()
+
+    def teardown(self):
+        self.workers.stop()
+
+    def provide(self, request):
+        key = self._request_key(request)
+
+        if key is None or key not in self._pending:
+            logger.warning(
+                "Request %s is not part of the prefetch schedule, "
+                "fetching it directly.", request)
+            return self.get_upstream_provider().request_batch(request)
+
+        start = time.time()
+        while key not in self._prefetched:
+            chunk = self.workers.get()
+            self._prefetched[self._request_key(chunk)] = chunk
+        logger.debug(
+            "waited %.3fs for prefetched batch", time.time() - start)
+
+        self._pending.remove(key)
+        chunk = self._prefetched.pop(key)
+
+        batch = gp.Batch()
+        batch.profiling_stats = chunk.profiling_stats
+        for array_key, spec in request.array_specs.items():
+            batch.arrays[array_key] = chunk.arrays[array_key]
+        for graph_key, spec in request.graph_specs.items():
+            batch.graphs[graph_key] = chunk.graphs[graph_key]
+
+        return batch
+
+    def schedule(self, shifts):
+        """Read ahead the ``reference`` shifted by each of ``shifts``, in
+        order."""
+
+        requests = [
+            shift_request(self.reference, shift) for shift in shifts
+        ]
+        if self.exclude is not None:
+            requests = [r for r in requests if not self.exclude(r)]
+
+        logger.info(
+            "prefetching %d of %d chunks with %d workers",
+            len(requests),
+            len(shifts),
+            self.num_workers)
+
+        for shifted_reference in requests:
+            self._pending.add(self._request_key(shifted_reference))
+            self.request_queue.put(shifted_reference)
+
+    def _worker_get_chunk(self):
+        request = self.request_queue.get()
+        return self.get_upstream_provider().request_batch(request)
+
+    def _request_key(self, request_or_batch):
+        """Identify a scheduled request by the ROIs of the reference keys."""
+        if isinstance(request_or_batch, gp.BatchRequest):
+            for array_key, _ in request_or_batch.items():
+                if array_key not in self.reference:
+                    return None
+
+        key = []
+        for array_key in sorted(self.reference.array_specs, key=str):
+            if array_key not in request_or_batch:
+                return None
+            if isinstance(request_or_batch, gp.Batch):
+                roi = request_or_batch[array_key].spec.roi
+            else:
+                roi = request_or_batch[array_key].roi
+            key.append((str(array_key), roi.get_offset(), roi.get_shape()))
+        return tuple(key)
@@ -0,0 +1,62 @@
+import logging
+
+import gunpowder as gp
+
+logger = logging.getLogger(__name__)
+
+
+class RouteByRoi(gp.BatchProvider):
+    """Combine several upstream providers with disjoint ROIs, and pass each
+    request to the one that provides the requested ROI of
+    ``reference_array``.
+
+    Only arrays that are provided by all upstream providers are provided,
+    with the bounding box of the upstream ROIs. Use together with
+    :class:`Translate` to move the upstream ROIs apart.
+
+    Args:
+
+        reference_array (gp.ArrayKey):
+
+            Array whose requested ROI selects the upstream provider.
+    """
+
+    def __init__(self, reference_array):
+        self.reference_array = reference_array
+
+    def setup(self):
+        upstream_specs = [
+            provider.spec for provider in self.get_upstream_providers()
+        ]
+        if len(upstream_specs) < 2:
+            raise ValueError(
+                "RouteByRoi needs at least two upstream providers.")
+
+        for key, spec in upstream_specs[0].array_specs.items():
+            if not all(key in s for s in upstream_specs[1:]):
+                logger.debug("%s is not provided by all upstreams", key)
+                continue
+
+            spec = spec.copy()
+            for upstream_spec in upstream_specs[1:]:
+                if spec.roi is not None:
+                    spec.roi = spec.roi.union(upstream_spec[key].roi)
+            self.provides(key, spec)
+
+        rois = [s[self.reference_array].roi for s in upstream_specs]
+        for i, roi in enumerate(rois):
+            for other in rois[i + 1:]:
+                if roi.intersects(other):
+                    raise ValueError(
+                        f"Upstream ROIs {roi} and {other} of "
+                        f"{self.reference_array} overlap.")
+
+    def provide(self, request):
+        roi = request[self.reference_array].roi
+        for provider in self.get_upstream_providers():
+            if provider.spec[self.reference_array].roi.contains(roi):
+                return provider.request_batch(request)
+
+        raise RuntimeError(
+            f"Requested {self.reference_array} ROI {roi} is not contained in "
+            "a single upstream provider.")
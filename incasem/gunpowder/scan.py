@@ -0,0 +1,294 @@
+import logging
+import multiprocessing
+from typing import Dict, List
+
+import numpy as np
+import gunpowder as gp
+from gunpowder.producer_pool import ProducerPool
+
+logger = logging.getLogger(__name__)
+
+
+def get_stride(reference):
+    """The amount by which ``reference`` is moved between chunks, the
+    smallest shape of its ROIs, as in ``gp.Scan``."""
+
+    stride = None
+    for _, spec in reference.items():
+        shape = spec.roi.get_shape()
+        if stride is None:
+            stride = shape
+        else:
+            stride = gp.Coordinate(min(a, b) for a, b in zip(stride, shape))
+    return stride
+
+
+def get_shift_roi(reference, spec):
+    """The ROI of all shifts of ``reference`` such that it is still contained
+    in the ROIs of ``spec``, as in ``gp.Scan``."""
+
+    total_shift_roi = None
+    for key, reference_spec in reference.items():
+        if key not in spec or spec[key].roi is None:
+            continue
+
+        reference_roi = reference_spec.roi
+        for r, s in zip(reference_roi.get_shape(), spec[key].roi.get_shape()):
+            if s is not None and r > s:
+                raise RuntimeError(
+                    f"Reference {key} with ROI {reference_roi} does not fit "
+                    f"into {spec[key].roi}.")
+
+        dims = reference_roi.dims()
+        shift_roi = spec[key].roi.shift(-reference_roi.get_begin()).grow(
+            gp.Coordinate((0,) * dims),
+            -(reference_roi.get_shape() - gp.Coordinate((1,) * dims))
+        )
+
+        if total_shift_roi is None:
+            total_shift_roi = shift_roi
+        else:
+            total_shift_roi = total_shift_roi.intersect(shift_roi)
+            if total_shift_roi.empty():
+                raise RuntimeError(
+                    f"There is no shift of the reference {reference} that is "
+                    f"contained in the ROIs of {spec}.")
+
+    if total_shift_roi is None:
+        raise RuntimeError(
+            "None of the upstream ROIs are bounded, cannot scan.")
+
+    return total_shift_roi
+
+
+def enumerate_shifts(shift_roi, stride):
+    """All shifts from the begin of ``shift_roi`` in steps of ``stride``,
+    the last one in each dimension snapped to the end of ``shift_roi``,
+    with the first dimension changing fastest, as in ``gp.Scan``."""
+
+    min_shift = shift_roi.get_offset()
+    max_shift = gp.Coordinate(
+        max(a, b - 1) for a, b in zip(min_shift, shift_roi.get_end()))
+
+    shift = np.array(min_shift)
+    shifts = []
+    dims = len(min_shift)
+    while True:
+        shifts.append(gp.Coordinate(shift))
+
+        if (shift == np.array(max_shift)).all():
+            break
+
+        for d in range(dims):
+            if shift[d] >= max_shift[d]:
+                shift[d] = min_shift[d]
+            else:
+                shift[d] = min(shift[d] + stride[d], max_shift[d])
+                break
+
+    return shifts
+
+
+def shift_request(request, shift):
+    shifted = request.copy()
+    for _, spec in shifted.items():
+        spec.roi = spec.roi.shift(shift)
+    return shifted
+
+
+def scan_shifts(reference, shift_roi, stride, regions=None):
+    """The shifts of ``reference`` that :class:`Scan` requests, in order.
+
+    Args:
+
+        reference (:class:`BatchRequest`):
+
+            The reference request of the scan.
+
+        shift_roi (:class:`Roi`):
+
+            All shifts that keep ``reference`` inside the scanned ROIs, see
+            :func:`get_shift_roi`.
+
+        stride (:class:`Coordinate`):
+
+            See :func:`get_stride`.
+
+        regions (``list`` of ``dict``, :class:`ArrayKey` -> :class:`Roi`):
+
+            See :class:`Scan`.
+    """
+
+    if regions is None:
+        return enumerate_shifts(shift_roi, stride)
+
+    shifts = []
+    for region in regions:
+        region = {key: gp.ArraySpec(roi=roi) for key, roi in region.items()}
+        try:
+            region_shift_roi = get_shift_roi(reference, region)
+        except RuntimeError:
+            logger.debug("reference does not fit into region %s", region)
+            continue
+        region_shift_roi = region_shift_roi.intersect(shift_roi)
+        if any(s <= 0 for s in region_shift_roi.get_shape()):
+            continue
+        shifts.extend(enumerate_shifts(region_shift_roi, stride))
+
+    logger.debug(
+        "enumerated %d shifts over %d regions", len(shifts), len(regions))
+
+    return shifts
+
+
+class Scan(gp.BatchFilter):
+    """Request batches of the shape of ``reference`` from upstream in a
+    scanning fashion, like ``gp.Scan``, optionally only over the given regions
+    of the upstream ROIs.
+
+    For an empty request, the whole upstream ROIs are scanned and an empty
+    batch is returned. Otherwise, only the requested ROIs are scanned, and
+    the chunks are assembled into the returned batch. Graphs are not
+    supported.
+
+    With ``regions``, the reference is tiled over each region separately, like
+    ``gp.Scan`` does over a single upstream provider, and chunks that would
+    cover parts of several regions, or the space between them, are never
+    requested. All chunks of all regions are handed to the same pool of
+    workers.
+
+    The shifts of the reference are computed once per request with
+    :func:`scan_shifts`, and handed to ``prefetch`` before the first chunk is
+    requested, which then reads the chunks ahead in the same order.
+
+    Args:
+
+        reference (:class:`BatchRequest`):
+
+            A reference :class:`BatchRequest`, see ``gp.Scan``.
+
+        num_workers (``int``, optional):
+
+            If set to >1, upstream requests are made in parallel with that
+            number of workers.
+
+        cache_size (``int``, optional):
+
+            If multiple workers are used, how many batches to hold at most.
+
+        regions (``list`` of ``dict``, :class:`ArrayKey` -> :class:`Roi`):
+
+            For each region, the ROIs of the reference arrays that the scan
+            has to stay in, in the order in which the regions are scanned.
+
+        prefetch (:class:`Prefetch`, optional):
+
+            The upstream node that reads the chunks ahead. Requires a single
+            worker.
+    """
+
+    def __init__(
+            self,
+            reference,
+            num_workers=1,
+            cache_size=50,
+            regions: List[Dict[gp.ArrayKey, gp.Roi]] = None,
+            prefetch=None):
+        if prefetch is not None and num_workers > 1:
+            raise ValueError(
+                "Prefetch reads ahead for a Scan with a single worker, "
+                f"not {num_workers}.")
+
+        self.reference = reference.copy()
+        self.num_workers = num_workers
+        self.cache_size = cache_size
+        self.regions = regions
+        self.prefetch = prefetch
+        self.workers = None
+
+    def setup(self):
+        if self.num_workers > 1:
+            self.request_queue = multiprocessing.Queue(maxsize=0)
+            self.workers = ProducerPool(
+                [self._worker_get_chunk for _ in range(self.num_workers)],
+                queue_size=self.cache_size,
+            )
+            self.workers.start()
+
+    def teardown(self):
+        if self.workers is not None:
+            self.workers.stop()
+            self.workers = None
+
+    def provide(self, request):
+        if request.graph_specs:
+            raise NotImplementedError("Scan does not assemble graphs.")
+
+        empty_request = len(request) == 0
+        scan_spec = self.spec if empty_request else request
+
+        shifts = scan_shifts(
+            self.reference,
+            get_shift_roi(self.reference, scan_spec),
+            get_stride(self.reference),
+            self.regions
+        )
+        logger.info("scanning over %d chunks", len(shifts))
+
+        if self.prefetch is not None:
+            self.prefetch.schedule(shifts)
+
+        requests = [shift_request(self.reference, shift) for shift in shifts]
+        if self.workers is not None:
+            for shifted_reference in requests:
+                self.request_queue.put(shifted_reference)
+            chunks = (self.workers.get() for _ in requests)
+        else:
+            chunks = (
+                self.get_upstream_provider().request_batch(shifted_reference)
+                for shifted_reference in requests
+            )
+
+        batch = gp.Batch()
+        for i, chunk in enumerate(chunks):
+            batch.profiling_stats.merge_with(chunk.profiling_stats)
+            if not empty_request:
+                self._add_to_batch(batch, request, chunk)
+            logger.debug("processed chunk %d/%d", i + 1, len(requests))
+
+        return batch
+
+    def _worker_get_chunk(self):
+        request = self.request_queue.get()
+        return self.get_upstream_provider().request_batch(request)
+
+    def _add_to_batch(self, batch, request, chunk):
+        for key, array in chunk.arrays.items():
+            if key not in request:
+                continue
+
+            if key not in batch.arrays:
+                # allocated like the first chunk, over the requested ROI
+                roi = request[key].roi
+                voxel_size = self.spec[key].voxel_size
+                shape = array.data.shape[:-roi.dims()] + \
+                    tuple(roi.get_shape() / voxel_size)
+                spec = self.spec[key].copy()
+                spec.roi = roi
+                batch.arrays[key] = gp.Array(
+                    np.zeros(shape, dtype=array.data.dtype), spec)
+
+            target = batch.arrays[key]
+            common = target.spec.roi.intersect(array.spec.roi)
+            if common.empty():
+                continue
+
+            voxel_size = target.spec.voxel_size
+            target_slices = (
+                (common - target.spec.roi.get_offset()) / voxel_size
+            ).to_slices()
+            chunk_slices = (
+                (common - array.spec.roi.get_offset()) / voxel_size
+            ).to_slices()
+            target.data[(Ellipsis,) + target_slices] = \
+                array.data[(Ellipsis,) + chunk_slices]
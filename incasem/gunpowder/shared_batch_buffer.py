@@ -0,0 +1,201 @@
+import collections
+import copy
+import logging
+import multiprocessing
+import os
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# offsets of the arrays in a slot are aligned to cache lines
+_ALIGNMENT = 64
+
+# segments created by other processes, attached by name in this process
+_attached = {}
+
+
+SharedBatch = collections.namedtuple(
+    'SharedBatch', ['name', 'slot', 'layout', 'batch'])
+SharedBatch.__doc__ = """Picklable description of a batch packed into a slot
+of a :class:`SharedBatchBuffer`. The arrays in ``layout`` are stored in the
+shared memory segment ``name``, their data in ``batch`` is ``None``."""
+
+
+class _Segment(shared_memory.SharedMemory):
+
+    def __del__(self):
+        # arrays unpacked from this segment may outlive it, they keep the
+        # mapping alive until they are garbage collected themselves
+        try:
+            self.close()
+        except (OSError, BufferError):
+            pass
+
+
+class _SlotView(np.ndarray):
+    """Bytes of a slot, the base of all arrays unpacked from it."""
+
+
+class SharedBatchBuffer:
+    """Pass batches between processes through a ring of preallocated shared
+    memory slots, instead of pickling their arrays.
+
+    The slot layout is fixed by ``template``: ``pack`` copies each array of a
+    batch that has the same shape and dtype as in the template into its
+    region of a free slot, and returns a small :class:`SharedBatch` to send
+    to another process instead of the batch. There, ``unpack`` returns the
+    batch with these arrays as zero-copy views of the slot. All other
+    arrays, graphs and attributes of the batch are pickled as usual.
+
+    Slots are handed out and released by the process that created the
+    buffer, either explicitly with ``release``, or, for batches unpacked
+    with ``get``, as soon as all their arrays have been garbage collected.
+    Processes forked after the buffer was created can ``pack`` batches, and
+    block while no slot is free.
+
+    Args:
+
+        template (:class:`Batch`):
+
+            A batch whose arrays define the slot layout.
+
+        num_slots (``int``):
+
+            Number of slots.
+    """
+
+    def __init__(self, template, num_slots):
+        self.num_slots = int(num_slots)
+
+        self.layout = {}
+        size = 0
+        for key, array in template.arrays.items():
+            data = array.data
+            if not isinstance(data, np.ndarray) or data.dtype.hasobject:
+                continue
+            self.layout[key] = (size, data.shape, data.dtype.str)
+            size += -(-data.nbytes // _ALIGNMENT) * _ALIGNMENT
+        self.slot_size = size
+
+        self._segments = [
+            _Segment(create=True, size=max(1, size))
+            for _ in range(self.num_slots)
+        ]
+        self._free = multiprocessing.Queue()
+        for slot in range(self.num_slots):
+            self._free.put(slot)
+
+        self._owner = os.getpid()
+        self._released = collections.deque()
+        self._in_use = 0
+
+        logger.info(
+            f"Allocated {self.num_slots} shared memory slots of "
+            f"{size / 2**20:.1f} MiB for arrays {list(self.layout)}")
+
+    @property
+    def in_use(self):
+        """Number of slots held by batches returned from ``get``."""
+        self._flush()
+        return self._in_use
+
+    def pack(self, batch):
+        """Copy the arrays of ``batch`` into a free slot.
+
+        Returns:
+
+            :class:`SharedBatch`
+        """
+
+        if os.getpid() == self._owner:
+            self._flush()
+        slot = self._free.get()
+        segment = self._segments[slot]
+
+        skeleton = copy.copy(batch)
+        skeleton.arrays = {}
+        layout = {}
+        for key, array in batch.arrays.items():
+            array = copy.copy(array)
+            if self._fits(key, array.data):
+                offset, shape, dtype = self.layout[key]
+                view = np.ndarray(
+                    shape, dtype, buffer=segment.buf, offset=offset)
+                view[...] = array.data
+                array.data = None
+                layout[key] = self.layout[key]
+            else:
+                logger.debug(f"{key} does not fit the slot layout, pickling")
+            skeleton.arrays[key] = array
+
+        return SharedBatch(segment.name, slot, layout, skeleton)
+
+    def get(self, shared_batch):
+        """Unpack a batch in the process that created the buffer. Its slot is
+        released once all its arrays have been garbage collected."""
+
+        self._flush()
+        segment = self._segments[shared_batch.slot]
+        batch, slot_view = _unpack(shared_batch, segment)
+
+        self._in_use += 1
+        weakref.finalize(
+            slot_view, self._released.append, shared_batch.slot)
+
+        return batch
+
+    @staticmethod
+    def unpack(shared_batch):
+        """Unpack a batch in any process. The arrays are only valid until the
+        creator of the buffer releases the slot."""
+
+        segment = _attached.get(shared_batch.name)
+        if segment is None:
+            segment = _Segment(name=shared_batch.name)
+            # the creator of the buffer unlinks the segment, not the
+            # resource tracker of this process when it exits
+            resource_tracker.unregister(segment._name, 'shared_memory')
+            _attached[shared_batch.name] = segment
+
+        batch, _ = _unpack(shared_batch, segment)
+        return batch
+
+    def release(self, slot):
+        """Make ``slot`` available to ``pack`` again."""
+        self._free.put(slot)
+
+    def close(self):
+        """Unlink the shared memory. Arrays still referencing it stay valid."""
+
+        for segment in self._segments:
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _fits(self, key, data):
+        if key not in self.layout or not isinstance(data, np.ndarray):
+            return False
+        _, shape, dtype = self.layout[key]
+        return data.shape == shape and data.dtype.str == dtype
+
+    def _flush(self):
+        # the finalizers of unpacked batches only record released slots,
+        # since they can run at any point in this process
+        while self._released:
+            self._free.put(self._released.popleft())
+            self._in_use -= 1
+
+
+def _unpack(shared_batch, segment):
+    slot_view = _SlotView((segment.size,), np.uint8, buffer=segment.buf)
+
+    batch = shared_batch.batch
+    for key, (offset, shape, dtype) in shared_batch.layout.items():
+        batch.arrays[key].data = np.ndarray(
+            shape, dtype, buffer=slot_view, offset=offset)
+
+    return batch, slot_view
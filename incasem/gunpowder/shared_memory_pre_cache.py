@@ -0,0 +1,122 @@
+import gc
+import logging
+from collections import deque
+
+import gunpowder as gp
+from gunpowder.profiling import Timing
+from gunpowder.producer_pool import ProducerPool
+
+from .shared_batch_buffer import SharedBatchBuffer
+
+logger = logging.getLogger(__name__)
+
+
+class SharedMemoryPreCache(gp.BatchFilter):
+    """Pre-cache repeated equal batch requests like ``gp.PreCache``, but the
+    workers hand their batches over in a :class:`SharedBatchBuffer`, so that
+    their arrays are not pickled.
+
+    The first batch of a series of equal requests is computed in this
+    process and fixes the slot layout, then ``num_workers`` processes are
+    started to fill ``cache_size + num_workers`` slots. The arrays of the
+    returned batches are zero-copy views of their slot, which is reused as
+    soon as they have been garbage collected. If downstream nodes hold on to
+    all slots, further batches are computed in this process.
+
+    Arrays whose shape or dtype differs from the first batch, graphs and
+    requests that differ from the current series are handled like in
+    ``gp.PreCache``, i.e. pickled or computed on demand.
+
+    Args:
+
+        cache_size (``int``):
+
+            How many batches to hold at most in the cache.
+
+        num_workers (``int``):
+
+            How many processes to spawn to fill the cache.
+    """
+
+    def __init__(self, cache_size=50, num_workers=20):
+        self.current_request = None
+        self.workers = None
+        self.batch_buffer = None
+        self.cache_size = cache_size
+        self.num_workers = num_workers
+
+        # keep track of recent requests
+        self.last_5 = deque([None] * 5, maxlen=5)
+
+    def teardown(self):
+        self._stop_workers()
+
+    def provide(self, request):
+        timing = Timing(self)
+        timing.start()
+
+        self.last_5.popleft()
+        self.last_5.append(request)
+
+        if request == self.current_request:
+            batch = self._get_cached(request)
+
+        else:
+            current_count = sum(
+                r == self.current_request for r in self.last_5)
+            new_count = sum(r == request for r in self.last_5)
+
+            if new_count > current_count or self.current_request is None:
+                self._stop_workers()
+                self.current_request = request.copy()
+                batch = self.get_upstream_provider().request_batch(request)
+                self._start_workers(batch)
+            else:
+                logger.debug("Resolving new request sequentially")
+                batch = self.get_upstream_provider().request_batch(request)
+
+        timing.stop()
+        batch.profiling_stats.add(timing)
+
+        return batch
+
+    def _get_cached(self, request):
+        if self.batch_buffer.in_use >= self.batch_buffer.num_slots:
+            gc.collect()
+        if self.batch_buffer.in_use >= self.batch_buffer.num_slots:
+            logger.warning(
+                "All shared memory slots are held downstream, "
+                "resolving request sequentially")
+            return self.get_upstream_provider().request_batch(request)
+
+        logger.debug("getting batch from queue...")
+        return self.batch_buffer.get(self.workers.get())
+
+    def _start_workers(self, template):
+        self.batch_buffer = SharedBatchBuffer(
+            template, num_slots=self.cache_size + self.num_workers)
+
+        logger.info(
+            "starting new set of workers (%s, cache size %s)...",
+            self.num_workers,
+            self.cache_size,
+        )
+        self.workers = ProducerPool(
+            [self._run_worker for _ in range(self.num_workers)],
+            queue_size=self.cache_size,
+        )
+        self.workers.start()
+
+    def _stop_workers(self):
+        if self.workers is not None:
+            logger.info("stopping current workers...")
+            self.workers.stop()
+            self.workers = None
+        if self.batch_buffer is not None:
+            self.batch_buffer.close()
+            self.batch_buffer = None
+
+    def _run_worker(self):
+        request = self.current_request.copy()
+        batch = self.get_upstream_provider().request_batch(request)
+        return self.batch_buffer.pack(batch)
@@ -0,0 +1,89 @@
+import logging
+from typing import Dict
+
+import numpy as np
+import gunpowder as gp
+
+logger = logging.getLogger(__name__)
+
+
+class SkipMaskedBlocks(gp.BatchFilter):
+    """Answer requests that lie entirely outside of a mask with constant
+    arrays, without requesting anything from upstream.
+
+    Args:
+
+        mask_index (:class:`incasem.utils.MaskIndex`):
+
+            Coarse index of the mask to query.
+
+        reference_array (gp.ArrayKey):
+
+            The ROI of this array in a request is checked for foreground.
+
+        fill_values (``dict``, gp.ArrayKey -> scalar or ``list``):
+
+            Values of the arrays in skipped requests, 0 by default. A list
+            fills a leading channel dimension with one value per channel.
+
+        roi (gp.Roi, optional):
+
+            Only requests inside this ROI are checked, all others are passed
+            upstream.
+    """
+
+    def __init__(
+            self,
+            mask_index,
+            reference_array: gp.ArrayKey,
+            fill_values: Dict[gp.ArrayKey, object] = None,
+            roi: gp.Roi = None):
+        self.mask_index = mask_index
+        self.reference_array = reference_array
+        self.fill_values = {} if fill_values is None else fill_values
+        self.roi = roi
+
+        self.skipped = 0
+        self.total = 0
+
+    def teardown(self):
+        if self.total:
+            logger.info(
+                "Skipped %d of %d blocks outside of the mask",
+                self.skipped, self.total)
+
+    def skips(self, roi):
+        """Whether a request with ``roi`` for the reference array is
+        skipped."""
+        if self.roi is not None and not self.roi.contains(roi):
+            return False
+        return not self.mask_index.any(roi)
+
+    def provide(self, request):
+        roi = request[self.reference_array].roi
+        if self.roi is not None and not self.roi.contains(roi):
+            return self.get_upstream_provider().request_batch(request)
+
+        self.total += 1
+        if not self.skips(roi):
+            return self.get_upstream_provider().request_batch(request)
+
+        self.skipped += 1
+        logger.debug(
+            "Skipping %s outside of mask (%d/%d blocks skipped)",
+            request[self.reference_array].roi, self.skipped, self.total)
+
+        batch = gp.Batch()
+        for key, request_spec in request.array_specs.items():
+            spec = self.spec[key].copy()
+            spec.roi = request_spec.roi
+
+            fill = np.asarray(self.fill_values.get(key, 0))
+            shape = request_spec.roi.get_shape() / spec.voxel_size
+            dtype = spec.dtype if spec.dtype is not None else fill.dtype
+
+            data = np.empty(fill.shape + tuple(shape), dtype=dtype)
+            data[...] = fill.reshape(fill.shape + (1,) * len(shape))
+            batch[key] = gp.Array(data, spec)
+
+        return batch
@@ -1,12 +1,17 @@
+import copy
 import os
 import logging
 import numpy as np
 import numcodecs
 
+from gunpowder.array import Array
+from gunpowder.batch import Batch
 from gunpowder.nodes.batch_filter import BatchFilter
 from gunpowder.batch_request import BatchRequest
 from gunpowder.ext import ZarrFile
 
+from incasem.utils.background_writer import BackgroundWriter
+
 logger = logging.getLogger(__name__)
 
 
@@ -69,6 +74,19 @@ class Snapshot(BatchFilter):
         chunk_shape (``tuple`` of ``int``):
 
             Chunk shape on disk in voxels.
+
+        asynchronous (``bool``):
+
+            Copy the arrays and graphs to store and write them from a
+            background thread, so that the batch continues downstream
+            immediately, see ``incasem.utils.BackgroundWriter``. Pending
+            snapshots are written in ``teardown``.
+
+        max_pending (``int``):
+
+            How many snapshots wait for the background thread at most. If
+            the writer falls behind, ``process`` blocks until a snapshot is
+            written.
         """
 
     def __init__(
@@ -83,6 +101,8 @@ class Snapshot(BatchFilter):
         dataset_dtypes=None,
         store_value_range=False,
         chunk_shape=None,
+        asynchronous=False,
+        max_pending=2,
     ):
         self.dataset_names = dataset_names
         self.output_dir = output_dir
@@ -108,6 +128,11 @@ class Snapshot(BatchFilter):
 
         self.mode = "w"
 
+        self.asynchronous = asynchronous
+        self.max_pending = max_pending
+        self._writer = BackgroundWriter(
+            self._write, name='SnapshotWriter', queue_size=max_pending)
+
     def write_if(self, batch):
         pass
 
@@ -177,84 +202,109 @@ class Snapshot(BatchFilter):
                 logger.warning("Ambiguous file type, saving as zarr.")
                 open_func = ZarrFile
 
-            with open_func(snapshot_name, self.mode) as f:
-                for (array_key, array) in batch.arrays.items():
-
-                    if array_key not in self.dataset_names:
-                        continue
-
-                    ds_name = self.dataset_names[array_key]
-                    channels = array.data.ndim - len(self.chunk_shape)
-                    chunks = (1,) * channels + self.chunk_shape
-
-                    if array_key in self.dataset_dtypes:
-                        dtype = self.dataset_dtypes[array_key]
-                        dataset = f.create_dataset(
-                            name=ds_name,
-                            data=array.data.astype(dtype),
-                            chunks=chunks,
-                            compressor=self.compressor,
-                        )
-
-                    else:
-                        dataset = f.create_dataset(
-                            name=ds_name,
-                            data=array.data,
-                            chunks=chunks,
-                            compressor=self.compressor,
-                        )
-
-                    if not array.spec.nonspatial:
-                        if array.spec.roi is not None:
-                            dataset.attrs["offset"] = array.spec.roi.get_offset()
-                        dataset.attrs["resolution"] = self.spec[array_key].voxel_size
-
-                    if self.store_value_range:
-                        dataset.attrs["value_range"] = (
-                            np.asscalar(array.data.min()),
-                            np.asscalar(array.data.max()),
-                        )
-
-                    # if array has attributes, add them to the dataset
-                    for attribute_name, attribute in array.attrs.items():
-                        dataset.attrs[attribute_name] = attribute
-
-                for (graph_key, graph) in batch.graphs.items():
-                    if graph_key not in self.dataset_names:
-                        continue
-
-                    ds_name = self.dataset_names[graph_key]
-
-                    node_ids = []
-                    locations = []
-                    edges = []
-                    for node in graph.nodes:
-                        node_ids.append(node.id)
-                        locations.append(node.location)
-                    for edge in graph.edges:
-                        edges.append((edge.u, edge.v))
-
-                    f.create_dataset(
-                        name=f"{ds_name}-ids",
-                        data=np.array(node_ids, dtype=int),
-                        chunks=self.chunk_shape,
-                        compressor=self.compressor,
-                    )
-                    f.create_dataset(
-                        name=f"{ds_name}-locations",
-                        data=np.array(locations),
-                        chunks=self.chunk_shape,
+            if self.asynchronous:
+                self._enqueue(snapshot_name, open_func, batch)
+            else:
+                self._write(snapshot_name, open_func, batch)
+
+        self.n += 1
+
+    def teardown(self):
+        self._writer.close()
+
+    def _enqueue(self, snapshot_name, open_func, batch):
+        self._writer.raise_error()
+
+        # the batch continues downstream, copy what is written
+        snapshot = Batch()
+        for array_key, array in batch.arrays.items():
+            if array_key in self.dataset_names:
+                snapshot.arrays[array_key] = Array(
+                    array.data.copy(), array.spec.copy(), array.attrs)
+        for graph_key, graph in batch.graphs.items():
+            if graph_key in self.dataset_names:
+                snapshot.graphs[graph_key] = copy.deepcopy(graph)
+        snapshot.loss = copy.deepcopy(batch.loss)
+
+        self._writer.put(snapshot_name, open_func, snapshot)
+
+    def _write(self, snapshot_name, open_func, batch):
+        with open_func(snapshot_name, self.mode) as f:
+            for (array_key, array) in batch.arrays.items():
+
+                if array_key not in self.dataset_names:
+                    continue
+
+                ds_name = self.dataset_names[array_key]
+                channels = array.data.ndim - len(self.chunk_shape)
+                chunks = (1,) * channels + self.chunk_shape
+
+                if array_key in self.dataset_dtypes:
+                    dtype = self.dataset_dtypes[array_key]
+                    dataset = f.create_dataset(
+                        name=ds_name,
+                        data=array.data.astype(dtype),
+                        chunks=chunks,
                         compressor=self.compressor,
                     )
-                    f.create_dataset(
-                        name=f"{ds_name}-edges",
-                        data=np.array(edges),
-                        chunks=self.chunk_shape,
+
+                else:
+                    dataset = f.create_dataset(
+                        name=ds_name,
+                        data=array.data,
+                        chunks=chunks,
                         compressor=self.compressor,
                     )
 
-                if batch.loss is not None:
-                    f["/"].attrs["loss"] = \
-                        [str(i) for i in np.atleast_1d(batch.loss)]
+                if not array.spec.nonspatial:
+                    if array.spec.roi is not None:
+                        dataset.attrs["offset"] = array.spec.roi.get_offset()
+                    dataset.attrs["resolution"] = self.spec[array_key].voxel_size
 
-        self.n += 1
+                if self.store_value_range:
+                    dataset.attrs["value_range"] = (
+                        np.asscalar(array.data.min()),
+                        np.asscalar(array.data.max()),
+                    )
+
+                # if array has attributes, add them to the dataset
+                for attribute_name, attribute in array.attrs.items():
+                    dataset.attrs[attribute_name] = attribute
+
+            for (graph_key, graph) in batch.graphs.items():
+                if graph_key not in self.dataset_names:
+                    continue
+
+                ds_name = self.dataset_names[graph_key]
+
+                node_ids = []
+                locations = []
+                edges = []
+                for node in graph.nodes:
+                    node_ids.append(node.id)
+                    locations.append(node.location)
+                for edge in graph.edges:
+                    edges.append((edge.u, edge.v))
+
+                f.create_dataset(
+                    name=f"{ds_name}-ids",
+                    data=np.array(node_ids, dtype=int),
+                    chunks=self.chunk_shape,
+                    compressor=self.compressor,
+                )
+                f.create_dataset(
+                    name=f"{ds_name}-locations",
+                    data=np.array(locations),
+                    chunks=self.chunk_shape,
+                    compressor=self.compressor,
+                )
+                f.create_dataset(
+                    name=f"{ds_name}-edges",
+                    data=np.array(edges),
+                    chunks=self.chunk_shape,
+                    compressor=self.compressor,
+                )
+
+            if batch.loss is not None:
+                f["/"].attrs["loss"] = \
+                    [str(i) for i in np.atleast_1d(batch.loss)]
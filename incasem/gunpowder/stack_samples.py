@@ -0,0 +1,73 @@
+import logging
+import random
+from typing import List
+
+import numpy as np
+import gunpowder as gp
+from gunpowder.profiling import Timing
+
+logger = logging.getLogger(__name__)
+
+
+class StackSamples(gp.BatchFilter):
+    """Request ``num_samples`` batches upstream and concatenate ``arrays``
+    along their leading (batch) dimension, to train on minibatches.
+
+    Like ``gp.Stack``, but the given arrays already have a batch dimension of
+    size 1, e.g. from ``fos.gunpowder.Unsqueeze``, and all other arrays are
+    taken from the first sample, so that they keep their shape. Only
+    meaningful with a source of randomness upstream, e.g. a random location
+    and augmentations, and best placed downstream of ``gp.PreCache``, which
+    prepares the samples in parallel.
+
+    Args:
+
+        arrays (``list`` of :class:`ArrayKey`):
+
+            Arrays to concatenate.
+
+        num_samples (``int``):
+
+            Number of upstream batches in a minibatch.
+    """
+
+    def __init__(self, arrays: List[gp.ArrayKey], num_samples: int):
+        self.arrays = arrays
+        self.num_samples = int(num_samples)
+
+        if self.num_samples < 1:
+            raise ValueError(
+                f"Number of samples has to be at least 1, not {num_samples}.")
+
+    def provide(self, request):
+        batches = []
+        for _ in range(self.num_samples):
+            upstream_request = request.copy()
+            if upstream_request.is_deterministic():
+                # new seeds for each sample, still deterministic since the
+                # RNG is seeded with the seed of the original request
+                upstream_request._random_seed = random.randint(0, 2**32)
+            batches.append(
+                self.get_upstream_provider().request_batch(upstream_request))
+
+        timing = Timing(self)
+        timing.start()
+
+        batch = gp.Batch()
+        for b in batches:
+            batch.profiling_stats.merge_with(b.profiling_stats)
+
+        for key in request.array_specs:
+            if key in self.arrays:
+                data = np.concatenate([b[key].data for b in batches])
+                batch[key] = gp.Array(data, batches[0][key].spec.copy())
+            else:
+                batch[key] = batches[0][key]
+
+        for key in request.graph_specs:
+            batch[key] = batches[0][key]
+
+        timing.stop()
+        batch.profiling_stats.add(timing)
+
+        return batch
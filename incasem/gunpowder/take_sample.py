@@ -0,0 +1,44 @@
+from typing import List
+import logging
+
+import gunpowder as gp
+
+logger = logging.getLogger(__name__)
+
+
+class TakeSample(gp.BatchFilter):
+    """Keep a single sample of a minibatch, e.g. to write snapshots of the
+    first sample after ``fos.gunpowder.StackSamples``.
+
+    The leading (batch) dimension is kept with size 1.
+
+    Args:
+        arrays (List[gp.ArrayKey]): ArrayKeys with a leading batch dimension.
+        index (int): Index of the sample to keep, defaults to 0.
+    """
+
+    def __init__(self, arrays: List[gp.ArrayKey], index: int = 0):
+        self.arrays = arrays
+        self.index = index
+
+    def setup(self):
+        self.enable_autoskip()
+        for array in self.arrays:
+            self.updates(array, self.spec[array].copy())
+
+    def prepare(self, request):
+        deps = gp.BatchRequest()
+        for array in self.arrays:
+            deps[array] = request[array].copy()
+        return deps
+
+    def process(self, batch, request):
+        outputs = gp.Batch()
+        for array in self.arrays:
+            outputs[array] = gp.Array(
+                batch[array].data[self.index:self.index + 1].copy(),
+                batch[array].spec.copy()
+            )
+            logger.debug(f'{array} shape: {outputs[array].data.shape}')
+
+        return outputs
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 
 from .validation_loss import ValidationLoss
+from .accumulate_loss import AccumulateLoss
 from .train import Train
 from .predict import Predict
@@ -0,0 +1,87 @@
+import logging
+from typing import Dict
+
+import numpy as np
+import torch
+import gunpowder as gp
+
+from ..accumulate_totals import AccumulateTotals
+
+logger = logging.getLogger(__name__)
+
+
+class AccumulateLoss(AccumulateTotals):
+    """Accumulate the loss of all blocks passing through, to compute the loss
+    of a whole ROI without assembling it in memory.
+
+    Place upstream of ``gp.Scan``, and pass to a :class:`ValidationLoss`
+    downstream of it, which resets the sums before each scan and reports
+    their ratio.
+
+    For every batch, ``loss.reduction_terms`` gives the scaled loss sum and
+    the scaling sum over all voxels, see
+    ``incasem.torch.loss.CrossEntropyLossWithScalingAndMeanReduction``. They
+    are added to totals in shared memory, see
+    :class:`incasem.gunpowder.AccumulateTotals`. For batches of a single
+    sample, the ratio of the totals is the loss of the assembled ROI.
+
+    Args:
+
+        loss:
+
+            The torch loss, with a ``reduction_terms`` method.
+
+        inputs (``dict``, ``int`` -> :class:`ArrayKey`):
+
+            Positional arguments of the loss.
+
+        device (``string``, optional):
+
+            Device to compute the loss on.
+    """
+
+    def __init__(
+            self,
+            loss,
+            inputs: Dict[int, gp.ArrayKey],
+            device: str = 'cpu'):
+        if not hasattr(loss, 'reduction_terms'):
+            raise ValueError(
+                f"{type(loss).__name__} cannot be accumulated blockwise, "
+                "it has no reduction_terms method.")
+
+        self.inputs = inputs
+        self.device = device
+        self.loss = loss.to(self.device)
+
+        super().__init__(
+            inputs=list(inputs.values()),
+            totals={
+                'numerator': ((), np.float64),
+                'denominator': ((), np.float64),
+            }
+        )
+
+    def accumulate(self, batch):
+        device_loss_inputs = []
+        for i in range(len(self.inputs)):
+            device_loss_inputs.append(
+                torch.as_tensor(batch[self.inputs[i]].data).to(self.device)
+            )
+
+        with torch.no_grad():
+            numerator, denominator = self.loss.reduction_terms(
+                *device_loss_inputs)
+
+        return {
+            'numerator': float(numerator.sum()),
+            'denominator': float(denominator.sum()),
+        }
+
+    @property
+    def value(self):
+        """Accumulated loss, the scaled loss sum over the scaling sum."""
+        totals = self.totals()
+        if totals['denominator'] == 0:
+            return float('nan')
+        return float(totals['numerator'] / totals['denominator'])
@@ -6,14 +6,22 @@ Changes before porting into this package are recorded at
 https://github.com/kirchhausenlab/gunpowder/blob/patch-1.1.4-logging/gunpowder/torch/nodes/predict.py
 """
 
+import contextlib
+import itertools
 import logging
-from typing import Dict, Union
+import os
+import time
+from typing import Dict, List, Union, Tuple
+
+import numpy as np
 
 from gunpowder.array import ArrayKey, Array
 from gunpowder.array_spec import ArraySpec
 from gunpowder.ext import torch
 from gunpowder.nodes.generic_predict import GenericPredict
 
+from ...torch.torchscript import load_torchscript
+
 
 logger = logging.getLogger(__name__)
 
@@ -25,7 +33,8 @@ class Predict(GenericPredict):
 
         model (subclass of ``torch.nn.Module``):
 
-            The model to use for prediction.
+            The model to use for prediction. Can be ``None`` if
+            ``torchscript`` is given.
 
         inputs (``dict``, ``string`` -> :class:`ArrayKey`):
 
@@ -66,6 +75,108 @@ class Predict(GenericPredict):
 
         spawn_subprocess (bool, optional): Whether to run ``predict`` in a
             separate process. Default is false.
+
+        micro_batch (``tuple`` of ``int``, optional):
+
+            Number of blocks per spatial dimension that are stacked into a
+            single forward pass. If given, each request covers a super-block
+            of ``micro_batch`` blocks. The input is split into overlapping
+            blocks of ``block_input_shape``, which are stacked along the batch
+            dimension, and the outputs of shape ``block_output_shape`` are
+            stitched back into the super-block. Requires a model with valid
+            padding and a leading batch dimension of size 1 in the inputs.
+
+        block_input_shape (``tuple`` of ``int``, optional):
+
+            Spatial input shape of a single block in voxels. Required for
+            ``micro_batch``.
+
+        block_output_shape (``tuple`` of ``int``, optional):
+
+            Spatial output shape of a single block in voxels. Required for
+            ``micro_batch``.
+
+        log_throughput_every (``int``, optional):
+
+            After how many calls to ``predict`` to log the throughput in
+            blocks/s and voxels/s for each batch size seen so far. A summary
+            is always logged when the node stops.
+
+        inference_mode (``bool``, optional):
+
+            Run the forward pass under ``torch.inference_mode`` instead of
+            ``torch.no_grad``. Default is false.
+
+        channels_last (``bool``, optional):
+
+            Convert the model and 5-dimensional inputs to the
+            ``channels_last_3d`` memory format, which is faster for 3d
+            convolutions on most x86 CPUs. Default is false.
+
+        autocast_dtype (``string``, optional):
+
+            If given (e.g. ``"bfloat16"``), run the forward pass under
+            ``torch.autocast`` with this dtype. Outputs are cast back to
+            ``float32``.
+
+        num_threads (``int``, optional):
+
+            Number of intra-op threads for torch on the CPU.
+
+        num_interop_threads (``int``, optional):
+
+            Number of inter-op threads for torch on the CPU.
+
+        cpu_affinity (``list`` of ``int``, optional):
+
+            Pin the process that runs the model to these CPU cores (Linux
+            only).
+
+        tta_mirror (``bool``, optional):
+
+            Test-time augmentation with all combinations of mirroring the
+            spatial axes, as in ``SimpleAugment``. The augmented views of a
+            block are stacked into a single forward pass, and the model
+            outputs are mapped back and averaged on the device. Default is
+            false.
+
+        tta_transpose (``bool``, optional):
+
+            Test-time augmentation with all permutations of the spatial axes,
+            combined with ``tta_mirror`` if set. Requires inputs with equal
+            spatial extent in every dimension. Default is false.
+
+        torchscript (``string``, optional):
+
+            Path to a model exported with
+            ``fos.torch.export_torchscript``, which is loaded instead of
+            ``model`` and ``checkpoint``. The model inputs have to match the
+            input shape it was traced with, including the batch size of
+            micro-batching and test-time augmentation. Only integer
+            ``outputs`` are supported. Models quantized with
+            ``fos.torch.quantize_static`` only run on the cpu.
+
+        softmax (``bool``, optional):
+
+            Apply a softmax over the channel dimension of all outputs on the
+            device, before they are copied to the host. Default is false.
+
+        output_dtype (``string``, optional):
+
+            Convert all outputs on the device to ``float16``, or to ``uint8``
+            probabilities scaled to [0, 255], which requires ``softmax``.
+
+        segmentations (``dict``, :class:`ArrayKey` -> :class:`ArrayKey`, optional):
+
+            Argmax over the channel dimension of an output, computed on the
+            device and provided as an additional array. Maps arrays in
+            ``outputs`` to the segmentation arrays, ``uint8`` unless a dtype
+            is given in ``array_specs``.
+
+        segmentation_mask (:class:`ArrayKey`, optional):
+
+            Set ``segmentations`` to 0 where this array is 0. It is
+            requested with the ROI of the segmentation.
     """
 
     def __init__(
@@ -77,14 +188,62 @@ class Predict(GenericPredict):
         checkpoint: str = None,
         gpus=[0],
         device="cuda",
-        spawn_subprocess=False
+        spawn_subprocess=False,
+        micro_batch: Tuple[int, ...] = None,
+        block_input_shape: Tuple[int, ...] = None,
+        block_output_shape: Tuple[int, ...] = None,
+        log_throughput_every: int = 100,
+        inference_mode: bool = False,
+        channels_last: bool = False,
+        autocast_dtype: str = None,
+        num_threads: int = None,
+        num_interop_threads: int = None,
+        cpu_affinity: List[int] = None,
+        tta_mirror: bool = False,
+        tta_transpose: bool = False,
+        torchscript: str = None,
+        softmax: bool = False,
+        output_dtype: str = None,
+        segmentations: Dict[ArrayKey, ArrayKey] = None,
+        segmentation_mask: ArrayKey = None,
     ):
-        if model.training:
+        if torchscript is not None:
+            if any(isinstance(key, str) for key in outputs):
+                raise ValueError(
+                    "Intermediate layer outputs are not available in a "
+                    "TorchScript model.")
+        elif model.training:
             logger.warning(
                 "Model is in training mode during prediction. "
                 "Consider using model.eval()"
             )
 
+        if output_dtype not in (None, 'float32', 'float16', 'uint8'):
+            raise ValueError(f"Unsupported output dtype {output_dtype}.")
+        if output_dtype == 'uint8' and not softmax:
+            raise ValueError(
+                "uint8 outputs are scaled probabilities, enable softmax.")
+
+        segmentations = {} if segmentations is None else dict(segmentations)
+        array_specs = dict(array_specs)
+        for array_key in outputs.values():
+            if output_dtype is not None:
+                spec = array_specs.get(array_key, ArraySpec()).copy()
+                spec.dtype = np.dtype(output_dtype)
+                array_specs[array_key] = spec
+
+        # the segmentations are provided like outputs, under their own keys
+        outputs = dict(outputs)
+        for array_key, segmentation in segmentations.items():
+            if array_key not in outputs.values():
+                raise ValueError(
+                    f"Segmentation of {array_key}, which is not an output.")
+            outputs[('argmax', array_key)] = segmentation
+            spec = array_specs.get(segmentation, ArraySpec()).copy()
+            if spec.dtype is None:
+                spec.dtype = np.uint8
+            array_specs[segmentation] = spec
+
         super(Predict, self).__init__(
             inputs,
             outputs,
@@ -97,8 +256,50 @@ class Predict(GenericPredict):
         self.checkpoint = checkpoint
         self.gpus = gpus
 
+        if micro_batch is not None:
+            if block_input_shape is None or block_output_shape is None:
+                raise ValueError(
+                    "Micro-batching requires block_input_shape and "
+                    "block_output_shape.")
+            if not (len(micro_batch) == len(block_input_shape)
+                    == len(block_output_shape)):
+                raise ValueError(
+                    f"Dimensions of {micro_batch=}, {block_input_shape=} and "
+                    f"{block_output_shape=} do not match.")
+            micro_batch = tuple(int(n) for n in micro_batch)
+            block_input_shape = tuple(int(s) for s in block_input_shape)
+            block_output_shape = tuple(int(s) for s in block_output_shape)
+        self.micro_batch = micro_batch
+        self.block_input_shape = block_input_shape
+        self.block_output_shape = block_output_shape
+
+        # batch size -> [number of calls, blocks, output voxels, seconds]
+        self.throughput = {}
+        self.log_throughput_every = log_throughput_every
+        self._predict_calls = 0
+
+        self.inference_mode = inference_mode
+        self.channels_last = channels_last
+        self.autocast_dtype = autocast_dtype
+        self.num_threads = num_threads
+        self.num_interop_threads = num_interop_threads
+        self.cpu_affinity = cpu_affinity
+
+        self.tta_mirror = tta_mirror
+        self.tta_transpose = tta_transpose
+        self._tta_views = None
+
+        self.torchscript = torchscript
+        self.torchscript_metadata = None
+
+        self.softmax = softmax
+        self.output_dtype = output_dtype
+        self.segmentations = segmentations
+        self.segmentation_mask = segmentation_mask
+
         self.intermediate_layers = {}
-        self.register_hooks()
+        if self.torchscript is None:
+            self.register_hooks()
 
     def start(self):
 
@@ -114,10 +315,22 @@ class Predict(GenericPredict):
             logger.info(f"Predicting on gpu {torch.cuda.current_device()}")
         else:
             logger.info("Predicting on cpu")
+            self.setup_cpu()
 
         self.device = torch.device(
             f"cuda:{torch.cuda.current_device()}" if self.use_cuda else "cpu")
 
+        if self.torchscript is not None:
+            start = time.time()
+            self.model, self.torchscript_metadata = load_torchscript(
+                self.torchscript, device=self.device)
+            logger.info((
+                f"Loaded TorchScript model {self.torchscript} for input "
+                f"shape {self.torchscript_metadata.get('input_shape')} in "
+                f"{time.time() - start:.2f} s"
+            ))
+            return
+
         try:
             self.model = self.model.to(self.device)
         except RuntimeError as e:
@@ -134,12 +347,88 @@ class Predict(GenericPredict):
             else:
                 self.model.load_state_dict()
 
+        if self.channels_last:
+            self.model = self.model.to(memory_format=torch.channels_last_3d)
+
+    def setup_cpu(self):
+        if self.cpu_affinity is not None:
+            if hasattr(os, 'sched_setaffinity'):
+                os.sched_setaffinity(0, self.cpu_affinity)
+                logger.info(
+                    f"Pinned prediction process to cores {self.cpu_affinity}")
+            else:
+                logger.warning(
+                    "CPU affinity is not supported on this platform.")
+
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+
+        if self.num_interop_threads is not None:
+            try:
+                torch.set_num_interop_threads(self.num_interop_threads)
+            except RuntimeError as e:
+                # can only be set once per process, before any parallel work
+                logger.warning(f"Could not set inter-op threads: {e}")
+
+        logger.info((
+            f"Using {torch.get_num_threads()} intra-op and "
+            f"{torch.get_num_interop_threads()} inter-op threads"
+        ))
+
+    def forward_context(self):
+        stack = contextlib.ExitStack()
+        if self.inference_mode:
+            stack.enter_context(torch.inference_mode())
+        else:
+            stack.enter_context(torch.no_grad())
+        if self.autocast_dtype is not None:
+            stack.enter_context(torch.autocast(
+                device_type=self.device.type,
+                dtype=getattr(torch, self.autocast_dtype)))
+        return stack
+
+    def prepare(self, request):
+        deps = super(Predict, self).prepare(request)
+
+        if self.segmentation_mask is not None:
+            for segmentation in self.segmentations.values():
+                if segmentation in request:
+                    deps[self.segmentation_mask] = ArraySpec(
+                        roi=request[segmentation].roi)
+                    break
+
+        return deps
+
     def predict(self, batch, request):
+        start = time.time()
+
         inputs = self.get_inputs(batch)
-        with torch.no_grad():
+        if self.micro_batch is not None:
+            inputs = {k: self.stack_blocks(v) for k, v in inputs.items()}
+        if self.tta_mirror or self.tta_transpose:
+            inputs = {k: self.augment(v) for k, v in inputs.items()}
+        if self.channels_last:
+            inputs = {
+                k: v.contiguous(memory_format=torch.channels_last_3d)
+                if v.dim() == 5 else v
+                for k, v in inputs.items()
+            }
+        batch_size = next(iter(inputs.values())).shape[0]
+        if self.torchscript_metadata:
+            self.check_torchscript_inputs(inputs)
+
+        with self.forward_context():
             out = self.model.forward(**inputs)
         outputs = self.get_outputs(out, request)
-        self.update_batch(batch, request, outputs)
+
+        if self.tta_mirror or self.tta_transpose:
+            outputs = {k: self.deaugment(v) for k, v in outputs.items()}
+        if self.micro_batch is not None:
+            outputs = {k: self.unstack_blocks(v) for k, v in outputs.items()}
+        self.update_batch(
+            batch, request, self.postprocess(batch, request, outputs))
+
+        self.record_throughput(batch_size, outputs, time.time() - start)
 
     def get_inputs(self, batch):
         model_inputs = {
@@ -148,6 +437,161 @@ class Predict(GenericPredict):
         }
         return model_inputs
 
+    def check_torchscript_inputs(self, inputs):
+        expected = tuple(self.torchscript_metadata['input_shape'])
+        for key, tensor in inputs.items():
+            if tuple(tensor.shape) != expected:
+                raise ValueError((
+                    f"Input {key} of shape {tuple(tensor.shape)} does not "
+                    f"match the shape {expected} that {self.torchscript} "
+                    "was exported for."
+                ))
+
+    def stack_blocks(self, tensor):
+        """Split a super-block input of shape ``(1, c, *spatial)`` into
+        overlapping blocks and stack them along the batch dimension."""
+
+        assert tensor.shape[0] == 1, \
+            f"Micro-batching expects a batch dimension of 1, got {tensor.shape}"
+        dims = len(self.micro_batch)
+        expected = tuple(
+            i + (n - 1) * o for n, i, o in zip(
+                self.micro_batch,
+                self.block_input_shape,
+                self.block_output_shape))
+        assert tuple(tensor.shape[-dims:]) == expected, \
+            (f"Input shape {tuple(tensor.shape)} does not match the "
+             f"super-block input shape {expected}")
+
+        blocks = []
+        for index in np.ndindex(*self.micro_batch):
+            slices = tuple(
+                slice(n * o, n * o + i) for n, i, o in zip(
+                    index, self.block_input_shape, self.block_output_shape))
+            blocks.append(tensor[(0, Ellipsis) + slices])
+
+        return torch.stack(blocks)
+
+    def unstack_blocks(self, tensor):
+        """Stitch block outputs of shape ``(n, c, *spatial)`` back into a
+        single super-block of shape ``(1, c, *super_spatial)``."""
+
+        dims = len(self.micro_batch)
+        channels = tuple(tensor.shape[1:-dims])
+        block_shape = tuple(tensor.shape[-dims:])
+        assert block_shape == self.block_output_shape, \
+            (f"Model output shape {block_shape} does not match "
+             f"block_output_shape {self.block_output_shape}")
+
+        # (n_z, n_y, n_x, *channels, o_z, o_y, o_x)
+        tensor = tensor.reshape(self.micro_batch + channels + block_shape)
+        # -> (*channels, n_z, o_z, n_y, o_y, n_x, o_x)
+        c = len(channels)
+        order = tuple(range(dims, dims + c))
+        for d in range(dims):
+            order += (d, dims + c + d)
+        tensor = tensor.permute(order)
+
+        super_shape = tuple(n * o for n, o in zip(
+            self.micro_batch, self.block_output_shape))
+        return tensor.reshape((1,) + channels + super_shape)
+
+    def get_tta_views(self, dims):
+        """All combinations of mirrored spatial axes and spatial axis
+        permutations, the identity first."""
+
+        if self._tta_views is None:
+            mirrors = [()]
+            if self.tta_mirror:
+                mirrors = [
+                    tuple(d for d in range(dims) if flip[d])
+                    for flip in itertools.product((False, True), repeat=dims)
+                ]
+            transposes = [tuple(range(dims))]
+            if self.tta_transpose:
+                transposes = list(itertools.permutations(range(dims)))
+            self._tta_views = list(itertools.product(mirrors, transposes))
+
+        return self._tta_views
+
+    def augment(self, tensor):
+        """Stack all test-time augmented views of ``(b, c, *spatial)`` along
+        the batch dimension, view-major."""
+
+        dims = tensor.dim() - 2
+        if self.tta_transpose and len(set(tensor.shape[2:])) > 1:
+            raise ValueError((
+                f"Transposing test-time augmentation requires equal spatial "
+                f"input shapes, got {tuple(tensor.shape)}"
+            ))
+
+        views = []
+        for mirror, transpose in self.get_tta_views(dims):
+            view = tensor
+            if mirror:
+                view = torch.flip(view, [2 + d for d in mirror])
+            view = view.permute((0, 1) + tuple(2 + d for d in transpose))
+            views.append(view)
+
+        return torch.cat(views)
+
+    def deaugment(self, tensor):
+        """Undo the test-time augmentation of stacked outputs of shape
+        ``(views * b, *channels, *spatial)`` and average over the views."""
+
+        # set up by augment
+        views = self._tta_views
+        dims = len(views[0][1])
+        spatial = tensor.dim() - dims
+
+        result = None
+        for (mirror, transpose), view in zip(
+                views, torch.chunk(tensor, len(views))):
+            inverse = [0] * dims
+            for d, t in enumerate(transpose):
+                inverse[t] = d
+            view = view.permute(
+                tuple(range(spatial)) + tuple(spatial + d for d in inverse))
+            if mirror:
+                view = torch.flip(view, [spatial + d for d in mirror])
+            result = view if result is None else result + view
+
+        return result / len(views)
+
+    def record_throughput(self, batch_size, outputs, duration):
+        # output voxels of all blocks, excluding the channel dimension
+        voxels = 0
+        if outputs:
+            out = next(iter(outputs.values()))
+            voxels = out.numel() // out.shape[1] if out.dim() > 1 \
+                else out.numel()
+
+        stats = self.throughput.setdefault(batch_size, [0, 0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += batch_size
+        stats[2] += voxels
+        stats[3] += duration
+
+        logger.debug(
+            f"Predicted {batch_size} block(s) in {duration:.3f} s")
+
+        self._predict_calls += 1
+        if self.log_throughput_every and \
+                self._predict_calls % self.log_throughput_every == 0:
+            self.log_throughput()
+
+    def log_throughput(self):
+        for batch_size, (calls, blocks, voxels, seconds) in sorted(
+                self.throughput.items()):
+            if seconds <= 0:
+                continue
+            logger.info((
+                f"Predict throughput at batch size {batch_size}: "
+                f"{blocks / seconds:.3f} blocks/s, "
+                f"{voxels / seconds:.3e} voxels/s "
+                f"({calls} forward passes, {seconds:.1f} s)"
+            ))
+
     def register_hooks(self):
         for key in self.outputs:
             if isinstance(key, str):
@@ -160,6 +604,39 @@ class Predict(GenericPredict):
 
         return save_layer
 
+    def postprocess(self, batch, request, outputs):
+        """Segmentations, softmax and dtype conversion of the outputs of
+        shape ``(b, c, *spatial)``, on the device."""
+
+        processed = {}
+        for array_key, tensor in outputs.items():
+            if tensor.dtype in (torch.bfloat16, torch.float16):
+                tensor = tensor.float()
+
+            segmentation = self.segmentations.get(array_key)
+            if segmentation is not None and segmentation in request:
+                labels = torch.argmax(tensor, dim=1)
+                labels = labels.to(
+                    torch.uint8 if tensor.shape[1] <= 256 else torch.int32)
+                if self.segmentation_mask is not None:
+                    mask = torch.as_tensor(
+                        batch[self.segmentation_mask].data,
+                        device=labels.device)
+                    labels *= (mask != 0).reshape(labels.shape)
+                processed[segmentation] = labels
+
+            if array_key not in request:
+                continue
+            if self.softmax:
+                tensor = torch.softmax(tensor, dim=1)
+            if self.output_dtype == 'uint8':
+                tensor = (tensor * 255).round_().to(torch.uint8)
+            elif self.output_dtype == 'float16':
+                tensor = tensor.half()
+            processed[array_key] = tensor
+
+        return processed
+
     def get_outputs(self, module_out, request):
         outputs = {}
         if isinstance(module_out, tuple):
@@ -167,7 +644,12 @@ class Predict(GenericPredict):
         else:
             module_outs = (module_out,)
         for key, value in self.outputs.items():
-            if value in request:
+            if isinstance(key, tuple):
+                # segmentation, computed in postprocess
+                continue
+            segmentation = self.segmentations.get(value)
+            if value in request or (
+                    segmentation is not None and segmentation in request):
                 if isinstance(key, str):
                     outputs[value] = self.intermediate_layers[key]
                 elif isinstance(key, int):
@@ -178,8 +660,10 @@ class Predict(GenericPredict):
         for array_key, tensor in requested_outputs.items():
             spec = self.spec[array_key].copy()
             spec.roi = request[array_key].roi
-            batch.arrays[array_key] = Array(
-                tensor.cpu().detach().numpy(), spec)
+            data = tensor.cpu().detach().numpy()
+            if spec.dtype is not None and data.dtype != spec.dtype:
+                data = data.astype(spec.dtype)
+            batch.arrays[array_key] = Array(data, spec)
 
     def stop(self):
-        pass
+        self.log_throughput()
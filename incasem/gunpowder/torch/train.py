@@ -7,6 +7,7 @@ https://github.com/kirchhausenlab/gunpowder/blob/patch-1.1.4-logging/gunpowder/t
 """
 
 import logging
+import os
 from typing import Dict, Union, Optional
 
 import numpy as np
@@ -15,6 +16,8 @@ from gunpowder.array import ArrayKey, Array
 from gunpowder.array_spec import ArraySpec
 from gunpowder.ext import torch, tensorboardX, NoSuchModule
 
+from incasem.torch.checkpoint import CheckpointWriter
+from incasem.tracking.metrics_logger import MetricsLogger, TensorboardSink
 from ..generic_train import GenericTrain
 
 
@@ -79,11 +82,18 @@ class Train(GenericTrain):
 
         log_dir (``string``, optional):
 
-            Directory for saving tensorboard summaries.
+            Directory for saving tensorboard summaries. They are buffered
+            and written from a background thread by an
+            ``incasem.tracking.MetricsLogger``.
 
         log_every (``int``, optional):
 
-            After how many iterations to write out tensorboard summaries.
+            After how many iterations to log the loss.
+
+        metrics_logger (``incasem.tracking.MetricsLogger``, optional):
+
+            Log the loss to this logger instead of one for ``log_dir``.
+            Requires ``spawn_subprocess=False``.
 
         device (``string``, optional):
 
@@ -94,6 +104,55 @@ class Train(GenericTrain):
         gpus (``list`` of ``int``, optional):
 
             Which GPUs to use for prediction.
+
+        autocast_dtype (``string``, optional):
+
+            If given (``"bfloat16"`` or ``"float16"``), run the forward pass
+            and the loss under ``torch.autocast`` with this dtype, for mixed
+            precision training. The weights and the optimizer state stay in
+            ``float32``, hence checkpoints are the same as without autocast.
+            ``"float16"`` additionally scales the loss with a
+            ``torch.amp.GradScaler``, whose state is stored in checkpoints as
+            ``scaler_state_dict``. ``"bfloat16"`` has the range of
+            ``float32`` and needs no scaling, it is the one to use on the CPU.
+
+        async_checkpoints (``bool``, optional):
+
+            Copy the state to CPU memory and write checkpoints from a
+            background thread, see ``incasem.torch.CheckpointWriter``.
+
+        keep_last_checkpoints (``int``, optional):
+
+            Only keep this many most recent checkpoints. Default keeps all.
+
+        keep_checkpoints_every (``int``, optional):
+
+            Keep the checkpoints of every ``keep_checkpoints_every``-th
+            iteration in addition to the most recent ones.
+
+        distributed (``bool``, optional):
+
+            Data-parallel training in several processes, one per rank of the
+            default ``torch.distributed`` process group, each with its own
+            upstream pipeline. The group is initialized in ``start`` from
+            ``dist_init_method`` unless it already is, with the ``env://``
+            default from the ``RANK`` and ``WORLD_SIZE`` environment
+            variables. The model is wrapped in
+            ``torch.nn.parallel.DistributedDataParallel``, which all-reduces
+            the gradients. Rank 0 loads the latest checkpoint and sends it to
+            the other ranks, and only rank 0 writes checkpoints and
+            tensorboard summaries. ``batch.loss`` is the loss of the local
+            batch. With CUDA, each process trains on ``gpus[LOCAL_RANK]``,
+            hence ``gpus`` needs one GPU per process on this machine.
+
+        dist_backend (``string``, optional):
+
+            Backend of the process group, ``"gloo"`` (default) runs on the
+            CPU, ``"nccl"`` requires CUDA.
+
+        dist_init_method (``string``, optional):
+
+            URL to initialize the process group from.
     """
 
     def __init__(
@@ -110,9 +169,17 @@ class Train(GenericTrain):
         save_every: int = 2000,
         log_dir: str = None,
         log_every: int = 1,
+        metrics_logger: MetricsLogger = None,
         device="cuda",
         gpus=[0],
         spawn_subprocess: bool = False,
+        autocast_dtype: str = None,
+        async_checkpoints: bool = False,
+        keep_last_checkpoints: int = None,
+        keep_checkpoints_every: int = None,
+        distributed: bool = False,
+        dist_backend: str = "gloo",
+        dist_init_method: str = "env://",
     ):
 
         if not model.training:
@@ -141,16 +208,35 @@ class Train(GenericTrain):
         self.device = None
         self.gpus = gpus
 
+        if autocast_dtype not in (None, 'bfloat16', 'float16'):
+            raise ValueError(
+                f"Unsupported autocast dtype {autocast_dtype}.")
+        self.autocast_dtype = autocast_dtype
+        self.scaler = None
+
+        self.async_checkpoints = async_checkpoints
+        self.keep_last_checkpoints = keep_last_checkpoints
+        self.keep_checkpoints_every = keep_checkpoints_every
+        self.checkpoint_writer = None
+
+        self.distributed = distributed
+        self.dist_backend = dist_backend
+        self.dist_init_method = dist_init_method
+        self.rank = 0
+        self.world_size = 1
+        self.owns_process_group = False
+        self.parallel_model = None
+
         self.iteration = 0
 
-        if not isinstance(tensorboardX, NoSuchModule) and log_dir is not None:
-            self.summary_writer = tensorboardX.SummaryWriter(log_dir)
-            self.log_every = log_every
-        else:
-            self.summary_writer = None
-            if log_dir is not None:
-                logger.warning(
-                    "log_dir given, but tensorboardX is not installed")
+        # created in start, only on rank 0
+        self.log_dir = log_dir
+        self.log_every = log_every
+        self.metrics_logger = metrics_logger
+        self.owns_metrics_logger = False
+        if isinstance(tensorboardX, NoSuchModule) and log_dir is not None:
+            logger.warning(
+                "log_dir given, but tensorboardX is not installed")
 
         self.intermediate_layers = {}
         self.register_hooks()
@@ -185,11 +271,24 @@ class Train(GenericTrain):
 
         self.use_cuda = torch.cuda.is_available() and self.device_string == "cuda"
 
+        if self.distributed:
+            self._init_process_group()
+
         if self.use_cuda:
-            if len(self.gpus) != 1:
-                raise NotImplementedError(
-                    f"Training only implemented for a single GPU.")
-            torch.cuda.set_device(self.gpus[0])
+            if self.distributed:
+                local_rank = int(os.environ.get("LOCAL_RANK", 0))
+                if local_rank >= len(self.gpus):
+                    raise ValueError(
+                        f"Process with LOCAL_RANK {local_rank} has no GPU "
+                        f"of {self.gpus}, give one per process on this "
+                        f"machine.")
+                torch.cuda.set_device(self.gpus[local_rank])
+            else:
+                if len(self.gpus) != 1:
+                    raise NotImplementedError(
+                        f"Training only implemented for a single GPU, "
+                        f"use distributed training for several.")
+                torch.cuda.set_device(self.gpus[0])
             logger.info(f"Training on gpu {torch.cuda.current_device()}.")
         else:
             logger.info("Training on cpu.")
@@ -208,18 +307,23 @@ class Train(GenericTrain):
         if isinstance(self.loss, torch.nn.Module):
             self.loss = self.loss.to(self.device)
 
-        checkpoint, self.iteration = self._get_latest_checkpoint(
-            self.checkpoint_basename
-        )
+        if self.autocast_dtype is not None:
+            logger.info(
+                "Mixed precision training with %s", self.autocast_dtype)
+        if self.autocast_dtype == 'float16':
+            # small float16 gradients underflow without loss scaling
+            self.scaler = torch.amp.GradScaler(self.device.type)
+
+        checkpoint, self.iteration = self._load_latest_checkpoint()
 
         if checkpoint is not None:
 
             logger.info("Resuming training from iteration %d", self.iteration)
-            logger.info("Loading %s", checkpoint)
 
-            checkpoint = torch.load(checkpoint, map_location=self.device)
             self.model.load_state_dict(checkpoint["model_state_dict"])
             self.optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
+            if self.scaler is not None and "scaler_state_dict" in checkpoint:
+                self.scaler.load_state_dict(checkpoint["scaler_state_dict"])
 
         else:
 
@@ -227,6 +331,80 @@ class Train(GenericTrain):
 
         logger.info("Using device %s", self.device)
 
+        if self.distributed:
+            # the gradients are all-reduced in the backward pass, the
+            # parameters of rank 0 are broadcast at construction
+            self.parallel_model = torch.nn.parallel.DistributedDataParallel(
+                self.model,
+                device_ids=[self.device.index] if self.use_cuda else None
+            )
+
+        if self.rank != 0:
+            return
+
+        self.checkpoint_writer = CheckpointWriter(
+            self.checkpoint_basename,
+            keep_last=self.keep_last_checkpoints,
+            keep_every=self.keep_checkpoints_every,
+            asynchronous=self.async_checkpoints
+        )
+
+        if self.metrics_logger is None and self.log_dir is not None and \
+                not isinstance(tensorboardX, NoSuchModule):
+            self.metrics_logger = MetricsLogger(
+                [TensorboardSink(self.log_dir)])
+            self.owns_metrics_logger = True
+
+    def stop(self):
+        if self.checkpoint_writer is not None:
+            logger.info("Waiting for checkpoints to be written ...")
+            self.checkpoint_writer.close()
+        if self.owns_metrics_logger:
+            self.metrics_logger.close()
+            self.metrics_logger = None
+            self.owns_metrics_logger = False
+        if self.owns_process_group:
+            torch.distributed.destroy_process_group()
+            self.owns_process_group = False
+
+    def _init_process_group(self):
+        dist = torch.distributed
+        if not dist.is_initialized():
+            dist.init_process_group(
+                backend=self.dist_backend,
+                init_method=self.dist_init_method
+            )
+            self.owns_process_group = True
+
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        logger.info(
+            "Distributed training, rank %d of %d (%s)",
+            self.rank, self.world_size, dist.get_backend())
+
+    def _load_latest_checkpoint(self):
+        checkpoint = None
+        iteration = 0
+        if self.rank == 0:
+            checkpoint_name, iteration = self._get_latest_checkpoint(
+                self.checkpoint_basename
+            )
+            if checkpoint_name is not None:
+                logger.info("Loading %s", checkpoint_name)
+                # sent to the other ranks from the cpu
+                checkpoint = torch.load(
+                    checkpoint_name,
+                    map_location="cpu" if self.distributed else self.device
+                )
+
+        if self.distributed:
+            # the other ranks need not have access to the checkpoints
+            objects = [checkpoint, iteration]
+            torch.distributed.broadcast_object_list(objects, src=0)
+            checkpoint, iteration = objects
+
+        return checkpoint, iteration
+
     def train_step(self, batch, request):
         batch.iteration = self.iteration
 
@@ -248,7 +426,10 @@ class Train(GenericTrain):
         # get outputs. Keys are tuple indices or model attr names as in
         # self.outputs
         self.optimizer.zero_grad()
-        model_outputs = self.model(**device_inputs)
+        model = self.model if self.parallel_model is None \
+            else self.parallel_model
+        with self._autocast():
+            model_outputs = model(**device_inputs)
         if isinstance(model_outputs, tuple):
             outputs = {i: model_outputs[i] for i in range(len(model_outputs))}
         elif isinstance(model_outputs, torch.Tensor):
@@ -308,12 +489,16 @@ class Train(GenericTrain):
         # logger.debug(f"loss_inputs: {device_loss_args},
         # {device_loss_kwargs}")
 
-        loss = self.loss(*device_loss_args, **device_loss_kwargs)
-        if loss.dim() == 1:
-            loss[0].backward()
+        with self._autocast():
+            loss = self.loss(*device_loss_args, **device_loss_kwargs)
+        loss_backward = loss[0] if loss.dim() == 1 else loss
+        if self.scaler is not None:
+            self.scaler.scale(loss_backward).backward()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
         else:
-            loss.backward()
-        self.optimizer.step()
+            loss_backward.backward()
+            self.optimizer.step()
 
         # TODO fix bug for logging histograms
         # if self.summary_writer and batch.iteration % self.log_every == 0:
@@ -338,7 +523,7 @@ class Train(GenericTrain):
             spec = self.spec[array_key].copy()
             spec.roi = request[array_key].roi
             batch.arrays[array_key] = Array(
-                outputs[array_name].detach().cpu().numpy(), spec
+                self._to_numpy(outputs[array_name]), spec
             )
 
         for array_name, array_key in self.gradients.items():
@@ -355,12 +540,12 @@ class Train(GenericTrain):
             spec = self.spec[array_key].copy()
             spec.roi = request[array_key].roi
             batch.arrays[array_key] = Array(
-                tensor.grad.detach().cpu().numpy(), spec
+                self._to_numpy(tensor.grad), spec
             )
 
-        batch.loss = loss.detach().cpu().numpy()
+        batch.loss = self._to_numpy(loss)
 
-        if batch.iteration % self.save_every == 0:
+        if self.rank == 0 and batch.iteration % self.save_every == 0:
 
             checkpoint_name = self._checkpoint_name(
                 self.checkpoint_basename, batch.iteration
@@ -368,21 +553,36 @@ class Train(GenericTrain):
 
             logger.info("Creating checkpoint %s", checkpoint_name)
 
-            torch.save(
-                {
-                    "model_state_dict": self.model.state_dict(),
-                    "optimizer_state_dict": self.optimizer.state_dict(),
-                },
-                checkpoint_name,
-            )
+            checkpoint = {
+                "model_state_dict": self.model.state_dict(),
+                "optimizer_state_dict": self.optimizer.state_dict(),
+            }
+            if self.scaler is not None:
+                checkpoint["scaler_state_dict"] = self.scaler.state_dict()
+            self.checkpoint_writer.save(checkpoint, checkpoint_name)
 
-        iterable_loss = np.atleast_1d(batch.loss).tolist()
-        if self.summary_writer:
-            for i, l in enumerate(iterable_loss):
-                self.summary_writer.add_scalar(f"loss_{i}", l, batch.iteration)
+        if self.rank == 0 and self.metrics_logger is not None and \
+                batch.iteration % self.log_every == 0:
+            for i, l in enumerate(torch.atleast_1d(loss)):
+                self.metrics_logger.log_scalar(
+                    f"loss_{i}", l, batch.iteration)
 
         self.iteration += 1
 
+    def _autocast(self):
+        return torch.autocast(
+            device_type=self.device.type,
+            dtype=getattr(torch, self.autocast_dtype or 'float32'),
+            enabled=self.autocast_dtype is not None
+        )
+
+    def _to_numpy(self, tensor):
+        # numpy has no bfloat16
+        tensor = tensor.detach()
+        if tensor.is_floating_point():
+            tensor = tensor.float()
+        return tensor.cpu().numpy()
+
     def __collect_requested_outputs(self, request):
 
         array_outputs = {}
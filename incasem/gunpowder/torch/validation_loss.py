@@ -10,41 +10,75 @@ logger = logging.getLogger(__name__)
 
 
 class ValidationLoss(gp.BatchFilter):
+    """Compute the loss of the batch, e.g. the whole validation ROI
+    assembled by ``gp.Scan``, and log it to tensorboard.
+
+    With ``accumulator``, an :class:`AccumulateLoss` upstream of the scan,
+    the loss is instead accumulated block by block, and this node only
+    resets the accumulator before and reports its value after each scan.
+    ``loss`` and ``inputs`` are not needed then.
+    """
+
     def __init__(
             self,
-            loss,
-            inputs: Dict[int, gp.ArrayKey],
+            loss=None,
+            inputs: Dict[int, gp.ArrayKey] = None,
             log_dir: str = None,
-            log_every: int = 1):
+            log_every: int = 1,
+            accumulator=None):
 
         self.inputs = inputs
+        self.accumulator = accumulator
 
         # TODO init cuda only in start() method, similar to gunpowder.torch.Predict
         # self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.device = 'cpu'
-        self.loss = loss.to(self.device)
+        self.loss = None if loss is None else loss.to(self.device)
+        if self.loss is None and self.accumulator is None:
+            raise ValueError("Either a loss or an accumulator is required.")
 
         self.log_dir = log_dir
         self.log_every = log_every
         self.iteration = 0
 
-        if not isinstance(tensorboardX, NoSuchModule) and log_dir is not None:
-            self.summary_writer = tensorboardX.SummaryWriter(log_dir)
-        else:
+        # created in setup, in the process that runs the pipeline
+        self.summary_writer = None
+        if isinstance(tensorboardX, NoSuchModule) and log_dir is not None:
+            logger.warning(
+                "log_dir given, but tensorboardX is not installed")
+
+    def setup(self):
+        if not isinstance(tensorboardX, NoSuchModule) and \
+                self.log_dir is not None:
+            self.summary_writer = tensorboardX.SummaryWriter(self.log_dir)
+
+    def teardown(self):
+        if self.summary_writer is not None:
+            self.summary_writer.close()
             self.summary_writer = None
-            if log_dir is not None:
-                logger.warning(
-                    "log_dir given, but tensorboardX is not installed")
+
+    def prepare(self, request):
+        if self.accumulator is not None:
+            self.accumulator.reset()
+
+        deps = gp.BatchRequest()
+        for key, spec in request.items():
+            deps[key] = spec.copy()
+        return deps
 
     def process(self, batch, request):
-        device_loss_inputs = []
-        for i in range(len(self.inputs)):
-            device_loss_inputs.append(
-                torch.from_numpy(batch[self.inputs[i]].data).to(self.device)
-            )
-
-        loss = self.loss(*device_loss_inputs)
-        batch.loss = loss.detach().cpu().numpy()
+        if self.accumulator is not None:
+            batch.loss = np.float32(self.accumulator.value)
+        else:
+            device_loss_inputs = []
+            for i in range(len(self.inputs)):
+                device_loss_inputs.append(
+                    torch.from_numpy(
+                        batch[self.inputs[i]].data).to(self.device)
+                )
+
+            loss = self.loss(*device_loss_inputs)
+            batch.loss = loss.detach().cpu().numpy()
 
         iterable_loss = np.atleast_1d(batch.loss).tolist()
         if self.summary_writer:
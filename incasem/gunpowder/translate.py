@@ -0,0 +1,43 @@
+import logging
+
+import gunpowder as gp
+
+logger = logging.getLogger(__name__)
+
+
+class Translate(gp.BatchFilter):
+    """Move all arrays provided upstream by ``shift`` in world coordinates.
+
+    Requests are shifted back before they are passed upstream, so that the
+    data itself is unchanged.
+
+    Args:
+
+        shift (gp.Coordinate):
+
+            Offset that is added to all upstream ROIs.
+    """
+
+    def __init__(self, shift):
+        self.shift = gp.Coordinate(shift)
+
+    def setup(self):
+        for key, spec in self.spec.items():
+            if spec.roi is None:
+                continue
+            spec = spec.copy()
+            spec.roi = spec.roi.shift(self.shift)
+            self.updates(key, spec)
+
+    def provide(self, request):
+        # the requested ROIs are moved, which a prepare/process pair can not
+        # express for arrays that are also requested upstream
+        upstream_request = request.copy()
+        for key, spec in upstream_request.array_specs.items():
+            spec.roi = spec.roi.shift(-self.shift)
+
+        batch = self.get_upstream_provider().request_batch(upstream_request)
+        for key, array in batch.arrays.items():
+            array.spec.roi = array.spec.roi.shift(self.shift)
+
+        return batch
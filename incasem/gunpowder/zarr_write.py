@@ -17,6 +17,8 @@ from gunpowder.coordinate import Coordinate  # noqa
 from gunpowder.ext import ZarrFile  # noqa
 from gunpowder.compat import ensure_str  # noqa
 
+from incasem.utils.background_writer import BackgroundWriter
+
 logger = logging.getLogger(__name__)
 
 
@@ -59,6 +61,32 @@ class ZarrWrite(BatchFilter):
             Chunk shape for output datasets. Set to ``True`` for auto-chunking,
             set to ``False`` to obtain a chunk equal to the dataset size.
             Defaults to ``True``.
+
+        num_writers (``int``):
+
+            If larger than 0, write the arrays of passing batches from that
+            many background threads, so that the batch can continue
+            downstream immediately, see ``incasem.utils.BackgroundWriter``.
+            Only effective in the process that tears the pipeline down, e.g.
+            when used with a ``gp.Scan`` with a single worker, otherwise
+            writes are synchronous. Defaults to 0.
+
+        queue_size (``int``):
+
+            Maximum number of batches waiting to be written by the background
+            threads. If the queue is full, ``process`` blocks.
+
+        roi (:class:`Roi`, optional):
+
+            Only write the parts of passing arrays inside this ROI, batches
+            outside of it pass without being written. Datasets are created
+            for the provided ROIs intersected with ``roi``.
+
+        shift (:class:`Coordinate`, optional):
+
+            Added to the ROIs of passing arrays before writing, e.g. to write
+            arrays moved by :class:`Translate` back at their original
+            position.
     '''
 
     def __init__(
@@ -67,7 +95,11 @@ class ZarrWrite(BatchFilter):
             output_dir='.',
             output_filename='output.hdf',
             dataset_dtypes=None,
-            chunks=True):
+            chunks=True,
+            num_writers=0,
+            queue_size=8,
+            roi=None,
+            shift=None):
 
         self.dataset_names = dataset_names
         self.output_dir = output_dir
@@ -78,14 +110,35 @@ class ZarrWrite(BatchFilter):
         else:
             self.dataset_dtypes = dataset_dtypes
         self.chunks = chunks
+        self.num_writers = num_writers
+        self.queue_size = queue_size
+        self.roi = roi
+        self.shift = None if shift is None else Coordinate(shift)
 
         self.dataset_offsets = {}
 
+        self._writer = BackgroundWriter(
+            self._write,
+            name='ZarrWrite',
+            num_threads=max(1, num_writers),
+            queue_size=queue_size)
+        self._data_file = None
+
     def setup(self):
         for key in self.dataset_names.keys():
             self.updates(key, self.spec[key])
         self.enable_autoskip()
 
+        self._setup_pid = os.getpid()
+
+    def teardown(self):
+        if self._data_file is None:
+            return
+
+        logger.info("Waiting for background writes to finish ...")
+        self._data_file = None
+        self._writer.close()
+
     def prepare(self, request):
         deps = BatchRequest()
         for key in self.dataset_names.keys():
@@ -119,16 +172,21 @@ class ZarrWrite(BatchFilter):
 
                 # if a dataset already exists, read its meta-information (if
                 # present)
+                provided_roi = self._get_provided_roi(array_key)
+
                 if dataset_name in data_file:
 
-                    offset = self._get_offset(
-                        data_file[dataset_name]) or Coordinate(
-                        (0,) * dims)
+                    offset = self._get_offset(data_file[dataset_name])
+                    if offset is None:
+                        # the dataset might still be initialized by another
+                        # process writing to the same container
+                        if provided_roi is not None:
+                            offset = provided_roi.get_offset()
+                        else:
+                            offset = Coordinate((0,) * dims)
 
                 else:
 
-                    provided_roi = self.spec[array_key].roi
-
                     if provided_roi is None:
                         raise RuntimeError(
                             "Dataset %s does not exist in %s, and no ROI is "
@@ -155,18 +213,24 @@ class ZarrWrite(BatchFilter):
                         dataset_name, data_shape, self.compression_type, dtype,
                         offset, voxel_size)
 
-                    dataset = data_file.create_dataset(
-                        name=dataset_name,
-                        shape=data_shape,
-                        compression=self.compression_type,
-                        dtype=dtype,
-                        chunks=self.chunks,
-                        synchronizer=zarr.ProcessSynchronizer(
-                            os.path.join(filename, 'sync')),
-                    )
-
-                    self._set_offset(dataset, offset)
-                    self._set_voxel_size(dataset, voxel_size)
+                    try:
+                        dataset = data_file.create_dataset(
+                            name=dataset_name,
+                            shape=data_shape,
+                            compression=self.compression_type,
+                            dtype=dtype,
+                            chunks=self.chunks,
+                            synchronizer=zarr.ProcessSynchronizer(
+                                os.path.join(filename, 'sync')),
+                        )
+                    except zarr.errors.ContainsArrayError:
+                        # created concurrently by another process writing to
+                        # the same container, with the same offset
+                        logger.debug(
+                            "%s was created by another process", dataset_name)
+                    else:
+                        self._set_offset(dataset, offset)
+                        self._set_voxel_size(dataset, voxel_size)
 
                 logger.debug(
                     "%s (%s in %s) has offset %s",
@@ -176,54 +240,98 @@ class ZarrWrite(BatchFilter):
                     offset)
                 self.dataset_offsets[array_key] = offset
 
+    def _get_provided_roi(self, array_key):
+        """The provided ROI of ``array_key`` in the coordinates of the output
+        container."""
+
+        provided_roi = self.spec[array_key].roi
+        if provided_roi is None:
+            return None
+
+        if self.roi is not None:
+            provided_roi = provided_roi.intersect(self.roi)
+        if self.shift is not None:
+            provided_roi = provided_roi.shift(self.shift)
+
+        return provided_roi
+
     def process(self, batch, request):
 
         filename = os.path.join(self.output_dir, self.output_filename)
 
+        if self.roi is not None and not any(
+                batch.arrays[array_key].spec.roi.intersects(self.roi)
+                for array_key in self.dataset_names.keys()):
+            return
+
         if not self.dataset_offsets:
             self.init_datasets(batch)
 
+        if self.num_writers > 0 and os.getpid() == self._setup_pid:
+            if self._data_file is None:
+                # shared by the writer threads
+                self._data_file = zarr.open(
+                    self._get_store(filename),
+                    mode='a',
+                    synchronizer=zarr.ThreadSynchronizer())
+
+            arrays = {
+                array_key: batch.arrays[array_key]
+                for array_key in self.dataset_names.keys()
+            }
+            self._writer.put(self._data_file, arrays)
+            return
+
         with self._open_file(filename) as data_file:
+            self._write(data_file, batch.arrays)
 
-            for (array_key, dataset_name) in self.dataset_names.items():
-
-                dataset = data_file[dataset_name]
-
-                array_roi = batch.arrays[array_key].spec.roi
-                voxel_size = self.spec[array_key].voxel_size
-                dims = array_roi.dims()
-                channel_slices = (slice(None),) * \
-                    max(0, len(dataset.shape) - dims)
-
-                dataset_roi = Roi(
-                    self.dataset_offsets[array_key],
-                    Coordinate(dataset.shape[-dims:]) * voxel_size)
-                common_roi = array_roi.intersect(dataset_roi)
-
-                if common_roi.empty():
-                    logger.warn(
-                        "array %s with ROI %s lies outside of dataset ROI %s, "
-                        "skipping writing" % (
-                            array_key,
-                            array_roi,
-                            dataset_roi))
-                    continue
-
-                dataset_voxel_roi = (
-                    common_roi - self.dataset_offsets[array_key]) // voxel_size
-                dataset_voxel_slices = dataset_voxel_roi.to_slices()
-                array_voxel_roi = (
-                    common_roi - array_roi.get_offset()) // voxel_size
-                array_voxel_slices = array_voxel_roi.to_slices()
+    def _write(self, data_file, arrays):
 
-                logger.debug(
-                    "writing %s to voxel coordinates %s" % (
+        for (array_key, dataset_name) in self.dataset_names.items():
+
+            dataset = data_file[dataset_name]
+
+            array_roi = arrays[array_key].spec.roi
+            write_roi = array_roi
+            if self.roi is not None:
+                write_roi = write_roi.intersect(self.roi)
+            if self.shift is not None:
+                array_roi = array_roi.shift(self.shift)
+                write_roi = write_roi.shift(self.shift)
+            voxel_size = self.spec[array_key].voxel_size
+            dims = array_roi.dims()
+            channel_slices = (slice(None),) * \
+                max(0, len(dataset.shape) - dims)
+
+            dataset_roi = Roi(
+                self.dataset_offsets[array_key],
+                Coordinate(dataset.shape[-dims:]) * voxel_size)
+            common_roi = write_roi.intersect(dataset_roi)
+
+            if common_roi.empty():
+                logger.warn(
+                    "array %s with ROI %s lies outside of dataset ROI %s, "
+                    "skipping writing" % (
                         array_key,
-                        dataset_voxel_roi))
+                        array_roi,
+                        dataset_roi))
+                continue
+
+            dataset_voxel_roi = (
+                common_roi - self.dataset_offsets[array_key]) // voxel_size
+            dataset_voxel_slices = dataset_voxel_roi.to_slices()
+            array_voxel_roi = (
+                common_roi - array_roi.get_offset()) // voxel_size
+            array_voxel_slices = array_voxel_roi.to_slices()
+
+            logger.debug(
+                "writing %s to voxel coordinates %s" % (
+                    array_key,
+                    dataset_voxel_roi))
 
-                data = batch.arrays[array_key].data[channel_slices +
-                                                    array_voxel_slices]
-                dataset[channel_slices + dataset_voxel_slices] = data
+            data = arrays[array_key].data[channel_slices +
+                                          array_voxel_slices]
+            dataset[channel_slices + dataset_voxel_slices] = data
 
     def _get_voxel_size(self, dataset):
 
@@ -261,3 +369,9 @@ class ZarrWrite(BatchFilter):
 
     def _open_file(self, filename):
         return ZarrFile(ensure_str(filename), mode='a')
+
+    def _get_store(self, filename):
+        filename = ensure_str(filename)
+        if filename.endswith('.n5'):
+            return zarr.N5Store(filename)
+        return filename
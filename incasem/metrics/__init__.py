@@ -5,3 +5,10 @@ from .precision_recall_curve import precision_recall_curve
 from .pairwise_distance_metric_thresholded \
     import pairwise_distance_metric_thresholded
 from .confusion_matrix import confusion_matrix
+from .counts import (
+    confusion_counts,
+    thresholded_counts,
+    jaccard_from_counts,
+    dice_from_counts,
+    precision_recall_from_counts
+)
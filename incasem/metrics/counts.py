@@ -0,0 +1,129 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _flatten(target, prediction_probas, mask):
+    num_classes = prediction_probas.shape[0]
+    prediction_probas = prediction_probas.reshape(num_classes, -1)
+    target = target.reshape(-1)
+
+    if mask is not None:
+        mask = mask.reshape(-1).astype(bool)
+        target = target[mask]
+        prediction_probas = prediction_probas[:, mask]
+
+    assert target.shape[0] == prediction_probas.shape[1], \
+        (f"Target shape {target.shape} and prediction shape "
+         f"{prediction_probas.shape} do not match.")
+
+    return target, prediction_probas
+
+
+def confusion_counts(target, prediction_probas, mask=None):
+    """Unnormalized confusion matrix of the argmax prediction.
+
+    Counts of several blocks can be summed up, and reduced to scores with
+    ``precision_recall_from_counts``.
+
+    Args:
+
+        target:
+
+            n-d numpy array of integers.
+
+        prediction_probas:
+
+            (n+1)-d (channel, ...) numpy array of class scores.
+
+        mask:
+
+            n-d numpy array of binary integers to exclude certain positions.
+
+    Returns:
+
+        ``np.ndarray`` of ``int64``: (true class, predicted class) counts.
+    """
+
+    num_classes = prediction_probas.shape[0]
+    target, prediction_probas = _flatten(target, prediction_probas, mask)
+
+    prediction = np.argmax(prediction_probas, axis=0)
+    return np.bincount(
+        target.astype(np.int64) * num_classes + prediction,
+        minlength=num_classes * num_classes
+    ).reshape(num_classes, num_classes)
+
+
+def thresholded_counts(target, prediction_probas, threshold, mask=None):
+    """Per class binary confusion counts, with the prediction of class ``i``
+    being ``prediction_probas[i] >= threshold``.
+
+    Counts of several blocks can be summed up, and reduced to scores with
+    ``jaccard_from_counts`` and ``dice_from_counts``.
+
+    Returns:
+
+        ``np.ndarray`` of ``int64`` with shape (classes, 2, 2): (true,
+        predicted) counts for each class, e.g. ``[i, 1, 1]`` are the true
+        positives of class ``i``.
+    """
+
+    num_classes = prediction_probas.shape[0]
+    target, prediction_probas = _flatten(target, prediction_probas, mask)
+
+    counts = np.empty((num_classes, 2, 2), dtype=np.int64)
+    for i in range(num_classes):
+        counts[i] = np.bincount(
+            (target == i) * 2 + (prediction_probas[i] >= threshold),
+            minlength=4
+        ).reshape(2, 2)
+
+    return counts
+
+
+def jaccard_from_counts(counts):
+    """Jaccard score of each class from ``thresholded_counts``, same as
+    ``pairwise_distance_metric_thresholded(..., metric='jaccard')``."""
+
+    scores = []
+    for c in counts:
+        tp, fp, fn = c[1, 1], c[0, 1], c[1, 0]
+        if tp + fp + fn == 0:
+            scores.append(1.0)
+        else:
+            scores.append(float(tp / (tp + fp + fn)))
+    return scores
+
+
+def dice_from_counts(counts):
+    """Dice score of each class from ``thresholded_counts``, same as
+    ``pairwise_distance_metric_thresholded(..., metric='dice')``."""
+
+    scores = []
+    for c in counts:
+        tp, fp, fn = c[1, 1], c[0, 1], c[1, 0]
+        if 2 * tp + fp + fn == 0:
+            scores.append(float('nan'))
+        else:
+            scores.append(float(2 * tp / (2 * tp + fp + fn)))
+    return scores
+
+
+def precision_recall_from_counts(confusion):
+    """Argmax-based precision and recall of each class from
+    ``confusion_counts``, same as ``precision_recall``."""
+
+    scores = []
+    for i in range(confusion.shape[0]):
+        tp = confusion[i, i]
+        fp = confusion[:, i].sum() - tp
+        fn = confusion[i, :].sum() - tp
+
+        precision = 0 if tp + fp == 0 else float(tp / (tp + fp))
+        recall = 0 if tp + fn == 0 else float(tp / (tp + fn))
+        scores.append((precision, recall))
+
+    return scores
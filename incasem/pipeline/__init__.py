@@ -6,3 +6,6 @@ from . import sources
 from .training_baseline_with_context import TrainingBaselineWithContext
 from .validation_baseline_with_context import ValidationBaselineWithContext
 from .prediction_baseline import PredictionBaseline
+from .cascade import predict_cascade_indices
+from .background_validation import BackgroundValidation
+from .load_blocks import load_blocks
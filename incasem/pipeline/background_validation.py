@@ -0,0 +1,264 @@
+import logging
+import multiprocessing
+import queue
+import traceback
+
+import numpy as np
+
+import gunpowder as gp
+from incasem.torch.checkpoint import state_to_cpu
+
+logger = logging.getLogger(__name__)
+
+# seconds between checks whether the worker is still alive, while waiting
+# for it
+POLL_INTERVAL = 1.0
+
+
+class BackgroundValidation:
+    """Run validation pipelines on a copy of the weights in a separate
+    process, while training continues.
+
+    The worker process is forked in ``start``, with its own copy of
+    ``model`` and of the ``ValidationBaselineWithContext`` objects in
+    ``validations``, whose pipelines it builds. ``validate`` sends a CPU copy
+    of the weights of ``model`` and returns immediately; the worker loads
+    them and scans the validation ROI of each pipeline, with an empty
+    request, or the whole ROI for pipelines with a snapshot. Results are
+    collected with ``poll``, tagged with the training iteration of the
+    weights they were computed with.
+
+    At most one validation waits while another one runs, further calls to
+    ``validate`` are skipped, so that training never waits for validation.
+    If the worker dies, e.g. killed for running out of memory, ``validate``,
+    ``poll`` and ``close`` raise a ``RuntimeError`` instead of waiting for
+    it.
+
+    Call ``start`` before CUDA is initialized in this process, i.e. before
+    building the training pipeline, since a forked process cannot use it
+    otherwise.
+
+    Args:
+
+        model (``torch.nn.Module``):
+
+            The model being trained, shared with the validation pipelines.
+
+        validations (``list`` of ``ValidationBaselineWithContext``):
+
+            Validation pipelines, not built yet.
+
+        metrics_fn (``callable``, optional):
+
+            Called with the validation pipeline after its scan, e.g. for its
+            ``confusion_counts``, the iteration and a name for the
+            validation pipeline, returns a ``dict`` of further metric names
+            and values.
+
+        asynchronous (``bool``, optional):
+
+            If false, ``validate`` runs the validation on ``model`` in this
+            process before returning.
+    """
+
+    def __init__(
+            self,
+            model,
+            validations,
+            metrics_fn=None,
+            asynchronous=True):
+        self.model = model
+        self.validations = validations
+        self.metrics_fn = metrics_fn
+        self.asynchronous = asynchronous
+
+        self._requests = None
+        self._results = None
+        self._process = None
+        self._pending = 0
+        self._completed = []
+        self._val_requests = None
+
+    def start(self):
+        """Fork the worker, or build the pipelines in this process."""
+
+        if not self.asynchronous:
+            self._setup()
+            return
+
+        context = multiprocessing.get_context('fork')
+        self._requests = context.Queue(maxsize=1)
+        self._results = context.Queue()
+        # does not outlive this process, its pipelines cannot start further
+        # processes
+        self._process = context.Process(
+            target=self._run, name='BackgroundValidation', daemon=True)
+        self._process.start()
+
+    def validate(self, iteration):
+        """Validate the current weights of ``model`` for ``iteration``.
+
+        Returns:
+
+            ``True`` if the validation was run or queued, ``False`` if it was
+            skipped because the worker is busy.
+        """
+
+        if not self.asynchronous:
+            self._completed.extend(self._validate(iteration))
+            return True
+
+        self._check_alive()
+        state = state_to_cpu(self.model.state_dict())
+        try:
+            self._requests.put_nowait((state, iteration))
+        except queue.Full:
+            logger.warning(
+                f"Skipping validation of iteration {iteration}, "
+                "the previous one is still waiting.")
+            return False
+
+        self._pending += 1
+        return True
+
+    def poll(self, block=False):
+        """Results of finished validations.
+
+        Args:
+
+            block (``bool``, optional):
+
+                Wait for all pending validations.
+
+        Returns:
+
+            ``list`` of ``(name, value, iteration)``.
+        """
+
+        results, self._completed = self._completed, []
+        while self._pending > 0:
+            try:
+                item = self._results.get(block=block, timeout=POLL_INTERVAL)
+            except queue.Empty:
+                self._check_alive()
+                if block:
+                    continue
+                break
+            self._pending -= 1
+            if isinstance(item, str):
+                raise RuntimeError(f"Validation failed:\n{item}")
+            results.extend(item)
+
+        return results
+
+    def close(self):
+        """Wait for pending validations and stop the worker.
+
+        Returns:
+
+            ``list`` of ``(name, value, iteration)`` not polled yet.
+        """
+
+        if not self.asynchronous:
+            self._teardown()
+            return self.poll()
+
+        if self._process is None:
+            return self.poll()
+
+        results = []
+        try:
+            results = self.poll(block=True)
+        finally:
+            self._stop_worker()
+
+        return results
+
+    def _check_alive(self):
+        if not self._process.is_alive():
+            pending, self._pending = self._pending, 0
+            raise RuntimeError((
+                f"Validation worker exited with code "
+                f"{self._process.exitcode}, {pending} pending validations "
+                "are lost."
+            ))
+
+    def _stop_worker(self):
+        while self._process.is_alive():
+            try:
+                self._requests.put(None, timeout=POLL_INTERVAL)
+                break
+            except queue.Full:
+                continue
+        self._process.join()
+        self._process = None
+
+    def _run(self):
+        try:
+            self._setup()
+        except Exception:
+            # reported for the first validation
+            error = traceback.format_exc()
+            while True:
+                item = self._requests.get()
+                if item is None:
+                    return
+                self._results.put(error)
+
+        try:
+            while True:
+                item = self._requests.get()
+                if item is None:
+                    return
+                state, iteration = item
+                self.model.load_state_dict(state)
+                try:
+                    self._results.put(self._validate(iteration))
+                except Exception:
+                    self._results.put(traceback.format_exc())
+        finally:
+            self._teardown()
+
+    def _setup(self):
+        self._val_requests = []
+        for validation in self.validations:
+            validation.pipeline.setup()
+
+            # the scan writes nothing back, unless the whole validation ROI
+            # is assembled for the snapshot
+            request = gp.BatchRequest()
+            if validation.snapshot is not None:
+                for key, spec in validation.scan.spec.items():
+                    if key in validation.request:
+                        request_spec = spec.copy()
+                        request_spec.dtype = None
+                        request[key] = request_spec
+            self._val_requests.append(request)
+
+    def _teardown(self):
+        for validation in self.validations:
+            validation.pipeline.internal_teardown()
+
+    def _validate(self, iteration):
+        training = self.model.training
+        self.model.eval()
+
+        results = []
+        for idx, (validation, request) in enumerate(
+                zip(self.validations, self._val_requests)):
+            validation.validation_loss.iteration = iteration
+            validation.confusion_counts.reset()
+            batch = validation.pipeline.request_batch(request)
+
+            for l_i, l in enumerate(np.atleast_1d(batch.loss)):
+                results.append(
+                    (f"loss_val_ds_{idx}_type_{l_i}", float(l), iteration))
+
+            if self.metrics_fn is not None:
+                metrics = self.metrics_fn(
+                    validation, iteration, f"validation_ds_{idx}")
+                for name, value in metrics.items():
+                    results.append((name, float(value), iteration))
+
+        self.model.train(training)
+        return results
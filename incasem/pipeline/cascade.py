@@ -0,0 +1,185 @@
+import logging
+
+import numpy as np
+import scipy.ndimage
+
+import gunpowder as gp
+import incasem as fos
+
+logger = logging.getLogger(__name__)
+
+
+def predict_cascade_indices(
+        data_config,
+        data_path_prefix,
+        voxel_size,
+        torchscript,
+        factor=(4, 4, 4),
+        threshold=0.05,
+        margin_voxels=(32, 32, 32),
+        device='cuda',
+        gpus=None,
+        num_workers=1):
+    """First pass of a coarse-to-fine cascade: predict each dataset of a data
+    config at low resolution with a cheap model, and index the candidate
+    voxels for ``PredictionBaseline(cascade_indices=...)``.
+
+    The cheap model, exported with
+    ``scripts/03_predict/export_torchscript.py`` for a batch size of 1,
+    predicts on the raw downsampled by ``factor`` with
+    ``fos.gunpowder.Downsample``. Voxels with a foreground probability of at
+    least ``threshold``, grown by ``margin_voxels`` (in full resolution
+    voxels), are candidates.
+
+    Args:
+
+        data_config (``string``):
+
+            Path of the data config.
+
+        data_path_prefix (``string``):
+
+            Prefix of the dataset paths in the data config.
+
+        voxel_size (``tuple`` of ``int``):
+
+            Full resolution voxel size.
+
+        torchscript (``string``):
+
+            Path of the exported cheap model.
+
+        factor, threshold, margin_voxels:
+
+            See above.
+
+        device (``string``, optional):
+
+            ``'cuda'`` or ``'cpu'``.
+
+        gpus (``list`` of ``int``, optional):
+
+            GPUs to use with ``'cuda'``.
+
+        num_workers (``int``, optional):
+
+            Number of ``gp.Scan`` workers.
+
+    Returns:
+
+        ``list`` with a ``fos.utils.MaskIndex`` per dataset, or ``None`` for
+        datasets that are too small for the cheap model.
+    """
+
+    keys = {
+        'RAW': gp.ArrayKey('RAW'),
+        'LABELS': gp.ArrayKey('LABELS'),
+        'MASK': gp.ArrayKey('MASK'),
+        'METRIC_MASK': gp.ArrayKey('METRIC_MASK'),
+        'RAW_LOW': gp.ArrayKey('RAW_LOW'),
+        'CANDIDATES': gp.ArrayKey('CANDIDATES'),
+    }
+
+    metadata = fos.torch.torchscript.read_metadata(torchscript)
+    batch_size = metadata['input_shape'][0]
+    if batch_size != 1:
+        raise ValueError((
+            f"Cascade model {torchscript} has to be exported for a batch "
+            f"size of 1, not {batch_size}."
+        ))
+
+    factor = gp.Coordinate(factor)
+    full_voxel_size = gp.Coordinate(voxel_size)
+    voxel_size = full_voxel_size * factor
+    input_size = voxel_size * gp.Coordinate(metadata['input_shape'][2:])
+    output_size = voxel_size * gp.Coordinate(metadata['output_shape'][2:])
+    context = (input_size - output_size) / 2
+
+    # margin in low resolution voxels, rounded up
+    margin = -((-full_voxel_size * gp.Coordinate(margin_voxels))
+               // voxel_size)
+
+    sources = fos.pipeline.sources.DataSourcesSemantic(
+        config_file=data_config,
+        keys=keys,
+        data_path_prefix=data_path_prefix
+    )
+
+    indices = []
+    for name, dataset_roi, pipeline in zip(
+            sources.names, sources.rois, sources.pipelines):
+        roi = dataset_roi.snap_to_grid(voxel_size, mode='shrink')
+        gate_roi = roi.grow(-context, -context)
+        if any(s < o for s, o in zip(gate_roi.get_shape(), output_size)):
+            logger.warning((
+                f"ROI {dataset_roi} is too small for the cascade model, "
+                "predicting all of its blocks."
+            ))
+            indices.append(None)
+            continue
+
+        pipeline = (
+            pipeline
+            + gp.Crop(keys['RAW'], roi)
+            + gp.IntensityScaleShift(keys['RAW'], 2, -1)
+            + fos.gunpowder.Downsample(
+                keys['RAW'],
+                factor,
+                keys['RAW_LOW']
+            )
+            + fos.gunpowder.Unsqueeze([keys['RAW_LOW']])
+            + fos.gunpowder.Unsqueeze([keys['RAW_LOW']])
+            + fos.gunpowder.torch.Predict(
+                model=None,
+                inputs={'x': keys['RAW_LOW']},
+                outputs={0: keys['CANDIDATES']},
+                array_specs={
+                    keys['CANDIDATES']: gp.ArraySpec(
+                        roi=gate_roi,
+                        dtype=np.float32,
+                        voxel_size=voxel_size
+                    )
+                },
+                gpus=[0] if gpus is None else list(gpus),
+                spawn_subprocess=True,
+                device=device,
+                torchscript=torchscript,
+                softmax=True,
+            )
+            + fos.gunpowder.Squeeze([keys['CANDIDATES']])
+        )
+
+        reference = gp.BatchRequest()
+        reference.add(keys['RAW_LOW'], input_size)
+        reference.add(keys['CANDIDATES'], output_size)
+        pipeline = (
+            pipeline
+            + gp.Scan(reference, num_workers=num_workers)
+        )
+
+        request = gp.BatchRequest()
+        request[keys['CANDIDATES']] = gp.ArraySpec(roi=gate_roi)
+        with gp.build(pipeline):
+            probabilities = pipeline.request_batch(
+                request)[keys['CANDIDATES']].data
+
+        candidates = probabilities[1:].max(axis=0) >= threshold
+        fraction = np.count_nonzero(candidates) / candidates.size
+
+        candidates = scipy.ndimage.maximum_filter(
+            candidates.astype(np.uint8),
+            size=tuple(2 * m + 1 for m in margin)
+        )
+        logger.info((
+            f"Cascade candidates in {name}: {fraction:.1%}, "
+            f"{np.count_nonzero(candidates) / candidates.size:.1%} with margin"
+        ))
+
+        indices.append(fos.utils.MaskIndex.build(
+            candidates,
+            offset=gate_roi.get_offset(),
+            voxel_size=voxel_size,
+            cell_shape=(1,) * candidates.ndim
+        ))
+
+    return indices
@@ -0,0 +1,128 @@
+import logging
+from time import time as now
+
+import numpy as np
+import torch
+import gunpowder as gp
+
+import incasem as fos
+from incasem.gunpowder.scan import (
+    get_shift_roi,
+    get_stride,
+    scan_shifts,
+    shift_request,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def load_blocks(
+        data_config,
+        data_path_prefix,
+        voxel_size,
+        input_size_voxels,
+        output_size_voxels,
+        max_blocks=None):
+    """Read and preprocess all blocks of all datasets in the data config,
+    or at most ``max_blocks`` evenly spaced blocks per dataset.
+
+    The blocks tile each dataset like the ``gp.Scan`` of
+    :class:`PredictionBaseline` does, so that metrics are computed over the
+    same voxels as in prediction.
+
+    Returns:
+
+        ``list`` of ``dict`` per dataset, with the dataset ``name`` and
+        ``file``, the output ROIs of the blocks, and per block the
+        preprocessed ``raw`` tensor with batch and channel dimension, and
+        the ``labels`` and the combined ``mask`` of the output block as
+        numpy arrays.
+    """
+
+    keys = {
+        'RAW': gp.ArrayKey('RAW'),
+        'LABELS': gp.ArrayKey('LABELS'),
+        'MASK': gp.ArrayKey('MASK'),
+        'METRIC_MASK': gp.ArrayKey('METRIC_MASK'),
+        'PREDICTIONS': gp.ArrayKey('PREDICTIONS'),
+    }
+    voxel_size = gp.Coordinate(voxel_size)
+    input_size = voxel_size * gp.Coordinate(input_size_voxels)
+    output_size = voxel_size * gp.Coordinate(output_size_voxels)
+
+    sources = fos.pipeline.sources.DataSourcesSemantic(
+        config_file=data_config,
+        keys=keys,
+        data_path_prefix=data_path_prefix
+    )
+
+    # same block request as in fos.pipeline.PredictionBaseline
+    reference = gp.BatchRequest()
+    reference.add(keys['RAW'], input_size)
+    for key in ['LABELS', 'MASK', 'METRIC_MASK', 'PREDICTIONS']:
+        reference.add(keys[key], output_size)
+
+    datasets = []
+    for name, filename, roi, pipeline in zip(
+            sources.names,
+            sources.filenames,
+            sources.rois,
+            sources.pipelines):
+        # same preprocessing as in fos.pipeline.PredictionBaseline
+        pipeline = (
+            pipeline
+            + gp.IntensityScaleShift(keys['RAW'], 2, -1)
+        )
+
+        dataset = {
+            'name': name,
+            'file': filename,
+            'rois': [],
+            'raw': [],
+            'labels': [],
+            'mask': [],
+        }
+
+        start = now()
+        with gp.build(pipeline):
+            # the predictions are provided by the Predict node there
+            spec = pipeline.spec.copy()
+            spec[keys['PREDICTIONS']] = gp.ArraySpec(
+                roi=fos.utils.grow_roi_to(
+                    roi=roi,
+                    target_shape=output_size,
+                    voxel_size=voxel_size
+                )
+            )
+            shifts = scan_shifts(
+                reference,
+                get_shift_roi(reference, spec),
+                get_stride(reference)
+            )
+            if max_blocks is not None and len(shifts) > max_blocks:
+                shifts = [
+                    shifts[i] for i in np.linspace(
+                        0, len(shifts) - 1, max_blocks).round().astype(int)
+                ]
+
+            for shift in shifts:
+                request = shift_request(reference, shift)
+                dataset['rois'].append(request[keys['PREDICTIONS']].roi)
+                del request[keys['PREDICTIONS']]
+                batch = pipeline.request_batch(request)
+
+                raw = batch[keys['RAW']].data.astype(np.float32)
+                dataset['raw'].append(torch.from_numpy(raw)[None, None])
+                dataset['labels'].append(batch[keys['LABELS']].data)
+                dataset['mask'].append(np.logical_and(
+                    batch[keys['MASK']].data.astype(bool),
+                    batch[keys['METRIC_MASK']].data.astype(bool)
+                ))
+
+        logger.info((
+            f"Cached {len(shifts)} blocks of {name} "
+            f"in {now() - start:.1f} s"
+        ))
+        datasets.append(dataset)
+
+    return datasets
@@ -2,6 +2,7 @@ import logging
 import os
 
 import numpy as np
+import zarr
 
 import gunpowder as gp
 import incasem as fos
@@ -11,6 +12,72 @@ logger = logging.getLogger(__name__)
 
 class PredictionBaseline:
     """Prediction pipeline with U-Net for semantic segmentation.
+
+    If the data config contains several datasets, they are predicted in a
+    single pass: the datasets are moved next to each other with
+    ``fos.gunpowder.Translate``, so that one ``Predict`` node (and hence one
+    loaded model) and one ``fos.gunpowder.Scan`` serve the blocks of all of
+    them, balanced over the same ``num_workers``. Each dataset is written to
+    its own output container at its original position, see
+    ``output_filenames``.
+
+    If ``micro_batch`` is given (number of blocks per dimension, zyx), each
+    ``gp.Scan`` request covers a super-block of that many blocks, which the
+    ``Predict`` node stacks into a single forward pass.
+
+    ``cpu_backend`` is an optional dictionary that configures prediction on
+    CPU, with the keys ``inference_mode``, ``channels_last``,
+    ``autocast_dtype``, ``num_threads``, ``num_interop_threads`` (see
+    ``fos.gunpowder.torch.Predict``) and ``pin_workers``. If ``pin_workers``
+    is set, the model process is pinned to the first ``num_threads`` cores,
+    and the remaining cores are split among the ``num_workers`` Scan workers.
+
+    If ``pipelined`` is set, reading, inference and writing of consecutive
+    blocks overlap instead of running ``num_workers`` full pipelines: a single
+    Scan worker drives the model, ``read_workers`` processes read and
+    preprocess up to ``read_ahead`` blocks in advance, in the order that the
+    scan hands to ``fos.gunpowder.Prefetch``, and ``write_workers`` threads
+    write the results in the background, with at most ``write_queue_size``
+    blocks waiting.
+
+    ``output_format`` selects how probabilities are stored: ``'float32'``
+    writes one dataset per class to ``prob_maps/class_<i>`` and a uint32
+    segmentation, ``'uint8'`` (probabilities scaled to [0, 255]) and
+    ``'float16'`` write a single channel-first dataset ``probabilities`` and a
+    uint8 segmentation.
+
+    ``tta_mirror`` and ``tta_transpose`` enable test-time augmentation inside
+    the ``Predict`` node, see ``fos.gunpowder.torch.Predict``.
+
+    If ``skip_masked`` is set, blocks without any foreground in the mask of
+    the dataset are not read and predicted, but get background predictions.
+    Blocks are checked with a coarse ``fos.utils.MaskIndex`` of the mask,
+    read from ``<mask>_index`` next to it as written by
+    ``scripts/01_data_formatting/20_create_mask.py``. Otherwise, it is built
+    with cells of ``mask_index_cell_shape`` voxels and cached in the output
+    container of the dataset, the input data is never modified.
+
+    ``torchscript`` is the path to a model exported with
+    ``scripts/03_predict/export_torchscript.py``, which replaces ``model`` and
+    ``checkpoint``.
+
+    With ``device_postprocess``, the softmax, the conversion to
+    ``output_format`` and the masked argmax segmentation are computed by
+    ``Predict`` on the device, and only the final arrays are copied to the
+    host.
+
+    ``cascade_indices`` enables a coarse-to-fine cascade: one
+    ``fos.utils.MaskIndex`` of candidate voxels per dataset, or ``None`` to
+    predict all of its blocks, computed beforehand with
+    ``fos.pipeline.predict_cascade_indices``. The full resolution model only
+    predicts blocks that touch a candidate, all other blocks are skipped like
+    masked blocks. It cannot be combined with ``count_confusions``, since
+    the labels of skipped blocks are not read.
+
+    If ``count_confusions`` is set, the confusion counts of all predicted
+    blocks are accumulated by ``fos.gunpowder.ConfusionCounts`` in
+    ``confusion_counts``, within the mask and the metric mask, so that
+    metrics over the whole ROI do not require to request it at once.
     """
 
     def __init__(
@@ -25,6 +92,25 @@ class PredictionBaseline:
             input_size_voxels,
             output_size_voxels,
             checkpoint,
+            micro_batch=None,
+            num_workers=1,
+            device='cuda',
+            cpu_backend=None,
+            pipelined=False,
+            read_workers=2,
+            read_ahead=4,
+            write_workers=1,
+            write_queue_size=4,
+            output_format='float32',
+            tta_mirror=False,
+            tta_transpose=False,
+            skip_masked=False,
+            mask_index_cell_shape=(16, 16, 16),
+            torchscript=None,
+            device_postprocess=False,
+            cascade_indices=None,
+            gpus=None,
+            count_confusions=False,
     ):
         self._data_config = data_config[0]
         self._data_config_name = data_config[1]
@@ -36,11 +122,63 @@ class PredictionBaseline:
         self._num_classes = num_classes
 
         self._voxel_size = gp.Coordinate(voxel_size)
+        self._block_input_shape = gp.Coordinate(input_size_voxels)
+        self._block_output_shape = gp.Coordinate(output_size_voxels)
+
+        if micro_batch is not None:
+            micro_batch = gp.Coordinate(micro_batch)
+            if micro_batch == gp.Coordinate((1,) * len(micro_batch)):
+                micro_batch = None
+        self._micro_batch = micro_batch
+
+        # with micro-batching, a single request spans a super-block
+        if self._micro_batch is not None:
+            input_size_voxels = self._block_input_shape + \
+                gp.Coordinate(n - 1 for n in self._micro_batch) * \
+                self._block_output_shape
+            output_size_voxels = self._micro_batch * self._block_output_shape
+
         self._input_size = self._voxel_size * gp.Coordinate(input_size_voxels)
         self._output_size = self._voxel_size * \
             gp.Coordinate(output_size_voxels)
+        self._block_output_size = self._voxel_size * self._block_output_shape
 
         self._checkpoint = checkpoint
+        self._torchscript = torchscript
+        self._num_workers = num_workers
+        self._device = device
+        self._cpu_backend = {} if cpu_backend is None else dict(cpu_backend)
+
+        self._pipelined = pipelined
+        self._read_workers = read_workers
+        self._read_ahead = read_ahead
+        self._write_workers = write_workers
+        self._write_queue_size = write_queue_size
+        if self._pipelined and self._num_workers > 1:
+            logger.warning((
+                f"Ignoring num_workers={self._num_workers} in pipelined mode, "
+                "use read_workers and write_workers instead."
+            ))
+            self._num_workers = 1
+
+        if output_format not in ('float32', 'float16', 'uint8'):
+            raise ValueError(f"Unknown output format {output_format}.")
+        self._output_format = output_format
+
+        self._tta_mirror = tta_mirror
+        self._tta_transpose = tta_transpose
+
+        self._skip_masked = skip_masked
+        self._mask_index_cell_shape = mask_index_cell_shape
+
+        self._device_postprocess = device_postprocess
+
+        self._cascade_indices = cascade_indices
+
+        self._gpus = [0] if gpus is None else list(gpus)
+
+        self._count_confusions = count_confusions
+
         self._assemble_pipeline()
 
     def _assemble_pipeline(self):
@@ -61,6 +199,14 @@ class PredictionBaseline:
         self.request.add(keys['METRIC_MASK'], self._output_size)
         self.request.add(keys['PREDICTIONS'], self._output_size)
 
+        if self._output_format == 'float32':
+            segmentation_dtype = np.uint32
+        else:
+            segmentation_dtype = np.uint8
+        if self._device_postprocess:
+            keys['SEGMENTATION'] = gp.ArrayKey('SEGMENTATION')
+            self.request.add(keys['SEGMENTATION'], self._output_size)
+
         sources = fos.pipeline.sources.DataSourcesSemantic(
             config_file=self._data_config,
             keys=keys,
@@ -73,21 +219,85 @@ class PredictionBaseline:
                 f"the voxel size of the datasets {sources.voxel_size}."
             ))
 
-        if sources.dataset_count > 1:
-            raise NotImplementedError((
-                f"Prediction is only implemented for a single cuboid ROI "
-                f"at a time. "
-                f"You provided {sources.dataset_count} in the data config "
-                "file, please remove all but one."
+        # regions covered by the scan over output blocks, one per dataset
+        if len(sources.rois) != sources.dataset_count:
+            raise ValueError(
+                "Prediction requires an offset and shape for each dataset "
+                "in the data config.")
+        self.rois = [roi.copy() for roi in sources.rois]
+        self.roi = self.rois[0] if sources.dataset_count == 1 else None
+
+        if self._cascade_indices is not None and \
+                len(self._cascade_indices) != sources.dataset_count:
+            raise ValueError((
+                f"Got {len(self._cascade_indices)} cascade indices for "
+                f"{sources.dataset_count} datasets."
             ))
-        self.pipeline = sources.pipelines[0]
+        if self._cascade_indices is not None and self._count_confusions:
+            # skipped candidate-free blocks can contain foreground labels,
+            # which would be missing from the counts
+            raise ValueError(
+                "Confusion counts are not supported with a cascade.")
 
-        # self.pipeline = (
-        #     self.pipeline
-        #     + fos.gunpowder.PadTo(keys['RAW'], self._input_size)
-        #     + fos.gunpowder.PadTo(keys['LABELS'], self._output_size)
-        #     + fos.gunpowder.PadTo(keys['MASK'], self._output_size)
-        # )
+        # optionally grow the predictions roi to account for padded raw
+        # labels
+        predictions_rois = [
+            fos.utils.grow_roi_to(
+                roi=roi,
+                target_shape=self._output_size,
+                voxel_size=self._voxel_size
+            )
+            for roi in self.rois
+        ]
+        logger.debug(f"{predictions_rois=}")
+
+        if sources.dataset_count == 1:
+            self._shifts = [gp.Coordinate((0,) * len(self._voxel_size))]
+            self.pipeline = sources.pipelines[0]
+        else:
+            # lay out the datasets next to each other, so that a single
+            # model and scan serve all of them
+            self._shifts = self._layout(self.rois, predictions_rois)
+            self.pipeline = tuple(
+                pipeline + fos.gunpowder.Translate(shift)
+                for pipeline, shift in zip(sources.pipelines, self._shifts)
+            ) + fos.gunpowder.RouteByRoi(keys['RAW'])
+            logger.info(
+                f"Predicting {sources.dataset_count} ROIs in a single pass")
+
+        # background with probability 1
+        background = [1] + [0] * (self._num_classes - 1)
+        if self._device_postprocess and self._output_format == 'uint8':
+            background = [255 * p for p in background]
+
+        skip_masked_blocks = []
+        for i, shift in enumerate(self._shifts):
+            mask_indices = []
+            if self._skip_masked:
+                mask_indices.append(self._get_mask_index(sources, i))
+            if self._cascade_indices is not None:
+                mask_indices.append(self._cascade_indices[i])
+
+            for mask_index in mask_indices:
+                if mask_index is None:
+                    continue
+                skip_masked_blocks.append(fos.gunpowder.SkipMaskedBlocks(
+                    mask_index=fos.utils.MaskIndex(
+                        mask_index.table,
+                        mask_index.offset + shift,
+                        mask_index.cell_size
+                    ),
+                    reference_array=keys['PREDICTIONS'],
+                    fill_values={keys['PREDICTIONS']: background},
+                    roi=predictions_rois[i].shift(shift)
+                ))
+
+        # self.pipeline = (
+        #     self.pipeline
+        #     + fos.gunpowder.PadTo(keys['RAW'], self._input_size)
+        #     + fos.gunpowder.PadTo(keys['LABELS'], self._output_size)
+        #     + fos.gunpowder.PadTo(keys['MASK'], self._output_size)
+        # )
 
         # Prepare data format for model
         self.pipeline = (
@@ -105,16 +315,75 @@ class PredictionBaseline:
             ])
         )
 
-        predictions_roi = sources.rois[0].copy()
-        # optionally grow the predictions roi to account for padded raw
+        # in the coordinates of the (translated) pipeline
+        rois = [
+            roi.shift(shift) for roi, shift in zip(self.rois, self._shifts)]
+        predictions_rois = [
+            roi.shift(shift)
+            for roi, shift in zip(predictions_rois, self._shifts)
+        ]
+        predictions_roi = predictions_rois[0]
+        for roi in predictions_rois[1:]:
+            predictions_roi = predictions_roi.union(roi)
 
-        # labels
-        predictions_roi = fos.utils.grow_roi_to(
-            roi=predictions_roi,
-            target_shape=self._output_size,
-            voxel_size=self._voxel_size
-        )
-        logger.debug(f"{predictions_roi=}")
+        if sources.dataset_count == 1:
+            regions = None
+        else:
+            regions = [
+                {
+                    keys[key]: roi
+                    for key in ['RAW', 'LABELS', 'MASK', 'METRIC_MASK']
+                }
+                for roi in rois
+            ]
+            for region, roi in zip(regions, predictions_rois):
+                region[keys['PREDICTIONS']] = roi
+
+        if self._pipelined:
+            prefetch_request = gp.BatchRequest()
+            for key in ['RAW', 'LABELS', 'MASK', 'METRIC_MASK']:
+                prefetch_request[keys[key]] = self.request[keys[key]].copy()
+            # scheduled by the scan
+            self.prefetch = fos.gunpowder.Prefetch(
+                prefetch_request,
+                num_workers=self._read_workers,
+                cache_size=self._read_ahead,
+                exclude=None if not skip_masked_blocks else (
+                    lambda request: any(
+                        node.skips(request[keys['LABELS']].roi)
+                        for node in skip_masked_blocks
+                    )
+                ),
+            )
+            self.pipeline = (
+                self.pipeline
+                + self.prefetch
+            )
+        else:
+            self.prefetch = None
+
+        predict_cores, worker_cores = self._partition_cores()
+
+        array_specs = {
+            keys['PREDICTIONS']: gp.ArraySpec(
+                roi=predictions_roi,
+                dtype=np.float32,
+                voxel_size=self._voxel_size
+            )
+        }
+        postprocess = {}
+        if self._device_postprocess:
+            array_specs[keys['SEGMENTATION']] = gp.ArraySpec(
+                roi=predictions_roi,
+                dtype=segmentation_dtype,
+                voxel_size=self._voxel_size
+            )
+            postprocess = {
+                'softmax': True,
+                'output_dtype': self._output_format,
+                'segmentations': {keys['PREDICTIONS']: keys['SEGMENTATION']},
+                'segmentation_mask': keys['MASK'],
+            }
 
         self.predict = fos.gunpowder.torch.Predict(
             model=self._model,
@@ -122,15 +391,24 @@ class PredictionBaseline:
                 'x': keys['RAW'],
             },
             outputs={0: keys['PREDICTIONS']},
-            array_specs={
-                keys['PREDICTIONS']: gp.ArraySpec(
-                    roi=predictions_roi,
-                    dtype=np.float32,
-                    voxel_size=self._voxel_size
-                )
-            },
+            array_specs=array_specs,
             checkpoint=self._checkpoint,
-            spawn_subprocess=True
+            gpus=self._gpus,
+            spawn_subprocess=True,
+            micro_batch=self._micro_batch,
+            block_input_shape=self._block_input_shape,
+            block_output_shape=self._block_output_shape,
+            device=self._device,
+            inference_mode=self._cpu_backend.get('inference_mode', False),
+            channels_last=self._cpu_backend.get('channels_last', False),
+            autocast_dtype=self._cpu_backend.get('autocast_dtype'),
+            num_threads=self._cpu_backend.get('num_threads'),
+            num_interop_threads=self._cpu_backend.get('num_interop_threads'),
+            cpu_affinity=predict_cores,
+            tta_mirror=self._tta_mirror,
+            tta_transpose=self._tta_transpose,
+            torchscript=self._torchscript,
+            **postprocess
         )
 
         self.pipeline = (
@@ -145,7 +423,7 @@ class PredictionBaseline:
                 keys['LABELS'],
                 keys['MASK'],
                 keys['PREDICTIONS'],
-            ])
+            ] + ([keys['SEGMENTATION']] if self._device_postprocess else []))
             + fos.gunpowder.Squeeze([keys['RAW']])
         )
 
@@ -156,60 +434,245 @@ class PredictionBaseline:
             + fos.gunpowder.ToDtype([keys['LABELS']], dtype='uint32')
         )
 
-        self.pipeline = (
-            self.pipeline
-            + fos.gunpowder.Softmax(keys['PREDICTIONS'])
-        )
+        if not self._device_postprocess:
+            self.pipeline = (
+                self.pipeline
+                + fos.gunpowder.Softmax(keys['PREDICTIONS'])
+            )
 
-        write_datasets = {}
+        for node in skip_masked_blocks:
+            self.pipeline = (
+                self.pipeline
+                + node
+            )
 
-        for cls in range(self._num_classes):
-            pred_class_key = f"PREDICTIONS_CLASS_{cls}"
-            keys[pred_class_key] = gp.ArrayKey(
-                pred_class_key
+        self.confusion_counts = None
+        if self._count_confusions:
+            self.confusion_counts = fos.gunpowder.ConfusionCounts(
+                labels=keys['LABELS'],
+                predictions=keys['PREDICTIONS'],
+                num_classes=self._num_classes,
+                masks=[keys['MASK'], keys['METRIC_MASK']]
+            )
+            self.pipeline = (
+                self.pipeline
+                + self.confusion_counts
             )
-            self.request.add(keys[pred_class_key], self._output_size)
+
+        write_datasets = {}
+
+        if self._output_format == 'float32':
+            for cls in range(self._num_classes):
+                pred_class_key = f"PREDICTIONS_CLASS_{cls}"
+                keys[pred_class_key] = gp.ArrayKey(
+                    pred_class_key
+                )
+                self.request.add(keys[pred_class_key], self._output_size)
+                self.pipeline = (
+                    self.pipeline
+                    + fos.gunpowder.PickChannel(
+                        array=keys['PREDICTIONS'],
+                        channel=cls,
+                        output_array=keys[pred_class_key]
+                    )
+                )
+                write_datasets[keys[pred_class_key]] = \
+                    f"volumes/predictions/{self._run_id}/prob_maps/class_{cls}"
+        elif self._device_postprocess:
+            # already converted by Predict
+            write_datasets[keys['PREDICTIONS']] = \
+                f"volumes/predictions/{self._run_id}/probabilities"
+        else:
+            keys['PROBABILITIES'] = gp.ArrayKey('PROBABILITIES')
+            self.request.add(keys['PROBABILITIES'], self._output_size)
+            if self._output_format == 'uint8':
+                self.pipeline = (
+                    self.pipeline
+                    + fos.gunpowder.FloatToUint8(
+                        keys['PREDICTIONS'],
+                        output_array=keys['PROBABILITIES']
+                    )
+                )
+            else:
+                self.pipeline = (
+                    self.pipeline
+                    + fos.gunpowder.ToDtype(
+                        [keys['PREDICTIONS']],
+                        dtype='float16',
+                        output_arrays=[keys['PROBABILITIES']]
+                    )
+                )
+            write_datasets[keys['PROBABILITIES']] = \
+                f"volumes/predictions/{self._run_id}/probabilities"
+
+        if not self._device_postprocess:
+            keys['SEGMENTATION'] = gp.ArrayKey('SEGMENTATION')
+            self.request.add(keys['SEGMENTATION'], self._output_size)
             self.pipeline = (
                 self.pipeline
-                + fos.gunpowder.PickChannel(
+                + fos.gunpowder.BinarizeLabels([keys['MASK']])
+                + fos.gunpowder.ExtractSegmentation(
                     array=keys['PREDICTIONS'],
-                    channel=cls,
-                    output_array=keys[pred_class_key]
+                    output_array=keys['SEGMENTATION'],
+                    mask=keys['MASK'],
+                    dtype=segmentation_dtype
                 )
             )
-            write_datasets[keys[pred_class_key]] = \
-                f"volumes/predictions/{self._run_id}/prob_maps/class_{cls}"
-
-        keys['SEGMENTATION'] = gp.ArrayKey('SEGMENTATION')
-        self.request.add(keys['SEGMENTATION'], self._output_size)
         write_datasets[keys['SEGMENTATION']
                        ] = f"volumes/predictions/{self._run_id}/segmentation"
 
-        self.pipeline = (
-            self.pipeline
-            + fos.gunpowder.BinarizeLabels([keys['MASK']])
-            + fos.gunpowder.ExtractSegmentation(
-                array=keys['PREDICTIONS'],
-                output_array=keys['SEGMENTATION'],
-                mask=keys['MASK']
+        # one output container per dataset, written at its original position
+        self.output_filenames = self._output_filenames(sources)
+        for filename, roi, shift in zip(
+                self.output_filenames, predictions_rois, self._shifts):
+            self.pipeline = (
+                self.pipeline
+                + fos.gunpowder.ZarrWrite(
+                    dataset_names=write_datasets,
+                    output_filename=filename,
+                    chunks=self._block_output_size / self._voxel_size / 2,
+                    num_writers=self._write_workers if self._pipelined else 0,
+                    queue_size=self._write_queue_size,
+                    roi=None if regions is None else roi,
+                    shift=None if regions is None else -shift,
+                )
             )
-        )
 
-        self.pipeline = (
-            self.pipeline
-            + fos.gunpowder.ZarrWrite(
-                dataset_names=write_datasets,
-                # TODO change hacky access to filename
-                output_filename=os.path.join(
-                    os.path.expanduser(self._predictions_path_prefix),
-                    sources.filenames[0]
-                ),
-                chunks=self._output_size / self._voxel_size / 2,
+        if worker_cores:
+            self.pipeline = (
+                self.pipeline
+                + fos.gunpowder.CpuAffinity(
+                    cores=worker_cores,
+                    cores_per_process=len(worker_cores) // self._num_workers
+                )
             )
-        )
 
-        self.scan = gp.Scan(self.request)
+        self.scan = fos.gunpowder.Scan(
+            self.request,
+            num_workers=self._num_workers,
+            regions=regions,
+            prefetch=self.prefetch
+        )
         self.pipeline = (
             self.pipeline
             + self.scan
         )
+
+    def _layout(self, rois, predictions_rois):
+        """Shifts that place the datasets one after another along the first
+        dimension, starting at the origin, with a gap of one output block
+        between their predictions."""
+
+        gap = self._output_size[0]
+        dims = len(self._voxel_size)
+
+        shifts = []
+        begin = 0
+        for roi, predictions_roi in zip(rois, predictions_rois):
+            # the predictions roi may extend beyond the dataset roi
+            margin = roi.get_begin()[0] - predictions_roi.get_begin()[0]
+            begin += margin
+            shift = gp.Coordinate((begin,) + (0,) * (dims - 1)) - \
+                roi.get_begin()
+            shifts.append(shift)
+            begin = predictions_roi.get_end()[0] + shift[0] + gap
+
+        return shifts
+
+    def _output_filenames(self, sources):
+        """Output container of each dataset, at the same relative path as its
+        input container. Datasets that share an input container get their own
+        output container, suffixed with their name."""
+
+        filenames = []
+        for name, filename in zip(sources.names, sources.filenames):
+            if sources.filenames.count(filename) > 1:
+                root, ext = os.path.splitext(filename.rstrip('/'))
+                filename = f"{root}_{name}{ext}"
+            filenames.append(os.path.join(
+                os.path.expanduser(self._predictions_path_prefix),
+                filename
+            ))
+
+        return filenames
+
+    def _get_mask_index(self, sources, index=0):
+        """Load the coarse index of the mask of dataset ``index``, or build
+        it and cache it in the output container of the dataset."""
+
+        attributes = sources.attributes[index]
+        if 'mask' not in attributes:
+            logger.warning(
+                "No mask given, not skipping any blocks during prediction.")
+            return None
+
+        filename = os.path.expanduser(
+            os.path.join(self._data_path_prefix, attributes['file']))
+        mask_ds = attributes['mask'].rstrip('/')
+        index_ds = f"{mask_ds}_index"
+
+        try:
+            return fos.utils.MaskIndex.load(filename, index_ds)
+        except KeyError:
+            pass
+
+        mask = zarr.open(filename, mode='r')[mask_ds]
+        voxel_size = gp.Coordinate(mask.attrs['resolution'])
+        cell_size = voxel_size * gp.Coordinate(self._mask_index_cell_shape)
+
+        cache_filename = self._output_filenames(sources)[index]
+        if os.path.exists(cache_filename):
+            try:
+                mask_index = fos.utils.MaskIndex.load(
+                    cache_filename, index_ds)
+                if mask_index.cell_size == cell_size:
+                    return mask_index
+            except KeyError:
+                pass
+
+        logger.info(
+            f"Building mask index of {mask_ds} in {filename}, "
+            f"caching it in {cache_filename}")
+        mask_index = fos.utils.MaskIndex.build(
+            mask,
+            offset=mask.attrs.get('offset', (0,) * mask.ndim),
+            voxel_size=voxel_size,
+            cell_shape=self._mask_index_cell_shape
+        )
+        mask_index.save(cache_filename, index_ds)
+
+        return mask_index
+
+    def _partition_cores(self):
+        """Split the available cores between the model process and the Scan
+        workers, if requested in the CPU backend settings."""
+
+        if not self._cpu_backend.get('pin_workers', False):
+            return None, None
+        if not hasattr(os, 'sched_getaffinity'):
+            logger.warning("CPU affinity is not supported on this platform.")
+            return None, None
+
+        cores = sorted(os.sched_getaffinity(0))
+        num_threads = self._cpu_backend.get('num_threads')
+        if num_threads is None:
+            raise ValueError(
+                "Pinning workers to cores requires num_threads for the model.")
+        if num_threads >= len(cores):
+            raise ValueError((
+                f"Cannot reserve {num_threads} cores for the model, only "
+                f"{len(cores)} cores are available."
+            ))
+
+        predict_cores = cores[:num_threads]
+        worker_cores = cores[num_threads:]
+        if self._num_workers <= 1:
+            worker_cores = None
+        elif len(worker_cores) < self._num_workers:
+            logger.warning((
+                f"Only {len(worker_cores)} cores left for "
+                f"{self._num_workers} Scan workers, some workers share cores."
+            ))
+        logger.info(f"Model cores {predict_cores}, worker cores {worker_cores}")
+
+        return predict_cores, worker_cores
@@ -20,6 +20,7 @@ class DataSourcesBase(ABC):
         self._dataset_count = 0
         self._names = []
         self._filenames = []
+        self._attributes = []
         self._rois = []
         self._voxel_size = None
 
@@ -51,6 +52,7 @@ class DataSourcesBase(ABC):
             self._dataset_count += 1
             self._names.append(name)
             self._filenames.append(attributes['file'])
+            self._attributes.append(attributes)
 
         logger.debug(f'{len(pipelines)=}')
         return pipelines
@@ -136,6 +138,10 @@ class DataSourcesBase(ABC):
     def filenames(self):
         return self._filenames
 
+    @property
+    def attributes(self):
+        return self._attributes
+
     @property
     def rois(self):
         return self._rois
@@ -13,6 +13,23 @@ class TrainingBaselineWithContext:
     """Training pipeline with U-Net for semantic segmentation.
 
     Dataset has to fit in memory.
+
+    With ``batch_size`` > 1, ``fos.gunpowder.StackSamples`` collects that
+    many independently sampled and augmented samples from the precache into
+    one minibatch for ``Train``. The arrays downstream of ``Train``, i.e.
+    snapshots and the returned batch, only contain the first sample, while
+    ``batch.loss`` is the loss of the whole minibatch.
+
+    With ``shared_memory_precache``, ``fos.gunpowder.SharedMemoryPreCache``
+    replaces ``gp.PreCache``, and hands batches over without pickling them.
+    Its slots are allocated in ``/dev/shm``, which needs to hold
+    ``cache_size + num_workers`` batches, e.g. ``docker run --shm-size``.
+
+    ``autocast_dtype`` enables mixed precision training, and
+    ``distributed`` data-parallel training in the default
+    ``torch.distributed`` process group, with one instance of this pipeline
+    per rank, see ``fos.gunpowder.torch.Train``. Pass a different
+    ``random_seed`` to each rank.
     """
 
     def __init__(
@@ -31,6 +48,10 @@ class TrainingBaselineWithContext:
             reject_min_masked=0.05,
             reject_probability=0.9,
             random_seed=None,
+            batch_size=1,
+            autocast_dtype=None,
+            distributed=False,
+            shared_memory_precache=False,
     ):
         self._data_config = data_config
         self._run_dir = run_dir
@@ -49,6 +70,10 @@ class TrainingBaselineWithContext:
         self._reject_min_masked = reject_min_masked
         self._reject_probability = reject_probability
         self._random_seed = random_seed
+        self._batch_size = int(batch_size)
+        self._autocast_dtype = autocast_dtype
+        self._distributed = distributed
+        self._shared_memory_precache = shared_memory_precache
 
         self._assemble_pipeline()
 
@@ -245,12 +270,28 @@ class TrainingBaselineWithContext:
             ])
         )
 
-        self.precache = gp.PreCache(cache_size=10, num_workers=5)
+        if self._shared_memory_precache:
+            self.precache = fos.gunpowder.SharedMemoryPreCache(
+                cache_size=10, num_workers=5)
+        else:
+            self.precache = gp.PreCache(cache_size=10, num_workers=5)
         self.pipeline = (
             self.pipeline
             + self.precache
         )
 
+        batch_arrays = [
+            keys['RAW'],
+            keys['LABELS'],
+            keys['MASK'],
+            keys['LOSS_SCALINGS'],
+        ]
+        if self._batch_size > 1:
+            self.pipeline = (
+                self.pipeline
+                + fos.gunpowder.StackSamples(batch_arrays, self._batch_size)
+            )
+
         # checkpoints in some directory
         checkpoint_dir = os.path.join(
             self._run_path_prefix,
@@ -290,12 +331,21 @@ class TrainingBaselineWithContext:
                 'training'
             ),
             log_every=1,
+            autocast_dtype=self._autocast_dtype,
+            distributed=self._distributed,
         )
         self.pipeline = (
             self.pipeline
             + self.train_node
         )
 
+        if self._batch_size > 1:
+            self.pipeline = (
+                self.pipeline
+                + fos.gunpowder.TakeSample(
+                    batch_arrays + [keys['PREDICTIONS']])
+            )
+
         self.pipeline = (
             self.pipeline
             + fos.gunpowder.Squeeze([
@@ -344,6 +394,8 @@ class TrainingBaselineWithContext:
             compression_type='zlib',
             compression_level=3,
             chunk_shape=tuple(self._output_size / self._voxel_size),
+            # compressed and written while the pipeline continues
+            asynchronous=True,
         )
 
         self.profiling_stats = gp.PrintProfilingStats(every=10)
@@ -10,6 +10,26 @@ logger.setLevel(logging.INFO)
 
 
 class ValidationBaselineWithContext:
+    """Validation pipeline with U-Net for semantic segmentation, over the
+    whole ROI of a single dataset.
+
+    The validation ROI is scanned block by block, and nothing is assembled:
+    ``fos.gunpowder.torch.AccumulateLoss`` accumulates the loss, reported by
+    ``fos.gunpowder.torch.ValidationLoss``, and
+    ``fos.gunpowder.ConfusionCounts`` the counts for the dice scores within
+    the mask and the metric mask, in ``confusion_counts``. Request an empty
+    ``gp.BatchRequest``, memory does not grow with the ROI then.
+
+    With ``snapshot``, the arrays of the whole ROI can be requested instead,
+    assembled by the scan and written by ``fos.gunpowder.Snapshot``.
+
+    With ``cache_inputs``, the arrays of the sources are read once over the
+    validation ROI by ``fos.gunpowder.CacheBatches``, in memory or
+    memory-mapped in ``cache_dir``, so that later rounds do not read and
+    normalize them again. The cache grows with the ROI, about 4 bytes for
+    each raw voxel plus the labels and masks at the dtype of the sources.
+    """
+
     def __init__(
             self,
             data_config,
@@ -24,6 +44,9 @@ class ValidationBaselineWithContext:
             output_size_voxels,
             run_every,
             random_seed=None,
+            cache_inputs=False,
+            cache_dir=None,
+            snapshot=False,
     ):
         self._data_config = data_config[0]
         self._data_config_name = data_config[1]
@@ -42,6 +65,9 @@ class ValidationBaselineWithContext:
 
         self._run_every = run_every
         self._random_seed = random_seed
+        self._cache_inputs = cache_inputs
+        self._cache_dir = cache_dir
+        self._snapshot = snapshot
 
         self._assemble_pipeline()
 
@@ -104,6 +130,14 @@ class ValidationBaselineWithContext:
             + self.downsample
         )
 
+        if self._cache_inputs:
+            self.cache = fos.gunpowder.CacheBatches(
+                cache_dir=self._cache_dir)
+            self.pipeline = (
+                self.pipeline
+                + self.cache
+            )
+
         self.balance_labels = gp.BalanceLabels(
             labels=keys['LABELS'],
             scales=keys['LOSS_SCALINGS'],
@@ -163,13 +197,7 @@ class ValidationBaselineWithContext:
             + self.predict
         )
 
-        self.scan = gp.Scan(reference=self.request, num_workers=1)
-        self.pipeline = (
-            self.pipeline +
-            self.scan
-        )
-
-        self.validation_loss = fos.gunpowder.torch.ValidationLoss(
+        self.accumulate_loss = fos.gunpowder.torch.AccumulateLoss(
             loss=self._loss,
             inputs={
                 0: keys['PREDICTIONS'],
@@ -177,18 +205,10 @@ class ValidationBaselineWithContext:
                 2: keys['MASK'],
                 3: keys['LOSS_SCALINGS'],
             },
-            log_dir=os.path.join(
-                self._run_path_prefix,
-                'tensorboard',
-                self._run_dir,
-                'validation',
-                self._data_config_name
-            ),
-            log_every=self._run_every
         )
         self.pipeline = (
             self.pipeline
-            + self.validation_loss
+            + self.accumulate_loss
         )
 
         self.pipeline = (
@@ -209,34 +229,71 @@ class ValidationBaselineWithContext:
             + gp.IntensityScaleShift(keys['RAW'], 0.5, 0.5)
             + fos.gunpowder.FloatToUint8(keys['RAW'])
             + fos.gunpowder.ToDtype([keys['LABELS']], dtype='uint32')
+            + fos.gunpowder.Softmax(keys['PREDICTIONS'])
         )
 
+        self.confusion_counts = fos.gunpowder.ConfusionCounts(
+            labels=keys['LABELS'],
+            predictions=keys['PREDICTIONS'],
+            num_classes=self._num_classes,
+            masks=[keys['MASK'], keys['METRIC_MASK']],
+        )
         self.pipeline = (
             self.pipeline
-            + fos.gunpowder.Softmax(keys['PREDICTIONS'])
+            + self.confusion_counts
             + fos.gunpowder.FloatToUint8(keys['PREDICTIONS'])
         )
 
-        self.snapshot = fos.gunpowder.Snapshot(
-            dataset_names={
-                v: f"{k.lower()}" for k, v in keys.items()
-            },
-            every=1,
-            output_dir=os.path.join(
+        self.scan = gp.Scan(reference=self.request, num_workers=1)
+        self.pipeline = (
+            self.pipeline +
+            self.scan
+        )
+
+        self.validation_loss = fos.gunpowder.torch.ValidationLoss(
+            accumulator=self.accumulate_loss,
+            log_dir=os.path.join(
                 self._run_path_prefix,
-                'snapshots',
+                'tensorboard',
                 self._run_dir,
                 'validation',
-                self._data_config_name,
+                self._data_config_name
             ),
-            output_filename='{iteration}.zarr',
-            compression_type='zlib',
-            compression_level=3,
-            chunk_shape=(128, 128, 128),
+            log_every=self._run_every
         )
         self.pipeline = (
             self.pipeline
-            + self.snapshot
-            + fos.gunpowder.Uint8ToFloat(keys['PREDICTIONS'])
+            + self.validation_loss
+        )
+
+        if self._snapshot:
+            self.snapshot = fos.gunpowder.Snapshot(
+                dataset_names={
+                    v: f"{k.lower()}" for k, v in keys.items()
+                },
+                every=1,
+                output_dir=os.path.join(
+                    self._run_path_prefix,
+                    'snapshots',
+                    self._run_dir,
+                    'validation',
+                    self._data_config_name,
+                ),
+                output_filename='{iteration}.zarr',
+                compression_type='zlib',
+                compression_level=3,
+                chunk_shape=(128, 128, 128),
+                # compressed and written while the pipeline continues
+                asynchronous=True,
+            )
+            self.pipeline = (
+                self.pipeline
+                + self.snapshot
+            )
+        else:
+            self.snapshot = None
+
+        self.pipeline = (
+            self.pipeline
             + gp.PrintProfilingStats(every=1)
         )
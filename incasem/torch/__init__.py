@@ -1,3 +1,6 @@
 from __future__ import absolute_import
 from . import models
 from . import loss
+from .quantization import quantize_static
+from .torchscript import export_torchscript, load_torchscript, blocks_per_pass
+from .checkpoint import CheckpointWriter
@@ -0,0 +1,139 @@
+import glob
+import logging
+import os
+import re
+import time
+
+import torch
+
+from incasem.utils.background_writer import BackgroundWriter
+
+logger = logging.getLogger(__name__)
+
+
+def state_to_cpu(state):
+    """Copy all tensors in a (nested) state dict to the CPU, so that training
+    can continue to update the originals in place."""
+
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, state_to_cpu(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(v) for v in state)
+    return state
+
+
+class CheckpointWriter:
+    """Write checkpoints with ``torch.save`` from a background thread, see
+    ``incasem.utils.BackgroundWriter``.
+
+    ``save`` copies the state to CPU memory and returns, while the copy is
+    written to a temporary file in the same directory and renamed to the
+    checkpoint name once complete, so that an interrupted write never leaves
+    a truncated checkpoint behind. While a checkpoint is written, at most
+    one more waits in memory, further calls to ``save`` block.
+
+    After each write, checkpoints ``<basename>_checkpoint_<iteration>`` are
+    deleted according to the retention policy: the ``keep_last`` most recent
+    ones and those whose iteration is a multiple of ``keep_every`` are kept,
+    and always the latest one. If both are ``None``, all checkpoints are
+    kept.
+
+    Args:
+
+        basename (``string``):
+
+            The basename of the checkpoint files, as used by
+            ``GenericTrain._checkpoint_name``.
+
+        keep_last (``int``, optional):
+
+            Number of most recent checkpoints to keep.
+
+        keep_every (``int``, optional):
+
+            Keep checkpoints of every ``keep_every``-th iteration.
+
+        asynchronous (``bool``, optional):
+
+            If false, ``save`` writes before returning, with the same atomic
+            rename and retention policy.
+    """
+
+    def __init__(
+            self,
+            basename,
+            keep_last=None,
+            keep_every=None,
+            asynchronous=True):
+        self.basename = basename
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.asynchronous = asynchronous
+
+        if keep_last is not None and keep_last < 1:
+            raise ValueError(
+                f"keep_last has to be at least 1, not {keep_last}.")
+
+        self._writer = BackgroundWriter(
+            self._write, name='CheckpointWriter', queue_size=1)
+
+    def save(self, state, filename):
+        """Snapshot ``state`` to the CPU and write it to ``filename``."""
+
+        self._writer.raise_error()
+
+        start = time.time()
+        state = state_to_cpu(state)
+        logger.debug(
+            f"Copied checkpoint state to cpu in {time.time() - start:.3f} s")
+
+        if not self.asynchronous:
+            self._write(state, filename)
+            return
+
+        self._writer.put(state, filename)
+
+    def close(self):
+        """Wait for pending writes and stop the background thread."""
+
+        self._writer.close()
+
+    def _write(self, state, filename):
+        start = time.time()
+
+        directory, name = os.path.split(filename)
+        # not matched by the glob in _get_latest_checkpoint
+        tmp_filename = os.path.join(directory, f'.{name}.tmp')
+        torch.save(state, tmp_filename)
+        os.replace(tmp_filename, filename)
+
+        logger.info(
+            f"Wrote checkpoint {filename} in {time.time() - start:.3f} s")
+
+        self._apply_retention()
+
+    def _apply_retention(self):
+        if self.keep_last is None and self.keep_every is None:
+            return
+
+        pattern = re.compile(
+            re.escape(os.path.basename(self.basename)) + r'_checkpoint_(\d+)$')
+        checkpoints = []
+        for filename in glob.glob(self.basename + '_checkpoint_*'):
+            match = pattern.match(os.path.basename(filename))
+            if match is not None:
+                checkpoints.append((int(match.group(1)), filename))
+        checkpoints.sort()
+
+        # the latest checkpoint is always kept, to resume training from
+        keep_last = self.keep_last if self.keep_last is not None else 1
+        for i, (iteration, filename) in enumerate(checkpoints):
+            if i >= len(checkpoints) - keep_last:
+                continue
+            if self.keep_every is not None and \
+                    iteration % self.keep_every == 0:
+                continue
+            logger.debug(f"Removing checkpoint {filename}")
+            os.remove(filename)
@@ -20,6 +20,27 @@ class CrossEntropyLossWithScalingAndMeanReduction(torch.nn.Module):
 
     def forward(self, input, target, mask=None, scaling=None):
 
+        # mean over the samples of a minibatch, each normalized by its own
+        # scaling, as computed per sample by gp.BalanceLabels
+        numerator, denominator = self.reduction_terms(
+            input, target, mask, scaling)
+        loss_reduced = (numerator / denominator).mean()
+        logger.debug(f'{loss_reduced.shape=}')
+
+        return loss_reduced
+
+    def reduction_terms(self, input, target, mask=None, scaling=None):
+        """Scaled loss sum and scaling sum of each sample, the loss of a
+        sample is their ratio.
+
+        Both are sums over voxels, so that the loss of a volume can be
+        accumulated from the terms of its blocks.
+        """
+
+        # under autocast, the logits may be reduced precision. The softmax and
+        # the sums over all voxels are computed in float32.
+        input = input.float()
+
         # logger.debug(f'{input.shape=}')
         # logger.debug(f'{target.shape=}')
         # logger.debug(f'{scaling.shape=}')
@@ -50,7 +71,7 @@ class CrossEntropyLossWithScalingAndMeanReduction(torch.nn.Module):
         logger.debug(
             f'Scaled loss per elem sum={float(loss_per_elem.sum())}')
 
-        loss_reduced = loss_per_elem.sum() / scaling.sum()
-        logger.debug(f'{loss_reduced.shape=}')
+        numerator = loss_per_elem.flatten(start_dim=1).sum(dim=1)
+        denominator = scaling.flatten(start_dim=1).sum(dim=1)
 
-        return loss_reduced
+        return numerator, denominator
@@ -42,6 +42,12 @@ class LsdLoss(torch.nn.Module):
 
         start = time.time()
 
+        # under autocast, the outputs may be reduced precision. The softmax,
+        # the squared errors and the sums over all voxels are computed in
+        # float32.
+        input_task = input_task.float()
+        input_lsd = input_lsd.float()
+
         # logger.debug(f'{input.shape=}')
         # logger.debug(f'{target.shape=}')
         # logger.debug(f'{scaling.shape=}')
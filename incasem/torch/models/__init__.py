@@ -3,3 +3,4 @@ from __future__ import absolute_import
 from .one_conv3d import OneConv3d
 from .unet import Unet
 from .multitask_unet import MultitaskUnet
+from .build_model import build_model, load_model, first_output
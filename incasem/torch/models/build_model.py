@@ -0,0 +1,85 @@
+import torch
+
+from .one_conv3d import OneConv3d
+from .unet import Unet
+from .multitask_unet import MultitaskUnet
+
+
+def build_model(model_config, voxel_size):
+    """Create the model described by the ``model`` section of a training
+    config, with valid padding and untrained weights.
+
+    Args:
+
+        model_config (``dict``):
+
+            The ``model`` section of a training config.
+
+        voxel_size (``tuple`` of ``int``):
+
+            Voxel size of the training data.
+    """
+
+    model_type = model_config['type']
+    if model_type == 'OneConv3d':
+        model = OneConv3d(
+            out_channels=model_config['num_fmaps_out']
+        )
+    elif model_type == 'Unet':
+        model = Unet(
+            in_channels=1,
+            num_fmaps=int(model_config['num_fmaps']),
+            fmap_inc_factor=int(model_config['fmap_inc_factor']),
+            downsample_factors=tuple(
+                tuple(i) for i in model_config['downsample_factors']
+            ),
+            activation='ReLU',
+            voxel_size=voxel_size,
+            num_fmaps_out=model_config['num_fmaps_out'],
+            num_heads=1,
+            constant_upsample=model_config['constant_upsample'],
+            padding='valid'
+        )
+    elif model_type == 'MultitaskUnet':
+        model = MultitaskUnet(
+            model_config['num_fmaps_out'],
+            model_config['num_fmaps_out_auxiliary'],
+            dims=3,
+            in_channels=1,
+            num_fmaps=int(model_config['num_fmaps']),
+            fmap_inc_factor=int(model_config['fmap_inc_factor']),
+            downsample_factors=tuple(
+                tuple(i) for i in model_config['downsample_factors']
+            ),
+            activation='ReLU',
+            voxel_size=voxel_size,
+            constant_upsample=model_config['constant_upsample'],
+            padding='valid'
+        )
+    else:
+        raise ValueError(f"Model type {model_type} does not exist.")
+
+    return model
+
+
+def load_model(model_config, voxel_size, checkpoint):
+    """Create the model with :func:`build_model` and load the weights of a
+    training checkpoint, in eval mode on the cpu."""
+
+    model = build_model(model_config, voxel_size)
+
+    checkpoint = torch.load(checkpoint, map_location='cpu')
+    if 'model_state_dict' in checkpoint:
+        model.load_state_dict(checkpoint['model_state_dict'])
+    else:
+        model.load_state_dict(checkpoint)
+
+    return model.eval()
+
+
+def first_output(out):
+    """The output of the main task, for models with several outputs such as
+    ``MultitaskUnet``."""
+    if isinstance(out, tuple):
+        return out[0]
+    return out
@@ -0,0 +1,133 @@
+import copy
+import logging
+
+import torch
+from torch.ao import quantization
+
+logger = logging.getLogger(__name__)
+
+
+class QuantizedBlock(torch.nn.Module):
+    """Run ``block`` on int8 tensors, with float inputs and outputs."""
+
+    def __init__(self, block):
+        super().__init__()
+        self.quant = quantization.QuantStub()
+        self.block = block
+        self.dequant = quantization.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.block(self.quant(x)))
+
+
+def quantized_engine(backend='x86'):
+    """Select the quantized engine ``backend``, or ``fbgemm`` on older
+    versions of torch."""
+
+    supported = torch.backends.quantized.supported_engines
+    if backend not in supported:
+        if 'fbgemm' not in supported:
+            raise RuntimeError(
+                f"Quantized engine {backend} is not available, "
+                f"only {supported}.")
+        logger.warning(f"Quantized engine {backend} is not available, "
+                       "using fbgemm")
+        backend = 'fbgemm'
+
+    torch.backends.quantized.engine = backend
+    return backend
+
+
+def _fuse_conv_relu(block):
+    pairs = []
+    for i in range(len(block) - 1):
+        if isinstance(block[i], torch.nn.Conv3d) and \
+                isinstance(block[i + 1], torch.nn.ReLU):
+            pairs.append([str(i), str(i + 1)])
+    if pairs:
+        quantization.fuse_modules(block, pairs, inplace=True)
+
+
+def quantize_static(
+        model,
+        calibration_inputs,
+        backend='x86',
+        skip=()):
+    """Post-training static int8 quantization of the convolutions of a
+    ``fos.torch.models.Unet`` or ``MultitaskUnet`` for inference on the CPU.
+
+    Every ``torch.nn.Sequential`` of ``Conv3d`` layers and activations, i.e.
+    the conv passes of the U-Net, is fused (``Conv3d`` + ``ReLU``) and runs on
+    int8 tensors. Pooling, upsampling, cropping and concatenation stay in
+    float, which keeps the U-Net code unchanged at the cost of a quantize and
+    dequantize step per conv pass. Activation ranges are calibrated with
+    histogram observers on ``calibration_inputs``, weights are quantized per
+    output channel.
+
+    Args:
+
+        model (``torch.nn.Module``):
+
+            Float model with loaded weights, is not modified.
+
+        calibration_inputs (iterable of ``torch.Tensor``):
+
+            Preprocessed input blocks with batch and channel dimension.
+
+        backend (``string``, optional):
+
+            Quantized engine, ``x86`` or ``fbgemm``.
+
+        skip (``list`` of ``string``, optional):
+
+            Names of submodules that stay in float, e.g. the output heads
+            ``final_conv_pass`` of a ``Unet``.
+
+    Returns:
+
+        The quantized model.
+    """
+
+    backend = quantized_engine(backend)
+    qconfig = quantization.get_default_qconfig(backend)
+
+    # fusing and observers must not touch the float model
+    model = copy.deepcopy(model).cpu().eval()
+
+    def skipped(name):
+        return any(
+            name == s or name.startswith(s + '.') for s in skip
+        )
+
+    blocks = [
+        (name, module)
+        for name, module in model.named_modules()
+        if name and isinstance(module, torch.nn.Sequential)
+        and any(isinstance(m, torch.nn.Conv3d) for m in module)
+        and not skipped(name)
+    ]
+    if not blocks:
+        raise ValueError("Model does not contain any conv passes.")
+
+    for name, block in blocks:
+        _fuse_conv_relu(block)
+        wrapper = QuantizedBlock(block)
+        wrapper.qconfig = qconfig
+        parent_name, _, child_name = name.rpartition('.')
+        setattr(model.get_submodule(parent_name), child_name, wrapper)
+    logger.info(f"Quantizing {len(blocks)} conv passes with {backend}")
+
+    quantization.prepare(model, inplace=True)
+
+    num_inputs = 0
+    with torch.no_grad():
+        for x in calibration_inputs:
+            model(x)
+            num_inputs += 1
+    if num_inputs == 0:
+        raise ValueError("No calibration inputs.")
+    logger.info(f"Calibrated on {num_inputs} blocks")
+
+    quantization.convert(model, inplace=True)
+
+    return model
@@ -0,0 +1,169 @@
+import itertools
+import json
+import logging
+import zipfile
+
+import torch
+
+from .quantization import quantized_engine
+
+logger = logging.getLogger(__name__)
+
+METADATA_FILE = 'incasem.json'
+
+
+def blocks_per_pass(prediction_config, dims=3):
+    """Number of blocks in a single forward pass of
+    ``fos.gunpowder.torch.Predict`` with the ``micro_batch`` and ``tta``
+    settings of the ``prediction`` section of a prediction config, i.e. the
+    batch size to export a model for."""
+
+    size = 1
+    micro_batch = prediction_config.get('micro_batch')
+    if micro_batch is not None:
+        for n in micro_batch:
+            size *= n
+
+    tta = prediction_config.get('tta', {})
+    if tta.get('mirror'):
+        size *= 2**dims
+    if tta.get('transpose'):
+        size *= len(list(itertools.permutations(range(dims))))
+
+    return size
+
+
+def export_torchscript(
+        model,
+        input_shape,
+        filename,
+        optimize=True,
+        channels_last=False,
+        metadata=None):
+    """Trace ``model`` for a fixed input shape, freeze it and save it as a
+    TorchScript artifact that ``fos.gunpowder.torch.Predict`` can load
+    without the Python model code.
+
+    Freezing inlines the parameters as constants and folds batch norms into
+    the preceding convolutions. If ``optimize`` is set,
+    ``load_torchscript`` additionally applies
+    ``torch.jit.optimize_for_inference`` on the CPU, which fuses convolutions
+    with their activations and picks CPU specific kernels.
+
+    Args:
+
+        model (``torch.nn.Module``):
+
+            Model with loaded weights.
+
+        input_shape (``tuple`` of ``int``):
+
+            Shape of the input tensor, including batch and channel dimension.
+
+        filename (``string``):
+
+            Where to save the artifact.
+
+        optimize (``bool``, optional):
+
+            Apply ``torch.jit.optimize_for_inference``.
+
+        channels_last (``bool``, optional):
+
+            Trace with the ``channels_last_3d`` memory format.
+
+        metadata (``dict``, optional):
+
+            Additional JSON serializable information stored in the artifact.
+
+    Returns:
+
+        The traced module, optimized if ``optimize`` is set.
+    """
+
+    model = model.eval()
+    example = torch.rand(tuple(input_shape))
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last_3d)
+        example = example.contiguous(memory_format=torch.channels_last_3d)
+
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+        frozen = torch.jit.freeze(traced)
+
+        # optimized graphs can not be serialized, the optimization is applied
+        # again after loading
+        optimized = frozen
+        if optimize:
+            optimized = torch.jit.optimize_for_inference(
+                torch.jit.freeze(traced))
+
+        # a few passes to run the profiling executor, and to check the output
+        for _ in range(2):
+            out = optimized(example)
+        expected = model(example)
+
+    if isinstance(out, tuple):
+        out, expected = out[0], expected[0]
+    max_difference = float((out - expected).abs().max())
+    logger.info(
+        f"Max. difference of traced and eager output: {max_difference:.3e}")
+
+    metadata = dict(metadata or {})
+    metadata.update({
+        'input_shape': list(input_shape),
+        'output_shape': list(out.shape),
+        'optimized': optimize,
+        'channels_last': channels_last,
+        'torch_version': torch.__version__,
+    })
+    torch.jit.save(
+        frozen,
+        filename,
+        _extra_files={METADATA_FILE: json.dumps(metadata)}
+    )
+    logger.info(f"Saved TorchScript model to {filename}")
+
+    return optimized
+
+
+def read_metadata(filename):
+    """Metadata stored in an artifact written by ``export_torchscript``,
+    without loading the module."""
+
+    with zipfile.ZipFile(filename) as archive:
+        for name in archive.namelist():
+            if name.endswith(f'/extra/{METADATA_FILE}'):
+                return json.loads(archive.read(name))
+
+    return {}
+
+
+def load_torchscript(filename, device='cpu'):
+    """Load an artifact written by ``export_torchscript``.
+
+    Models quantized with ``fos.torch.quantize_static`` can only be loaded
+    on the CPU, with the quantized engine they were calibrated for.
+
+    Returns:
+
+        The module and the metadata stored with it.
+    """
+
+    metadata = read_metadata(filename)
+    is_cpu = torch.device(device).type == 'cpu'
+
+    if metadata.get('quantized_engine') is not None:
+        if not is_cpu:
+            raise ValueError(
+                f"Quantized model {filename} can only run on the cpu.")
+        # packed weights are created for the engine when loading
+        quantized_engine(metadata['quantized_engine'])
+
+    module = torch.jit.load(filename, map_location=device)
+    module.eval()
+
+    if metadata.get('optimized', False) and is_cpu:
+        module = torch.jit.optimize_for_inference(module)
+
+    return module, metadata
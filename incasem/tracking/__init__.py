@@ -2,3 +2,9 @@ from __future__ import absolute_import
 
 from .sacred import experiment
 from . import sacred
+from .metrics_logger import (
+    MetricsLogger,
+    TensorboardSink,
+    SacredSink,
+    JsonlSink
+)
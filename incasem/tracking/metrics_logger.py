@@ -0,0 +1,173 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from incasem.utils.background_writer import BackgroundWriter
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsLogger:
+    """Buffer scalar metrics in memory and write them to several sinks from a
+    background thread.
+
+    ``log_scalar`` only adds the value to a running sum per metric, which
+    for a ``torch.Tensor`` stays on its device, so that logging does not
+    synchronize with the device or touch the disk. On the first
+    ``log_scalar`` at least ``flush_every`` seconds after the last flush, the
+    mean of each metric since then, with the step of its most recent value,
+    is handed to an ``incasem.utils.BackgroundWriter``, which writes it to
+    all sinks.
+
+    Args:
+
+        sinks (``list``):
+
+            Objects with a ``write(records)`` method that takes a list of
+            ``(name, value, step)`` tuples, and optionally ``close()``, e.g.
+            :class:`TensorboardSink`, :class:`SacredSink` or
+            :class:`JsonlSink`.
+
+        flush_every (``float``, optional):
+
+            Minimum seconds between flushes. If ``None``, metrics are only
+            written on ``flush`` and ``close``.
+    """
+
+    def __init__(self, sinks, flush_every=30.0):
+        self.sinks = list(sinks)
+        self.flush_every = flush_every
+
+        self._lock = threading.Lock()
+        self._buffer = {}
+        self._records = []
+        self._last_flush = time.time()
+        self._writer = BackgroundWriter(
+            self._write, name='MetricsLogger', queue_size=8)
+
+    def log_scalar(self, name, value, step, aggregate=True):
+        """Add ``value``, a number or a scalar tensor, to metric ``name``.
+
+        With ``aggregate=False``, the value is written as is at ``step``,
+        e.g. for infrequent evaluations.
+        """
+
+        if hasattr(value, 'detach'):
+            # sums of low precision losses would round
+            value = value.detach().float()
+        else:
+            value = float(value)
+
+        with self._lock:
+            if not aggregate:
+                self._records.append((name, value, step))
+            else:
+                entry = self._buffer.get(name)
+                if entry is None:
+                    self._buffer[name] = [value, 1, step]
+                else:
+                    entry[0] = entry[0] + value
+                    entry[1] += 1
+                    entry[2] = step
+
+            due = self.flush_every is not None and \
+                time.time() - self._last_flush >= self.flush_every
+
+        if due:
+            self._enqueue()
+
+    def log_scalars(self, scalars, step, aggregate=True):
+        """Log a ``dict`` of metric names to values."""
+        for name, value in scalars.items():
+            self.log_scalar(name, value, step, aggregate=aggregate)
+
+    def flush(self):
+        """Write the buffered means to all sinks, and wait until written."""
+
+        self._enqueue()
+        self._writer.wait()
+
+    def close(self):
+        """Flush, stop the background thread and close all sinks."""
+
+        self._enqueue()
+        self._writer.close()
+        for sink in self.sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+
+    def _enqueue(self):
+        with self._lock:
+            buffer, self._buffer = self._buffer, {}
+            records, self._records = self._records, []
+            self._last_flush = time.time()
+        if buffer or records:
+            self._writer.put(buffer, records)
+
+    def _write(self, buffer, records):
+        records = [(name, float(value), step)
+                   for name, value, step in records]
+        for name, (total, count, step) in buffer.items():
+            # converting a device tensor waits for it, in this thread
+            value = float(total) / count
+            records.append((name, value, step))
+
+        for sink in self.sinks:
+            try:
+                sink.write(records)
+            except Exception as e:
+                logger.error(
+                    f"Writing metrics to {type(sink).__name__} "
+                    f"failed: {e}")
+
+
+class TensorboardSink:
+    """Write metrics as tensorboard scalars to ``log_dir``."""
+
+    def __init__(self, log_dir):
+        import tensorboardX
+        self.summary_writer = tensorboardX.SummaryWriter(log_dir)
+
+    def write(self, records):
+        for name, value, step in records:
+            self.summary_writer.add_scalar(name, value, step)
+        self.summary_writer.flush()
+
+    def close(self):
+        self.summary_writer.close()
+
+
+class SacredSink:
+    """Log metrics to a sacred run, i.e. its observers."""
+
+    def __init__(self, run):
+        self.run = run
+
+    def write(self, records):
+        for name, value, step in records:
+            self.run.log_scalar(name, value, step)
+
+
+class JsonlSink:
+    """Append metrics to ``filename``, one JSON object per line with keys
+    ``name``, ``value`` and ``step``."""
+
+    def __init__(self, filename):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(filename, 'a')
+
+    def write(self, records):
+        for name, value, step in records:
+            if not math.isfinite(value):
+                value = str(value)
+            self.file.write(json.dumps(
+                {'name': name, 'value': value, 'step': int(step)}) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
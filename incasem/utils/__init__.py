@@ -10,3 +10,7 @@ from .crop_datasets import crop_datasets
 from .create_multiple_config import create_multiple_config
 from .monitor_runtime import monitor_runtime
 from .scale_pyramid import scale_pyramid
+from .block_ledger import BlockLedger
+from .decode_probabilities import decode_probabilities
+from .mask_index import MaskIndex
+from .background_writer import BackgroundWriter
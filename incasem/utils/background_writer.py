@@ -0,0 +1,115 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundWriter:
+    """Call ``write`` from background threads, so that the caller continues
+    immediately.
+
+    ``put(*args)`` queues the arguments of a call to ``write``, which is made
+    from one of ``num_threads`` daemon threads, started on the first ``put``.
+    If the writers fall behind, at most ``queue_size`` calls wait, and
+    ``put`` blocks until there is space, with a warning if that takes long.
+
+    An exception raised by ``write`` is logged, and raised as a
+    ``RuntimeError`` from the next ``put``, ``wait`` or ``close``.
+
+    Args:
+
+        write (``callable``):
+
+            Called with the arguments of each ``put``, in a background
+            thread.
+
+        name (``string``):
+
+            Name of the threads, used in log messages and errors.
+
+        num_threads (``int``, optional):
+
+            Number of background threads.
+
+        queue_size (``int``, optional):
+
+            How many calls wait at most. If 0, the queue is unbounded.
+    """
+
+    def __init__(self, write, name, num_threads=1, queue_size=1):
+        self.write = write
+        self.name = name
+        self.num_threads = num_threads
+        self.queue_size = queue_size
+
+        self._queue = None
+        self._threads = []
+        self._error = None
+
+    def put(self, *args):
+        """Queue a call of ``write`` with ``args``."""
+
+        self.raise_error()
+
+        if self._queue is None:
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            for i in range(self.num_threads):
+                thread = threading.Thread(
+                    target=self._run,
+                    name=self.name if self.num_threads == 1
+                    else f"{self.name}-{i}",
+                    daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+        start = time.time()
+        self._queue.put(args)
+        waited = time.time() - start
+        if waited > 1.0:
+            logger.warning(
+                "%s is falling behind, waited %.1f s for a free slot in "
+                "the queue.", self.name, waited)
+
+    def wait(self):
+        """Wait until all queued calls are done."""
+
+        if self._queue is not None:
+            self._queue.join()
+
+        self.raise_error()
+
+    def close(self):
+        """Wait for the queued calls and stop the background threads."""
+
+        if self._queue is not None:
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._queue = None
+            self._threads = []
+
+        self.raise_error()
+
+    def raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError(f"Writing in {self.name} failed.") from error
+
+    def _run(self):
+        while True:
+            args = self._queue.get()
+            try:
+                if args is None:
+                    return
+                start = time.time()
+                self.write(*args)
+                logger.debug(
+                    "%s wrote in %.3f s", self.name, time.time() - start)
+            except Exception as e:
+                logger.error("Writing in %s failed: %s", self.name, e)
+                self._error = e
+            finally:
+                self._queue.task_done()
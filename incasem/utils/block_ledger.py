@@ -0,0 +1,98 @@
+import glob
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class BlockLedger:
+    """Persistent record of finished blocks of a blockwise task.
+
+    The ledger is a directory with one sqlite file per writer (named after
+    host and ``writer``), so that processes on several machines can share it
+    over a network filesystem without concurrent writes to the same
+    database. A resumed run with the same writers appends to the same files.
+    Reading the ledger takes the union over all files.
+
+    Args:
+
+        path (str):
+
+            Directory of the ledger, created if it does not exist.
+
+        writer (str, optional):
+
+            Name of the writing worker, unique among the concurrent writers
+            on a host, e.g. its worker index. Can be set after forking.
+    """
+
+    def __init__(self, path, writer='0'):
+        self.path = os.path.expanduser(path)
+        os.makedirs(self.path, exist_ok=True)
+
+        self.writer = writer
+
+        self._connection = None
+        self._connection_pid = None
+        self._done = set()
+
+    def refresh(self):
+        """Re-read the finished blocks from all files of the ledger."""
+
+        done = set()
+        for filename in glob.glob(os.path.join(self.path, '*.sqlite')):
+            connection = sqlite3.connect(filename, timeout=30)
+            try:
+                done.update(
+                    row[0] for row in connection.execute(
+                        'SELECT block_id FROM blocks'
+                    )
+                )
+            except sqlite3.OperationalError as e:
+                # the writing process has not created its table yet
+                logger.debug(f"Skipping {filename}: {e}")
+            finally:
+                connection.close()
+
+        self._done = done
+        logger.info(f"{len(self._done)} blocks done in ledger {self.path}")
+
+    def is_done(self, block_id):
+        """Whether ``block_id`` was finished at the last ``refresh``."""
+        return block_id in self._done
+
+    def mark_done(self, block_id, roi=None, duration=None):
+        """Record that ``block_id`` has been finished by this process."""
+
+        connection = self._get_connection()
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?)',
+                (block_id, str(roi), duration, time.time())
+            )
+        self._done.add(block_id)
+
+    def __len__(self):
+        return len(self._done)
+
+    def _get_connection(self):
+        # sqlite connections must not be shared with forked processes
+        pid = os.getpid()
+        if self._connection_pid != pid:
+            filename = os.path.join(
+                self.path, f"{socket.gethostname()}_{self.writer}.sqlite")
+            self._connection = sqlite3.connect(filename, timeout=30)
+            with self._connection:
+                self._connection.execute((
+                    'CREATE TABLE IF NOT EXISTS blocks ('
+                    'block_id INTEGER PRIMARY KEY, '
+                    'roi TEXT, '
+                    'duration REAL, '
+                    'finished REAL)'
+                ))
+            self._connection_pid = pid
+
+        return self._connection
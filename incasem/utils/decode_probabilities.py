@@ -0,0 +1,28 @@
+import numpy as np
+
+
+def decode_probabilities(data, channel=None):
+    """Convert a stored probability map to float32 in [0, 1].
+
+    Handles the per-class float32 datasets, as well as the compact
+    channel-first uint8 (scaled to [0, 255]) and float16 datasets written by
+    ``PredictionBaseline``.
+
+    Args:
+
+        data (np.ndarray):
+
+            Probabilities, optionally with a leading channel dimension.
+
+        channel (int):
+
+            Class channel to pick from multi-channel probabilities.
+    """
+
+    if channel is not None:
+        data = data[channel]
+
+    if data.dtype == np.uint8:
+        return data.astype(np.float32) / 255
+
+    return data.astype(np.float32, copy=False)
@@ -0,0 +1,134 @@
+import logging
+
+import numpy as np
+import zarr
+import gunpowder as gp
+
+logger = logging.getLogger(__name__)
+
+
+class MaskIndex:
+    """Coarse summed-area table of a binary mask, to check in constant time
+    whether a ROI contains any foreground.
+
+    The mask is divided into cells of ``cell_shape`` voxels, and the table
+    holds the cumulative number of foreground voxels over the cells. Queries
+    are conservative: a ROI is reported to contain foreground if any cell it
+    touches does, or if it is not fully covered by the index.
+
+    Args:
+
+        table (np.ndarray):
+
+            Summed-area table with a leading zero in each dimension.
+
+        offset (gp.Coordinate):
+
+            World offset of the first cell.
+
+        cell_size (gp.Coordinate):
+
+            World size of a cell.
+    """
+
+    def __init__(self, table, offset, cell_size):
+        self.table = table
+        self.offset = gp.Coordinate(offset)
+        self.cell_size = gp.Coordinate(cell_size)
+
+        self.num_cells = gp.Coordinate(s - 1 for s in table.shape)
+        self.roi = gp.Roi(self.offset, self.num_cells * self.cell_size)
+
+    @classmethod
+    def build(cls, mask, offset, voxel_size, cell_shape=(16, 16, 16)):
+        """Build the index from a mask array (numpy or zarr) with the given
+        world ``offset`` and ``voxel_size``, reading one slab of cells along
+        the first dimension at a time."""
+
+        cell_shape = gp.Coordinate(cell_shape)
+        num_cells = gp.Coordinate(
+            -(-s // c) for s, c in zip(mask.shape, cell_shape))
+
+        counts = np.zeros(num_cells, dtype=np.int64)
+        for z in range(num_cells[0]):
+            slab = np.asarray(
+                mask[z * cell_shape[0]:(z + 1) * cell_shape[0]]) != 0
+
+            # pad to full cells
+            padded_shape = (cell_shape[0],) + tuple(
+                n * c for n, c in zip(num_cells[1:], cell_shape[1:]))
+            padded = np.zeros(padded_shape, dtype=bool)
+            padded[tuple(slice(0, s) for s in slab.shape)] = slab
+
+            # (c_z, n_y, c_y, n_x, c_x), sum over the voxels of each cell
+            cells_shape = (cell_shape[0],)
+            for n, c in zip(num_cells[1:], cell_shape[1:]):
+                cells_shape += (n, c)
+            cells = padded.reshape(cells_shape)
+            counts[z] = cells.sum(
+                axis=(0,) + tuple(range(2, len(cells_shape), 2)))
+
+        table = np.pad(counts, [(1, 0)] * counts.ndim)
+        for axis in range(table.ndim):
+            table = np.cumsum(table, axis=axis)
+
+        logger.info((
+            f"Built mask index with {counts.size} cells, "
+            f"{np.count_nonzero(counts)} containing foreground"
+        ))
+
+        return cls(
+            table,
+            offset,
+            gp.Coordinate(voxel_size) * cell_shape
+        )
+
+    @classmethod
+    def load(cls, filename, ds_name):
+        dataset = zarr.open(filename, mode='r')[ds_name]
+        return cls(
+            dataset[:],
+            dataset.attrs['offset'],
+            dataset.attrs['cell_size']
+        )
+
+    def save(self, filename, ds_name):
+        data_file = zarr.open(filename, mode='a')
+        dataset = data_file.create_dataset(
+            ds_name,
+            data=self.table,
+            overwrite=True
+        )
+        dataset.attrs['offset'] = list(self.offset)
+        dataset.attrs['cell_size'] = list(self.cell_size)
+
+    def count(self, roi):
+        """Number of foreground voxels in all cells touched by ``roi``."""
+
+        begin = (roi.get_begin() - self.offset) // self.cell_size
+        end = -((self.offset - roi.get_end()) // self.cell_size)
+        begin = [min(max(b, 0), n) for b, n in zip(begin, self.num_cells)]
+        end = [min(max(e, 0), n) for e, n in zip(end, self.num_cells)]
+
+        # inclusion-exclusion over the corners of the summed-area table
+        total = 0
+        dims = len(begin)
+        for corner in range(2**dims):
+            index = []
+            sign = 1
+            for d in range(dims):
+                if corner & (1 << d):
+                    index.append(end[d])
+                else:
+                    index.append(begin[d])
+                    sign = -sign
+            total += sign * self.table[tuple(index)]
+
+        return total
+
+    def any(self, roi):
+        """Whether ``roi`` may contain foreground."""
+
+        if not self.roi.contains(roi):
+            return True
+        return self.count(roi) > 0
@@ -11,7 +11,9 @@ from skimage.morphology import ball
 from funlib.persistence import Array, open_ds, prepare_ds
 from funlib.geometry import Roi, Coordinate
 import daisy
+import zarr
 
+from incasem.utils import MaskIndex
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -62,6 +64,7 @@ def create_mask(
         chunk_shape,
         min_gray_value,
         max_gray_value,
+        index_cell_shape,
         num_workers):
 
     raw = open_ds(
@@ -109,6 +112,15 @@ def create_mask(
 
     logger.info(f"Done in {now() - start} s")
 
+    # coarse index to skip blocks outside of the mask during prediction
+    mask_index = MaskIndex.build(
+        zarr.open(filename, mode='r')[out_ds_name],
+        offset=out.roi.offset,
+        voxel_size=out.voxel_size,
+        cell_shape=index_cell_shape
+    )
+    mask_index.save(filename, f"{out_ds_name.rstrip('/')}_index")
+
 
 def parse_args():
     p = argparse.ArgParser(
@@ -151,6 +163,13 @@ def parse_args():
         default=180,
         help='upper boundary for masking by value'
     )
+    p.add(
+        '--index_cell_shape',
+        nargs='+',
+        type=int,
+        default=[16, 16, 16],
+        help='cell size in voxels of the coarse mask index for prediction'
+    )
     p.add(
         '--num_workers',
         '-n',
@@ -174,6 +193,7 @@ def main():
         args.chunk_shape,
         args.min_gray_value,
         args.max_gray_value,
+        args.index_cell_shape,
         args.num_workers
     )
 
@@ -4,12 +4,14 @@ import sys
 import logging
 import argparse
 import json
+from time import time as now
 
 import numpy as np
 from pymongo import MongoClient
 import torch
+import torch.distributed as dist
+import torch.multiprocessing
 import sacred
-import tensorboardX
 
 import gunpowder as gp
 
@@ -36,44 +38,8 @@ def torch_setup(_config):
 
 @ex.capture
 def model_setup(_config, _run):
-    model_type = _config['model']['type']
-    if model_type == 'OneConv3d':
-        model = fos.torch.models.OneConv3d(
-            out_channels=_config['model']['num_fmaps_out']
-        )
-    elif model_type == 'Unet':
-        model = fos.torch.models.Unet(
-            in_channels=1,
-            num_fmaps=int(_config['model']['num_fmaps']),
-            fmap_inc_factor=int(_config['model']['fmap_inc_factor']),
-            downsample_factors=tuple(
-                tuple(i) for i in _config['model']['downsample_factors']
-            ),
-            activation='ReLU',
-            voxel_size=_config['data']['voxel_size'],
-            num_fmaps_out=_config['model']['num_fmaps_out'],
-            num_heads=1,
-            constant_upsample=_config['model']['constant_upsample'],
-            padding='valid'
-        )
-    elif model_type == 'MultitaskUnet':
-        model = fos.torch.models.MultitaskUnet(
-            _config['model']['num_fmaps_out'],
-            _config['model']['num_fmaps_out_auxiliary'],
-            dims=3,
-            in_channels=1,
-            num_fmaps=int(_config['model']['num_fmaps']),
-            fmap_inc_factor=int(_config['model']['fmap_inc_factor']),
-            downsample_factors=tuple(
-                tuple(i) for i in _config['model']['downsample_factors']
-            ),
-            activation='ReLU',
-            voxel_size=_config['data']['voxel_size'],
-            constant_upsample=_config['model']['constant_upsample'],
-            padding='valid'
-        )
-    else:
-        raise ValueError(f"Model type {model_type} does not exist.")
+    model = fos.torch.models.build_model(
+        _config['model'], _config['data']['voxel_size'])
 
     total_params = sum(p.numel()
                        for p in model.parameters())
@@ -139,13 +105,31 @@ def training_setup(_config, _run, _seed, run_dir, model):
         reject_probability=float(
             _config['training']['reject']['reject_probability']),
         random_seed=_seed,
+        batch_size=int(_config['training']['batch_size']),
+        autocast_dtype=_config['training']['autocast_dtype'],
+        distributed=dist.is_initialized(),
+        shared_memory_precache=bool(
+            _config['training']['precache']['shared_memory']),
     )
 
     device = _config['torch']['device']
-    training.train_node.gpus = [] if device == 'cpu' else [int(device)]
+    if device == 'cpu':
+        training.train_node.gpus = []
+    elif dist.is_initialized():
+        # each process picks the GPU of its LOCAL_RANK, restrict them with
+        # CUDA_VISIBLE_DEVICES
+        training.train_node.gpus = list(range(torch.cuda.device_count()))
+    else:
+        training.train_node.gpus = [int(device)]
 
     training.train_node.save_every = int(
         _config['training']['save_every'])
+    training.train_node.async_checkpoints = bool(
+        _config['training']['async_checkpoints'])
+    training.train_node.keep_last_checkpoints = \
+        _config['training']['keep_last_checkpoints']
+    training.train_node.keep_checkpoints_every = \
+        _config['training']['keep_checkpoints_every']
     training.train_node.log_every = int(
         _config['training']['log_every'])
 
@@ -221,6 +205,8 @@ def training_setup(_config, _run, _seed, run_dir, model):
     training.snapshot.every = int(
         _config['training']['snapshot']['every']
     )
+    if get_rank() != 0:
+        training.snapshot.output_dir += f"_rank_{get_rank()}"
 
     # Profiling Stats
     training.profiling_stats.every = int(
@@ -271,6 +257,9 @@ def validation_setup(_config, _run, _seed, run_dir, model, val_dataset):
         output_size_voxels=_config['validation']['output_size_voxels'],
         run_every=_config['validation']['validate_every'],
         random_seed=_seed,
+        cache_inputs=bool(_config['validation']['cache_inputs']),
+        cache_dir=_config['validation']['cache_dir'],
+        snapshot=bool(_config['validation']['snapshot']['enabled']),
     )
     device = _config['torch']['device']
     validation.predict.gpus = [] if device == 'cpu' else [int(device)]
@@ -290,9 +279,10 @@ def validation_setup(_config, _run, _seed, run_dir, model, val_dataset):
         _config['loss']['balance_labels']['clipmin'] = None
         _config['loss']['balance_labels']['clipmax'] = None
 
-    validation.snapshot.every = int(
-        _config['validation']['snapshot']['every']
-    )
+    if validation.snapshot is not None:
+        validation.snapshot.every = int(
+            _config['validation']['snapshot']['every']
+        )
 
     return validation
 
@@ -361,9 +351,31 @@ def directory_structure_setup(_config, _run):
     return dir_run_id
 
 
-@ ex.capture
+def dice_metrics(target, prediction_probas, mask, metric_mask, mode):
+    mask = np.logical_and(mask.astype(bool), metric_mask.astype(bool))
+
+    # one pass over the arrays for all classes
+    counts = fos.metrics.thresholded_counts(
+        target=target,
+        prediction_probas=prediction_probas,
+        threshold=0.5,
+        mask=mask,
+    )
+    return dice_metrics_from_counts(counts, mode)
+
+
+def dice_metrics_from_counts(counts, mode):
+    dice_scores = fos.metrics.dice_from_counts(counts)
+
+    scores = {}
+    for label, score in enumerate(dice_scores):
+        scores[f"dice_class_{label}_{mode}"] = score
+        logger.info(f"{mode} | Dice score class {label}: {score}")
+    return scores
+
+
 def log_metrics(
-        _run,
+        metrics,
         target,
         prediction_probas,
         mask,
@@ -371,22 +383,11 @@ def log_metrics(
         iteration,
         mode):
 
-    mask = np.logical_and(mask.astype(bool), metric_mask.astype(bool))
-
-    dice_scores = []
-    for i in range(prediction_probas.shape[0]):
-        dic_score = fos.metrics.pairwise_distance_metric_thresholded(
-            target=target,
-            prediction_probas=prediction_probas,
-            threshold=0.5,
-            metric='dice',
-            foreground_class=i,
-            mask=mask,
-        )
-        dice_scores.append(dic_score)
-    for label, score in enumerate(dice_scores):
-        _run.log_scalar(f"dice_class_{label}_{mode}", score, iteration)
-        logger.info(f"{mode} | Dice score class {label}: {score}")
+    metrics.log_scalars(
+        dice_metrics(target, prediction_probas, mask, metric_mask, mode),
+        iteration,
+        aggregate=False
+    )
 
     # jaccard_scores = fos.metrics.jaccard(
         # target,
@@ -404,30 +405,58 @@ def log_metrics(
         # _run.log_scalar(f"AP_class_{label}_{mode}", score, iteration)
 
 
-@ ex.capture
-def log_labels_balance(_run, labels, num_classes, iteration):
-    try:
-        for c in range(num_classes):
-            pct = np.sum(labels == c) / np.prod(labels.shape)
-            _run.log_scalar(f"pct_class_{c}", pct, iteration)
-    except KeyError as e:
-        logger.error(e)
+def log_batch_position(metrics, i, raw_pos):
+    logger.debug(f"{i=}, {raw_pos=}")
+    metrics.log_scalars({
+        'offset_z': int(raw_pos[0][0]),
+        'offset_y': int(raw_pos[0][1]),
+        'offset_x': int(raw_pos[0][2]),
+        'shape_z': int(raw_pos[1][0]),
+        'shape_y': int(raw_pos[1][1]),
+        'shape_x': int(raw_pos[1][2]),
+    }, i, aggregate=False)
+
+
+def log_labels_balance(metrics, i, labels, num_classes):
+    counts = np.bincount(labels.ravel(), minlength=num_classes)
+    for c in range(num_classes):
+        metrics.log_scalar(
+            f'pct_class_{c}', counts[c] / labels.size, i, aggregate=False)
 
 
-def log_tb_batch_position(summary_writer, i, raw_pos):
-    logger.debug(f"{i=}, {raw_pos=}")
-    summary_writer.add_scalar('offset_z', int(raw_pos[0][0]), i)
-    summary_writer.add_scalar('offset_y', int(raw_pos[0][1]), i)
-    summary_writer.add_scalar('offset_x', int(raw_pos[0][2]), i)
-    summary_writer.add_scalar('shape_z', int(raw_pos[1][0]), i)
-    summary_writer.add_scalar('shape_y', int(raw_pos[1][1]), i)
-    summary_writer.add_scalar('shape_x', int(raw_pos[1][2]), i)
+@ ex.capture
+def metrics_setup(_config, _run, run_dir):
+    """Loggers for the metrics of the run, written to sacred and a jsonl
+    file, and for per-iteration debug values, written to tensorboard and a
+    jsonl file. Only the debug values go to tensorboard, hence each tag is
+    written once, to a single event file."""
+
+    runs = os.path.expanduser(_config['directories']['runs'])
+    debug_logdir = os.path.join(runs, 'tensorboard', run_dir, 'debug')
+    logger.info(f"{debug_logdir=}")
+    flush_every = float(_config['sacred']['flush_every'])
+
+    metrics = fos.tracking.MetricsLogger(
+        sinks=[
+            fos.tracking.SacredSink(_run),
+            fos.tracking.JsonlSink(
+                os.path.join(runs, 'metrics', f"{run_dir}.jsonl")),
+        ],
+        flush_every=flush_every
+    )
+    debug_metrics = fos.tracking.MetricsLogger(
+        sinks=[
+            fos.tracking.TensorboardSink(debug_logdir),
+            fos.tracking.JsonlSink(
+                os.path.join(runs, 'metrics', f"{run_dir}_debug.jsonl")),
+        ],
+        flush_every=flush_every
+    )
+    return metrics, debug_metrics
 
 
-def log_tb_batch_labels_balance(summary_writer, i, labels, num_classes):
-    for c in range(num_classes):
-        pct = np.sum(labels == c) / np.prod(labels.shape)
-        summary_writer.add_scalar(f'pct_class_{c}', pct, i)
+def get_rank():
+    return dist.get_rank() if dist.is_initialized() else 0
 
 
 @ ex.main
@@ -439,79 +468,114 @@ def train(_config, _run, _seed):
         val_data_config:
     """
 
+    rank = get_rank()
+
     torch_setup(_config)
     log_data_config(_config, _run)
 
-    run_dir = directory_structure_setup(_config, _run)
+    if rank == 0:
+        run_dir = directory_structure_setup(_config, _run)
+    else:
+        run_dir = None
+    if dist.is_initialized():
+        # all ranks train the run of rank 0, on distinct samples
+        shared = [run_dir, _seed]
+        dist.broadcast_object_list(shared, src=0)
+        run_dir, _seed = shared
+        logger.info(f"Rank {rank} of {dist.get_world_size()}, {run_dir=}")
 
     model = model_setup(_config, _run)
     training = training_setup(
-        _config, _run, _seed, run_dir=run_dir, model=model)
-
-    validations = multiple_validation_setup(
-        _config, _run, _seed, run_dir=run_dir, model=model)
+        _config, _run, _seed + rank, run_dir=run_dir, model=model)
+
+    def validation_metrics(validation, iteration, mode):
+        if iteration % _config['sacred']['log_every'] != 0:
+            return {}
+        # accumulated block by block by the scan
+        return dice_metrics_from_counts(
+            validation.confusion_counts.thresholded, mode)
+
+    # validation and debug logs only on rank 0
+    if rank == 0:
+        validation = fos.pipeline.BackgroundValidation(
+            model,
+            multiple_validation_setup(
+                _config, _run, _seed, run_dir=run_dir, model=model),
+            metrics_fn=validation_metrics,
+            asynchronous=bool(_config['validation']['background'])
+        )
+    else:
+        validation = None
     validation_loss = float('inf')
 
-    debug_logdir = os.path.join(
-        os.path.expanduser(_config['directories']['runs']),
-        'tensorboard',
-        run_dir,
-        'debug'
-    )
-    logger.info(f"{debug_logdir=}")
-    debug_writer = tensorboardX.SummaryWriter(
-        debug_logdir
-    )
+    # forked before the training pipeline initializes CUDA, and before
+    # starting the metrics thread
+    if validation is not None:
+        validation.start()
+
+    if rank == 0:
+        metrics, debug_metrics = metrics_setup(_config, _run, run_dir)
+    else:
+        metrics, debug_metrics = None, None
+
+    def log_validation_results(results):
+        # one value per validation, under the iteration of its weights
+        for name, value, iteration in results:
+            metrics.log_scalar(name, value, iteration, aggregate=False)
 
     # ### START ITERATING ### #
     with gp.build(training.pipeline) as p:
 
-        # Hack for validation in continued training
-        logger.info((
-            f"Training iteration is {training.train_node.iteration}, "
-            "copying into validation pipeline"
-        ))
         start_iteration = training.train_node.iteration
+        logger.info(f"Training iteration is {start_iteration}")
 
-        # build validation pipelines
-        for idx_pipeline, validation in enumerate(validations):
-            try:
-                validations[idx_pipeline].pipeline.setup()
-            except BaseException:
-                logger.error(
-                    f"something went wrong during the setup of pipeline {idx_pipeline}, calling tear down")
-                validations[idx_pipeline].pipeline.internal_teardown()
-                logger.debug("tear down completed")
-                raise
-
-            validations[idx_pipeline].validation_loss.iteration = start_iteration
+        # throughput of the training pipeline, without validation
+        batch_size = int(_config['training']['batch_size'])
+        train_seconds = 0.0
+        train_iterations = 0
 
         # from 0 to iterations+1, for logging once more in the end.
         for i in range(start_iteration,
                        _config['training']['iterations'] + 1):
+            start = now()
             batch = p.request_batch(training.request)
+            train_seconds += now() - start
+            train_iterations += 1
             # logger.debug(f'batch {i}:\n{batch}')
 
-            log_tb_batch_position(
-                debug_writer, i, batch[gp.ArrayKey('RAW_POS')].data)
-            log_tb_batch_labels_balance(
-                debug_writer, i, batch[gp.ArrayKey('LABELS')].data,
-                _config['data']['num_classes'])
+            # buffered and written every flush_every seconds
+            if debug_metrics is not None:
+                log_batch_position(
+                    debug_metrics, i, batch[gp.ArrayKey('RAW_POS')].data)
+                log_labels_balance(
+                    debug_metrics, i, batch[gp.ArrayKey('LABELS')].data,
+                    _config['data']['num_classes'])
 
-            if i % _config['sacred']['log_every'] == 0:
+            if rank == 0 and i % _config['sacred']['log_every'] == 0:
                 # Convention for loss: pos 0 is the final loss used for
                 # backprop, other positions are intermediate/partial losses
                 for l_i, l in enumerate(np.atleast_1d(batch.loss)):
-                    _run.log_scalar(f"loss_train_{l_i}", l, i)
-
+                    metrics.log_scalar(
+                        f"loss_train_{l_i}", l, i, aggregate=False)
                 log_labels_balance(
-                    _run,
-                    labels=batch[gp.ArrayKey('LABELS')].data,
-                    num_classes=_config['data']['num_classes'],
-                    iteration=i)
+                    metrics, i, batch[gp.ArrayKey('LABELS')].data,
+                    _config['data']['num_classes'])
+
+                samples_per_second = \
+                    batch_size * train_iterations / train_seconds
+                metrics.log_scalar(
+                    "samples_per_second", samples_per_second, i,
+                    aggregate=False)
+                logger.info((
+                    f"Training throughput at batch size {batch_size}: "
+                    f"{samples_per_second:.3f} samples/s"
+                ))
+                train_seconds = 0.0
+                train_iterations = 0
+
                 # Log metrics training
                 log_metrics(
-                    _run,
+                    metrics,
                     target=batch[gp.ArrayKey('LABELS')].data,
                     prediction_probas=batch[gp.ArrayKey(
                         'PREDICTIONS')].data,
@@ -521,55 +585,88 @@ def train(_config, _run, _seed):
                     mode='train'
                 )
 
-            if i % _config['validation']['validate_every'] == 0:
-                model.eval()
+            if validation is not None:
+                log_validation_results(validation.poll())
+                if i % _config['validation']['validate_every'] == 0:
+                    # runs on a copy of the weights, training continues
+                    validation.validate(i)
 
-                # loop over validation objects; each one has a pipeline
-                for val_idx, validation in enumerate(validations):
+                    # TODO there is no single validation loss to save any
+                    # more. Extend to multiclass.
+                    # validation_loss = val_losses[0]
 
-                    # current validation pipeline
-                    val_p = validation.pipeline
+        if validation is not None:
+            logger.info("Waiting for pending validations ...")
+            log_validation_results(validation.close())
 
-                    val_request = gp.BatchRequest()
-                    provider_spec = validation.scan.spec
-                    for key, spec in provider_spec.items():
-                        if key in validation.request:
-                            request_spec = spec.copy()
-                            request_spec.dtype = None
-                            val_request[key] = request_spec
+    if metrics is not None:
+        metrics.close()
+        debug_metrics.close()
 
-                    val_batch = val_p.request_batch(val_request)
+    return log_result(_run, metric_val=validation_loss)
 
-                    val_losses = np.atleast_1d(val_batch.loss)
-                    for l_i, l in enumerate(val_losses):
-                        _run.log_scalar(
-                            f"loss_val_ds_{val_idx}_type_{l_i}", l, i)
 
-                    # TODO there is no single validation loss to save any more.
-                    # Extend to multiclass.
-                    # validation_loss = val_losses[0]
+def distributed_setup():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '--world_size',
+        type=int,
+        default=1,
+        help=('Number of processes for data-parallel training, '
+              'on all machines together.')
+    )
+    parser.add_argument(
+        '--nproc_per_node',
+        type=int,
+        help=('Number of processes to start on this machine. '
+              'Defaults to world_size.')
+    )
+    parser.add_argument(
+        '--node_rank',
+        type=int,
+        default=0,
+        help=('Index of this machine, its processes have the ranks '
+              'node_rank * nproc_per_node + [0, nproc_per_node). '
+              'Validation, checkpoints and logs are handled by rank 0.')
+    )
+    parser.add_argument(
+        '--init_method',
+        default='tcp://127.0.0.1:29500',
+        help='Address of rank 0 to initialize the process group.'
+    )
+    parser.add_argument(
+        '--dist_backend',
+        default='gloo',
+        help='Backend of the process group, gloo or nccl.'
+    )
 
-                    if i % _config['sacred']['log_every'] == 0:
-                        log_metrics(
-                            _run,
-                            target=val_batch[gp.ArrayKey('LABELS')].data,
-                            prediction_probas=val_batch[gp.ArrayKey(
-                                'PREDICTIONS')].data,
-                            mask=val_batch[gp.ArrayKey('MASK')].data,
-                            metric_mask=val_batch[gp.ArrayKey(
-                                'METRIC_MASK')].data,
-                            iteration=i,
-                            mode=f'validation_ds_{val_idx}'
-                        )
-                model.train()
-
-        # release (teardown) validation pipelines
-        logger.debug("tearing down val pipelines")
-        for idx_pipeline, validation in enumerate(validations):
-            validations[idx_pipeline].pipeline.internal_teardown()
-        logger.debug("tear down completed")
+    args, remaining_argv = parser.parse_known_args()
+    sys.argv = [sys.argv[0], *remaining_argv]
 
-    return log_result(_run, metric_val=validation_loss)
+    if args.nproc_per_node is None:
+        args.nproc_per_node = args.world_size
+
+    return args
+
+
+def run_distributed(local_rank, args):
+    rank = args.node_rank * args.nproc_per_node + local_rank
+    os.environ['RANK'] = str(rank)
+    os.environ['LOCAL_RANK'] = str(local_rank)
+    os.environ['WORLD_SIZE'] = str(args.world_size)
+
+    dist.init_process_group(
+        backend=args.dist_backend,
+        init_method=args.init_method,
+        rank=rank,
+        world_size=args.world_size
+    )
+    try:
+        main()
+    finally:
+        dist.destroy_process_group()
 
 
 def observer_setup():
@@ -591,7 +688,10 @@ def observer_setup():
     args, remaining_argv = parser.parse_known_args()
     sys.argv = [sys.argv[0], *remaining_argv]
 
-    # create experiment observers
+    # create experiment observers, the run is tracked by rank 0
+    if get_rank() != 0:
+        return args.mongodb
+
     if args.mongodb:
         logger.info(f"Attach Mongo observer")
         with open(args.mongodb) as f:
@@ -725,7 +825,7 @@ def experiment_setup(mongodb_cfg_file):
         return None
 
 
-if __name__ == '__main__':
+def main():
     mongodb_cfg_file = observer_setup()
     config = experiment_setup(mongodb_cfg_file)
     if config is not None:
@@ -740,3 +840,15 @@ if __name__ == '__main__':
     argv = [*sys.argv, *sacred_default_flags]
 
     ex.run_commandline(argv)
+
+
+if __name__ == '__main__':
+    distributed_args = distributed_setup()
+    if distributed_args.world_size > 1:
+        torch.multiprocessing.spawn(
+            run_distributed,
+            args=(distributed_args,),
+            nprocs=distributed_args.nproc_per_node
+        )
+    else:
+        main()
@@ -0,0 +1,314 @@
+"""Find the fastest block size for prediction with a valid-padded U-Net.
+
+Enumerates the cubic input sizes that the model configuration accepts, with
+their output sizes, benchmarks the throughput and peak memory of a forward
+pass for each of them on this machine, and writes the fastest one that fits
+into the memory budget to the prediction config.
+"""
+
+import logging
+import multiprocessing
+import re
+import resource
+from time import time as now
+
+import torch
+import yaml
+import configargparse as argparse
+
+import incasem as fos
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def enumerate_shapes(model, min_size, max_size, dims=3):
+    """Cubic (input size, output size) pairs accepted by the model, with the
+    smallest input size for each output size.
+
+    Shapes are computed on the meta device, without allocating any data.
+    """
+
+    model = model.to('meta')
+
+    inputs_per_output = {}
+    for size in range(min_size, max_size + 1):
+        x = torch.empty((1, 1) + (size,) * dims, device='meta')
+        try:
+            with torch.no_grad():
+                out = fos.torch.models.first_output(model(x))
+        except (RuntimeError, AssertionError):
+            # downsampling or cropping is not possible for this size
+            continue
+
+        out_size = out.shape[-1]
+        if out_size > 0:
+            inputs_per_output.setdefault(out_size, size)
+
+    return sorted(
+        (input_size, output_size)
+        for output_size, input_size in inputs_per_output.items()
+    )
+
+
+def benchmark_worker(
+        model_config,
+        voxel_size,
+        input_shape,
+        device,
+        num_threads,
+        repetitions,
+        queue):
+    try:
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        use_cuda = device == 'cuda'
+
+        model = fos.torch.models.build_model(
+            model_config, voxel_size).eval().to(device)
+        x = torch.rand((1, 1) + tuple(input_shape), device=device)
+
+        with torch.inference_mode():
+            # warm up, e.g. for cudnn autotuning
+            model(x)
+            if use_cuda:
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+
+            start = now()
+            for _ in range(repetitions):
+                model(x)
+            if use_cuda:
+                torch.cuda.synchronize()
+            seconds = (now() - start) / repetitions
+
+        if use_cuda:
+            peak_bytes = torch.cuda.max_memory_allocated()
+        else:
+            # kilobytes on linux
+            peak_bytes = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss * 1024
+
+        queue.put((seconds, peak_bytes, None))
+    except RuntimeError as e:
+        # most likely out of memory
+        queue.put((None, None, str(e)))
+
+
+def benchmark(
+        model_config,
+        voxel_size,
+        input_shape,
+        device,
+        num_threads,
+        repetitions):
+    """Run the benchmark in a fresh process, so that the peak memory is not
+    affected by previous candidates."""
+
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(
+        target=benchmark_worker,
+        args=(
+            model_config,
+            voxel_size,
+            input_shape,
+            device,
+            num_threads,
+            repetitions,
+            queue
+        )
+    )
+    process.start()
+    process.join()
+
+    if process.exitcode != 0:
+        return None, None, f"exit code {process.exitcode}"
+    return queue.get()
+
+
+def write_block_size(prediction_config, input_size, output_size, dims=3):
+    """Replace the block size in the prediction config, keeping comments and
+    formatting of the file."""
+
+    with open(prediction_config) as f:
+        text = f.read()
+
+    for name, size in [
+        ('input_size_voxels', input_size),
+        ('output_size_voxels', output_size),
+    ]:
+        text, count = re.subn(
+            rf'^(\s*{name}:).*$',
+            rf'\1 {list((size,) * dims)}',
+            text,
+            flags=re.MULTILINE
+        )
+        if count != 1:
+            raise ValueError(
+                f"Expected a single {name} in {prediction_config}, "
+                f"found {count}.")
+
+    with open(prediction_config, 'w') as f:
+        f.write(text)
+
+
+def autotune_block_size(
+        training_config,
+        prediction_config,
+        min_size,
+        max_size,
+        memory_budget,
+        device,
+        num_threads,
+        repetitions,
+        dry_run):
+
+    with open(training_config) as f:
+        config = yaml.safe_load(f)
+    model_config = config['model']
+    voxel_size = config['data']['voxel_size']
+
+    shapes = enumerate_shapes(
+        fos.torch.models.build_model(model_config, voxel_size).eval(),
+        min_size,
+        max_size
+    )
+    if not shapes:
+        raise ValueError(
+            f"No valid input size between {min_size} and {max_size}.")
+    logger.info(f"Valid (input, output) sizes: {shapes}")
+
+    budget_bytes = memory_budget * 1024**3
+    results = []
+    for input_size, output_size in shapes:
+        seconds, peak_bytes, error = benchmark(
+            model_config,
+            voxel_size,
+            (input_size,) * 3,
+            device,
+            num_threads,
+            repetitions
+        )
+        if error is not None:
+            logger.info(f"{input_size} -> {output_size}: failed ({error})")
+            # larger blocks will not fit either
+            break
+
+        voxels_per_second = output_size**3 / seconds
+        fits = peak_bytes <= budget_bytes
+        results.append(
+            (input_size, output_size, voxels_per_second, peak_bytes, fits))
+        logger.info((
+            f"{input_size} -> {output_size}: "
+            f"{voxels_per_second:.3e} voxels/s, "
+            f"peak memory {peak_bytes / 1024**3:.2f} GB"
+            f"{'' if fits else ' (over budget)'}"
+        ))
+
+        if not fits:
+            break
+
+    candidates = [r for r in results if r[4]]
+    if not candidates:
+        raise RuntimeError(
+            f"No block size fits into the budget of {memory_budget} GB.")
+
+    input_size, output_size, voxels_per_second, peak_bytes, _ = max(
+        candidates, key=lambda r: r[2])
+    logger.info((
+        f"Fastest block size within {memory_budget} GB: "
+        f"{input_size} -> {output_size}, {voxels_per_second:.3e} voxels/s, "
+        f"{peak_bytes / 1024**3:.2f} GB"
+    ))
+
+    if not dry_run:
+        write_block_size(prediction_config, input_size, output_size)
+        logger.info(f"Updated {prediction_config}")
+
+    return results
+
+
+def parse_args():
+    p = argparse.ArgParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add('--config', is_config_file=True, help='config file path')
+    p.add(
+        '--training_config',
+        default='../02_train/config_training.yaml',
+        help='YAML file with the model and data sections of the training.'
+    )
+    p.add(
+        '--prediction_config',
+        default='config_prediction.yaml',
+        help='Prediction config to write the block size to.'
+    )
+    p.add(
+        '--min_size',
+        type=int,
+        default=100,
+        help='Smallest input edge length to consider, in voxels.'
+    )
+    p.add(
+        '--max_size',
+        type=int,
+        default=300,
+        help='Largest input edge length to consider, in voxels.'
+    )
+    p.add(
+        '--memory_budget',
+        '-m',
+        type=float,
+        required=True,
+        help=(
+            'Peak memory of the model process in GB, RAM on cpu or '
+            'allocated memory on cuda.'
+        )
+    )
+    p.add(
+        '--device',
+        default='cpu',
+        choices=['cpu', 'cuda'],
+    )
+    p.add(
+        '--num_threads',
+        type=int,
+        default=None,
+        help='Number of torch threads on cpu.'
+    )
+    p.add(
+        '--repetitions',
+        type=int,
+        default=3,
+        help='Number of timed forward passes per block size.'
+    )
+    p.add(
+        '--dry_run',
+        action='store_true',
+        help='Only report the results, do not update the prediction config.'
+    )
+
+    args = p.parse_args()
+    logger.info(f'\n{p.format_values()}')
+
+    return args
+
+
+def main():
+    args = parse_args()
+    autotune_block_size(
+        training_config=args.training_config,
+        prediction_config=args.prediction_config,
+        min_size=args.min_size,
+        max_size=args.max_size,
+        memory_budget=args.memory_budget,
+        device=args.device,
+        num_threads=args.num_threads,
+        repetitions=args.repetitions,
+        dry_run=args.dry_run
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""Export a training checkpoint as a frozen TorchScript model for prediction.
+
+The model is traced for the block size of the prediction config, including
+the batch dimension of micro-batching and test-time augmentation, frozen and
+optimized for inference. Set ``prediction.torchscript`` in the prediction
+config to the written file to predict with it.
+
+``--input_size_voxels`` and ``--batch_size`` override the prediction config,
+e.g. to export the cheap model of a coarse-to-fine cascade
+(``prediction.cascade``), which runs on single blocks.
+
+With ``--repetitions``, the forward pass of the eager model and the exported
+model are benchmarked on the production block size.
+"""
+
+import logging
+from time import time as now
+
+import torch
+import yaml
+import configargparse as argparse
+
+import incasem as fos
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def time_forward(model, x, repetitions):
+    with torch.inference_mode():
+        # warm up, and let the profiling executor specialize the graph
+        for _ in range(2):
+            fos.torch.models.first_output(model(x))
+
+        start = now()
+        for _ in range(repetitions):
+            fos.torch.models.first_output(model(x))
+        return (now() - start) / repetitions
+
+
+def benchmark(model, exported, input_shape, channels_last, repetitions):
+    x = torch.rand(input_shape)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last_3d)
+        x = x.contiguous(memory_format=torch.channels_last_3d)
+
+    seconds_eager = time_forward(model, x, repetitions)
+    seconds_exported = time_forward(exported, x, repetitions)
+
+    logger.info((
+        f"Forward pass of {tuple(input_shape)}: "
+        f"eager {seconds_eager:.3f} s, "
+        f"TorchScript {seconds_exported:.3f} s, "
+        f"speedup {seconds_eager / seconds_exported:.2f}x"
+    ))
+    return seconds_eager, seconds_exported
+
+
+def export(
+        training_config,
+        prediction_config,
+        checkpoint,
+        output,
+        optimize,
+        channels_last,
+        num_threads,
+        repetitions,
+        input_size_voxels=None,
+        blocks_per_pass=None):
+
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    with open(training_config) as f:
+        training_config = yaml.safe_load(f)
+    with open(prediction_config) as f:
+        prediction_config = yaml.safe_load(f)['prediction']
+
+    if input_size_voxels is None:
+        input_size_voxels = prediction_config['input_size_voxels']
+    if blocks_per_pass is None:
+        blocks_per_pass = fos.torch.blocks_per_pass(prediction_config)
+    input_shape = (blocks_per_pass, 1) + tuple(input_size_voxels)
+
+    model = fos.torch.models.load_model(
+        training_config['model'],
+        training_config['data']['voxel_size'],
+        checkpoint
+    )
+    exported = fos.torch.export_torchscript(
+        model,
+        input_shape,
+        output,
+        optimize=optimize,
+        channels_last=channels_last,
+        metadata={
+            'checkpoint': checkpoint,
+            'model': training_config['model'],
+        }
+    )
+
+    if repetitions > 0:
+        # the artifact as Predict would load it
+        exported, _ = fos.torch.load_torchscript(output)
+        benchmark(model, exported, input_shape, channels_last, repetitions)
+
+
+def parse_args():
+    p = argparse.ArgParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add('--config', is_config_file=True, help='config file path')
+    p.add(
+        '--training_config',
+        default='../02_train/config_training.yaml',
+        help='YAML file with the model and data sections of the training.'
+    )
+    p.add(
+        '--prediction_config',
+        default='config_prediction.yaml',
+        help='Prediction config with the block size to export for.'
+    )
+    p.add(
+        '--checkpoint',
+        '-c',
+        required=True,
+        help='Training checkpoint with the model weights.'
+    )
+    p.add(
+        '--output',
+        '-o',
+        required=True,
+        help='File to write the TorchScript model to.'
+    )
+    p.add(
+        '--input_size_voxels',
+        type=int,
+        nargs=3,
+        default=None,
+        help='Input block size, defaults to the one of the prediction config.'
+    )
+    p.add(
+        '--batch_size',
+        type=int,
+        default=None,
+        help=(
+            'Blocks per forward pass, defaults to micro-batching and '
+            'test-time augmentation of the prediction config.'
+        )
+    )
+    p.add(
+        '--no_optimize',
+        action='store_true',
+        help='Only freeze, do not optimize the model for inference on cpu.'
+    )
+    p.add(
+        '--channels_last',
+        action='store_true',
+        help='Trace with the channels_last_3d memory format.'
+    )
+    p.add(
+        '--num_threads',
+        type=int,
+        default=None,
+        help='Number of torch threads on cpu.'
+    )
+    p.add(
+        '--repetitions',
+        type=int,
+        default=0,
+        help=(
+            'Number of timed forward passes to compare with the eager model, '
+            '0 to skip the benchmark.'
+        )
+    )
+
+    args = p.parse_args()
+    logger.info(f'\n{p.format_values()}')
+
+    return args
+
+
+def main():
+    args = parse_args()
+    export(
+        training_config=args.training_config,
+        prediction_config=args.prediction_config,
+        checkpoint=args.checkpoint,
+        output=args.output,
+        optimize=not args.no_optimize,
+        channels_last=args.channels_last,
+        num_threads=args.num_threads,
+        repetitions=args.repetitions,
+        input_size_voxels=args.input_size_voxels,
+        blocks_per_pass=args.batch_size
+    )
+
+
+if __name__ == '__main__':
+    main()
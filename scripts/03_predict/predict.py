@@ -6,7 +6,6 @@ import json
 from pymongo import MongoClient
 import configargparse as argparse
 import torch
-import numpy as np
 
 import sacred
 
@@ -30,50 +29,8 @@ def torch_setup(_config):
 
 @ex.capture
 def model_setup(_config, _run):
-    model_type = _config['model']['type']
-    if model_type == 'OneConv3d':
-        model = fos.torch.models.OneConv3d(
-            out_channels=_config['model']['num_fmaps_out']
-        )
-    elif model_type == 'Unet':
-        model = fos.torch.models.Unet(
-            in_channels=1,
-            num_fmaps=int(_config['model']['num_fmaps']),
-            fmap_inc_factor=int(_config['model']['fmap_inc_factor']),
-            downsample_factors=tuple(
-                tuple(i) for i in _config['model']['downsample_factors']
-            ),
-            # kernel_size_down=None,
-            # kernel_size_up=None,
-            # activation='ReLU',
-            voxel_size=_config['data']['voxel_size'],
-            num_fmaps_out=_config['model']['num_fmaps_out'],
-            # num_heads=1,
-            constant_upsample=_config['model']['constant_upsample'],
-            padding='valid'
-        )
-    elif model_type == 'MultitaskUnet':
-        model = fos.torch.models.MultitaskUnet(
-            _config['model']['num_fmaps_out'],
-            _config['model']['num_fmaps_out_auxiliary'],
-            dims=3,
-            in_channels=1,
-            num_fmaps=int(_config['model']['num_fmaps']),
-            fmap_inc_factor=int(_config['model']['fmap_inc_factor']),
-            downsample_factors=tuple(
-                tuple(i) for i in _config['model']['downsample_factors']
-            ),
-            # kernel_size_down=None,
-            # kernel_size_up=None,
-            # activation='ReLU',
-            voxel_size=_config['data']['voxel_size'],
-            # num_heads=1,
-            constant_upsample=_config['model']['constant_upsample'],
-            padding='valid'
-        )
-    else:
-        raise ValueError(f"Model type {model_type} does not exist.")
-
+    model = fos.torch.models.build_model(
+        _config['model'], _config['data']['voxel_size'])
     model.eval()
 
     total_params = sum(p.numel()
@@ -114,7 +71,8 @@ def get_checkpoint(checkpoint_file):
 
 
 @ex.capture
-def multiple_prediction_setup(_config, _run, run_path, model_, checkpoint):
+def multiple_prediction_setup(_config, _run, run_path, model_, checkpoint,
+                              count_confusions=False):
     prediction_datasets = fos.utils.create_multiple_config(
         _config['prediction']['data'])
     pred_setups = []
@@ -126,18 +84,44 @@ def multiple_prediction_setup(_config, _run, run_path, model_, checkpoint):
                 run_path,
                 model_,
                 checkpoint,
-                pred_ds)
+                pred_ds,
+                count_confusions)
         )
     return pred_setups
 
 
+@ex.capture
+def cascade_setup(_config, pred_dataset):
+    """Coarse pass of the cascade, before building the prediction pipeline."""
+    cascade = _config['prediction']['cascade']
+    if cascade['torchscript'] is None:
+        return None
+
+    device = str(_config['prediction']['torch']['device'])
+    return fos.pipeline.predict_cascade_indices(
+        data_config=pred_dataset[0],
+        data_path_prefix=os.path.expanduser(_config['directories']['data']),
+        voxel_size=_config['data']['voxel_size'],
+        torchscript=cascade['torchscript'],
+        factor=cascade['factor'],
+        threshold=cascade['threshold'],
+        margin_voxels=cascade['margin_voxels'],
+        device='cpu' if device == 'cpu' else 'cuda',
+        gpus=[] if device == 'cpu' else [int(device)],
+        num_workers=_config['prediction']['num_workers'],
+    )
+
+
 @ex.capture
 def prediction_setup(_config, _run, run_path, model_,
-                     checkpoint, pred_dataset):
+                     checkpoint, pred_dataset, count_confusions=False):
     pipeline_type = {
         'baseline': fos.pipeline.PredictionBaseline,
     }[_config['prediction']['pipeline']]
 
+    device = str(_config['prediction']['torch']['device'])
+    cascade_indices = cascade_setup(_config, pred_dataset=pred_dataset)
+
     prediction = pipeline_type(
         data_config=pred_dataset,
         run_id=run_path,
@@ -150,9 +134,29 @@ def prediction_setup(_config, _run, run_path, model_,
         input_size_voxels=_config['prediction']['input_size_voxels'],
         output_size_voxels=_config['prediction']['output_size_voxels'],
         checkpoint=checkpoint,
+        micro_batch=_config['prediction']['micro_batch'],
+        num_workers=_config['prediction']['num_workers'],
+        device='cpu' if device == 'cpu' else 'cuda',
+        cpu_backend=(
+            _config['prediction']['torch']['cpu'] if device == 'cpu' else None
+        ),
+        pipelined=_config['prediction']['pipelined']['enabled'],
+        read_workers=_config['prediction']['pipelined']['read_workers'],
+        read_ahead=_config['prediction']['pipelined']['read_ahead'],
+        write_workers=_config['prediction']['pipelined']['write_workers'],
+        write_queue_size=_config['prediction']['pipelined'][
+            'write_queue_size'],
+        output_format=_config['prediction']['output_format'],
+        tta_mirror=_config['prediction']['tta']['mirror'],
+        tta_transpose=_config['prediction']['tta']['transpose'],
+        skip_masked=_config['prediction']['skip_masked'],
+        mask_index_cell_shape=_config['prediction']['mask_index_cell_shape'],
+        torchscript=_config['prediction']['torchscript'],
+        device_postprocess=_config['prediction']['device_postprocess'],
+        cascade_indices=cascade_indices,
+        gpus=[] if device == 'cpu' else [int(device)],
+        count_confusions=count_confusions,
     )
-    prediction.predict.gpus = [int(_config['prediction']['torch']['device'])]
-    prediction.scan.num_workers = _config['prediction']['num_workers']
 
     return prediction
 
@@ -177,64 +181,25 @@ def remove_context(batch, input_size_voxels, output_size_voxels):
 @ex.capture
 def log_metrics(
         _run,
-        target,
-        prediction_probas,
-        mask,
-        metric_mask,
+        confusion,
+        thresholded,
         run_path,
         iteration,
         mode):
+    """Log the metrics of the confusion counts accumulated by
+    ``fos.gunpowder.ConfusionCounts`` over all blocks of a prediction."""
 
-    mask = np.logical_and(mask.astype(bool), metric_mask.astype(bool))
-
-    jaccard_scores = []
-    for i in range(prediction_probas.shape[0]):
-        jac_score = fos.metrics.pairwise_distance_metric_thresholded(
-            target=target,
-            prediction_probas=prediction_probas,
-            metric='jaccard',
-            threshold=0.5,
-            foreground_class=i,
-            mask=mask
-        )
-        jaccard_scores.append(jac_score)
+    jaccard_scores = fos.metrics.jaccard_from_counts(thresholded)
     for label, score in enumerate(jaccard_scores):
         _run.log_scalar(f"jaccard_class_{label}_{mode}", score, iteration)
         logger.info(f"{mode} | Jaccard score class {label}: {score}")
 
-    dice_scores = []
-    for i in range(prediction_probas.shape[0]):
-        dic_score = fos.metrics.pairwise_distance_metric_thresholded(
-            target=target,
-            prediction_probas=prediction_probas,
-            metric='dice',
-            threshold=0.5,
-            foreground_class=i,
-            mask=mask
-        )
-        dice_scores.append(dic_score)
+    dice_scores = fos.metrics.dice_from_counts(thresholded)
     for label, score in enumerate(dice_scores):
         _run.log_scalar(f"dice_class_{label}_{mode}", score, iteration)
         logger.info(f"{mode} | Dice score class {label}: {score}")
 
-    # conf_mat = fos.metrics.confusion_matrix(
-        # target,
-        # prediction_probas,
-        # mask
-    # )
-    # for i in range(conf_mat.shape[0]):
-        # for j in range(conf_mat.shape[1]):
-            # _run.log_scalar(f"confusm_t{i}_p{j}_{mode}",
-                            # conf_mat[i, j], iteration)
-            # logger.info(
-                # f"{mode} | Confusion matrix true {i} pred {j}: {conf_mat[i,
-                # j]}")
-
-    precision_recall = fos.metrics.precision_recall(
-        target,
-        prediction_probas,
-        mask
-    )
+    precision_recall = fos.metrics.precision_recall_from_counts(confusion)
     for i, (p, r) in enumerate(precision_recall):
         _run.log_scalar(f"precision_{i}_{mode}", p, iteration)
         logger.info(
@@ -243,66 +208,6 @@ def log_metrics(
         logger.info(
             f"{mode} | Recall class {i}: {r}")
 
-    # average_precision_scores = fos.metrics.average_precision(
-    # target,
-    # prediction_probas
-    # )
-    # for label, score in enumerate(average_precision_scores):
-    # _run.log_scalar(f"AP_class_{label}", score, 0)
-    # logger.info(f"Average precision class {label}: {score}")
-
-    # # Precision Recall
-
-    # pr_curves = fos.metrics.precision_recall(
-    # target,
-    # prediction_probas
-    # )
-
-    # temp_path = os.path.join('temp', run_path)
-    # os.makedirs(temp_path)
-    # for label, curve in pr_curves.items():
-    # plt.figure(label)
-    # plt.plot(curve['recall'], curve['precision'], label='PR curve')
-    # plt.plot(curve['recall'], curve['thresholds'], label='thresholds')
-    # plt.legend(loc='center')
-    # plt.grid()
-    # plt.xlabel('Recall')
-    # plt.ylabel('Precision / Threshold')
-    # plt.axis('square')
-
-    # plot_path = os.path.join(temp_path, f"pr_class_{label}.png")
-    # plt.savefig(plot_path)
-    # _run.add_artifact(plot_path)
-
-    # # Thresholded jaccard based on pr curve
-    # idx = np.argwhere(
-    # np.diff(
-    # np.sign(
-    # curve['recall'] -
-    # curve['precision']))).flatten()[0]
-
-    # threshold = curve['thresholds'][idx]
-    # _run.log_scalar(f"pr_based_threshold_class_{label}", threshold, 0)
-    # logger.info(f"PR-based threshold class {label}: {threshold}")
-
-    # # Jaccard score
-
-    # jaccard_thresholded = fos.metrics.jaccard_thresholded(
-    # target,
-    # prediction_probas,
-    # threshold,
-    # pos_label=label
-    # )
-    # _run.log_scalar(
-    # f"thresholded_jaccard_class_{label}",
-    # jaccard_thresholded,
-    # 0)
-    # logger.info(
-    # f"Thresholded Jaccard score class {label}: {jaccard_thresholded}")
-
-    # # remove the plot objects
-    # shutil.rmtree(temp_path)
-
 
 @ex.main
 def predict(_config, _run, checkpoint=None, iteration=0, run_path=None):
@@ -315,53 +220,55 @@ def predict(_config, _run, checkpoint=None, iteration=0, run_path=None):
 
     if run_path is None:
         run_path = directory_structure_setup(_config, _run)
-    model = model_setup(_config, _run)
-
-    if checkpoint is None:
-        checkpoint = get_checkpoint(_config['prediction']['checkpoint'])
-
-    predictions = multiple_prediction_setup(
-        _config, _run, run_path=run_path, model_=model, checkpoint=checkpoint)
+    if _config['prediction']['torchscript']:
+        # the exported model contains the weights
+        model = None
+    else:
+        model = model_setup(_config, _run)
+
+        if checkpoint is None:
+            checkpoint = get_checkpoint(_config['prediction']['checkpoint'])
+
+    do_log_metrics = _config['prediction']['log_metrics']
+    if do_log_metrics and _config['prediction']['multi_roi']:
+        logger.warning(
+            "Metrics are not logged in multi-ROI prediction.")
+        do_log_metrics = False
+    if do_log_metrics and \
+            _config['prediction']['cascade']['torchscript'] is not None:
+        logger.warning(
+            "Metrics are not logged in cascade prediction.")
+        do_log_metrics = False
+
+    if _config['prediction']['multi_roi']:
+        # all datasets in one pipeline, with a single model
+        predictions = [
+            prediction_setup(
+                _config,
+                _run,
+                run_path,
+                model,
+                checkpoint,
+                (_config['prediction']['data'], None),
+                count_confusions=do_log_metrics
+            )
+        ]
+    else:
+        predictions = multiple_prediction_setup(
+            _config, _run, run_path=run_path, model_=model,
+            checkpoint=checkpoint, count_confusions=do_log_metrics)
 
     for idx_pipeline, prediction in enumerate(predictions):
         with gp.build(prediction.pipeline) as p:
-            request = gp.BatchRequest()
-
-            if _config['prediction']['log_metrics']:
-                provider_spec = p.spec
-                for key, spec in provider_spec.items():
-                    if key in prediction.request:
-                        request_spec = spec.copy()
-                        request_spec.dtype = None
-                        request[key] = request_spec
-
-            # labels_roi = request[gp.ArrayKey('LABELS')].roi
-            # predictions_roi = request[gp.ArrayKey('PREDICTIONS')].roi
-            # assert labels_roi == predictions_roi, \
-            # (f"{labels_roi=} and {predictions_roi=} do not match, "
-            # "probably due to some padding of the dataset "
-            # "while building the pipeline")
-
-            # logger.debug(f"Total request: {request}")
-
-            batch = p.request_batch(request)
-
-            # # explicitly remove context, even though it is already removed
-            # # as a side effect of the metric mask request at output_size
-            # batch = remove_context(
-            # batch,
-            # _config['prediction']['input_size_voxels'],
-            # _config['prediction']['output_size_voxels']
-            # )
-
-            # TODO load files from disk as daisy datasets
-            if _config['prediction']['log_metrics']:
+            # the scan writes all blocks, and the metrics are accumulated
+            # block by block, hence nothing is assembled here
+            p.request_batch(gp.BatchRequest())
+
+            if do_log_metrics:
                 log_metrics(
                     _run,
-                    target=batch[gp.ArrayKey('LABELS')].data,
-                    prediction_probas=batch[gp.ArrayKey('PREDICTIONS')].data,
-                    mask=batch[gp.ArrayKey('MASK')].data,
-                    metric_mask=batch[gp.ArrayKey('METRIC_MASK')].data,
+                    confusion=prediction.confusion_counts.confusion,
+                    thresholded=prediction.confusion_counts.thresholded,
                     run_path=run_path,
                     iteration=iteration,
                     mode=f'ds_{idx_pipeline}'
@@ -0,0 +1,318 @@
+"""Resumable blockwise prediction with daisy.
+
+Every finished output block is recorded in a ``BlockLedger``. Run again with
+the same ``--run_path`` to skip the blocks that are done already. To spread a
+volume over several machines that share a filesystem, start the script on each
+of them with the same ``--run_path``, the same ``--num_worker_groups`` and a
+distinct ``--worker_index``.
+"""
+
+import logging
+import math
+import os
+import sys
+import json
+from time import time as now
+
+import configargparse as argparse
+import daisy
+import gunpowder as gp
+
+import incasem as fos
+from incasem.tracking.sacred import ex
+from predict import (
+    torch_setup,
+    model_setup,
+    directory_structure_setup,
+    get_checkpoint,
+    prediction_setup,
+    observer_setup,
+    get_config_from_database,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# patch: suppress daisy warnings
+logging.getLogger('daisy.client').setLevel(logging.ERROR)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '--run_path',
+        default=None,
+        help=(
+            'Output path of the predictions relative to the predictions '
+            'prefix, e.g. train_0001/predict_0002. Pass the run path of an '
+            'interrupted prediction to resume it.'
+        )
+    )
+    parser.add_argument(
+        '--ledger_dir',
+        default=None,
+        help=(
+            'Directory of the block ledger. Defaults to '
+            '<predictions prefix>/ledgers/<run path>.'
+        )
+    )
+    parser.add_argument(
+        '--num_block_workers',
+        type=int,
+        default=1,
+        help='Number of daisy worker processes, each with its own model.'
+    )
+    parser.add_argument(
+        '--worker_index',
+        type=int,
+        default=0,
+        help='Index of this machine among the worker groups.'
+    )
+    parser.add_argument(
+        '--num_worker_groups',
+        type=int,
+        default=1,
+        help='Number of machines sharing the volume.'
+    )
+
+    return parser.parse_known_args()
+
+
+def snap_to_roi(write_roi, roi):
+    """Shift a block that overhangs ``roi`` back inside, like ``gp.Scan``
+    does for its last chunk in each dimension."""
+
+    begin = daisy.Coordinate(
+        min(b, e - s) for b, e, s in zip(
+            write_roi.get_begin(),
+            roi.get_end(),
+            write_roi.get_shape()
+        )
+    )
+    return daisy.Roi(begin, write_roi.get_shape())
+
+
+def in_worker_group(write_roi, roi, worker_index, num_worker_groups):
+    """Assign blocks to worker groups by contiguous slabs of block rows along
+    z, so that different groups never write to the same output chunk."""
+
+    block_shape = write_roi.get_shape()
+    rows = math.ceil(roi.get_shape()[0] / block_shape[0])
+    # a block snapped inside the roi overlaps the previous row, and hence
+    # belongs to its group
+    row = (write_roi.get_begin()[0] - roi.get_begin()[0]) // block_shape[0]
+
+    return row * num_worker_groups // rows == worker_index
+
+
+def predict_worker(prediction, ledger, roi, worker_index):
+    """Build the pipeline and load the model once, then predict the blocks
+    handed out by the daisy server."""
+
+    client = daisy.Client()
+    # the same ledger files on every resume
+    ledger.writer = \
+        f"{worker_index}_{daisy.Context.from_env()['worker_id']}"
+    predictions_key = gp.ArrayKey('PREDICTIONS')
+
+    with gp.build(prediction.pipeline) as pipeline:
+        while True:
+            with client.acquire_block() as block:
+                if block is None:
+                    break
+
+                start = now()
+                write_roi = snap_to_roi(block.write_roi, roi)
+                request = gp.BatchRequest()
+                request[predictions_key] = gp.ArraySpec(
+                    roi=gp.Roi(
+                        write_roi.get_offset(),
+                        write_roi.get_shape()
+                    )
+                )
+                pipeline.request_batch(request)
+
+                ledger.mark_done(
+                    block.block_id[1],
+                    roi=write_roi,
+                    duration=now() - start
+                )
+
+
+def predict_blockwise_dataset(
+        prediction,
+        ledger,
+        task_id,
+        num_block_workers,
+        worker_index,
+        num_worker_groups):
+
+    # one output block per scan chunk, the blocks are scheduled by daisy
+    prediction.scan.num_workers = 1
+
+    raw_roi = prediction.request[gp.ArrayKey('RAW')].roi
+    predictions_roi = prediction.request[gp.ArrayKey('PREDICTIONS')].roi
+
+    read_roi = daisy.Roi(
+        (0,) * len(raw_roi.get_shape()),
+        raw_roi.get_shape()
+    )
+    write_roi = daisy.Roi(
+        predictions_roi.get_offset() - raw_roi.get_offset(),
+        predictions_roi.get_shape()
+    )
+    context_neg = write_roi.get_begin() - read_roi.get_begin()
+    context_pos = read_roi.get_end() - write_roi.get_end()
+
+    roi = daisy.Roi(prediction.roi.get_offset(), prediction.roi.get_shape())
+    total_roi = roi.grow(context_neg, context_pos)
+
+    ledger.refresh()
+
+    def check_block(block):
+        if not in_worker_group(
+                snap_to_roi(block.write_roi, roi),
+                roi,
+                worker_index,
+                num_worker_groups):
+            return True
+        return ledger.is_done(block.block_id[1])
+
+    task = daisy.Task(
+        task_id=task_id,
+        total_roi=total_roi,
+        read_roi=read_roi,
+        write_roi=write_roi,
+        process_function=lambda: predict_worker(
+            prediction, ledger, roi, worker_index),
+        check_function=check_block,
+        read_write_conflict=True,
+        # overhanging blocks are snapped inside the roi by the workers,
+        # read-write conflicts keep them from running next to their neighbors
+        fit='overhang',
+        num_workers=num_block_workers,
+        max_retries=2,
+    )
+
+    start = now()
+    success = daisy.run_blockwise([task])
+    logger.info(f'Done in {now() - start} s, {len(ledger)} blocks in ledger')
+
+    if not success:
+        raise RuntimeError(
+            f"Some blocks of {task_id} failed, run again to resume.")
+
+
+@ex.main
+def predict_blockwise(_config, _run):
+    blockwise = _config['prediction']['blockwise']
+
+    if _config['prediction']['pipelined']['enabled']:
+        raise ValueError(
+            "Pipelined prediction reads ahead over the whole volume "
+            "and can not be combined with blockwise prediction.")
+    if _config['prediction']['log_metrics']:
+        logger.warning("Metrics are not logged in blockwise prediction.")
+    if _config['prediction']['multi_roi']:
+        logger.warning(
+            "Ignoring multi_roi, the datasets are predicted one after another.")
+
+    torch_setup(_config)
+    _run.add_artifact(_config['prediction']['data'])
+
+    run_path = blockwise['run_path']
+    if run_path is None:
+        run_path = directory_structure_setup(_config, _run)
+    logger.info(f"Writing predictions to {run_path}")
+
+    ledger_dir = blockwise['ledger_dir']
+    if ledger_dir is None:
+        ledger_dir = os.path.join(
+            os.path.expanduser(_config['prediction']['directories']['prefix']),
+            'ledgers',
+            run_path
+        )
+
+    if _config['prediction']['torchscript']:
+        model, checkpoint = None, None
+    else:
+        model = model_setup(_config, _run)
+        checkpoint = get_checkpoint(_config['prediction']['checkpoint'])
+
+    prediction_datasets = fos.utils.create_multiple_config(
+        _config['prediction']['data'])
+
+    for idx, pred_dataset in enumerate(prediction_datasets):
+        prediction = prediction_setup(
+            _config,
+            _run,
+            run_path,
+            model,
+            checkpoint,
+            pred_dataset
+        )
+        predict_blockwise_dataset(
+            prediction,
+            ledger=fos.utils.BlockLedger(
+                os.path.join(ledger_dir, f"ds_{idx}")),
+            task_id=f"predict_ds_{idx}",
+            num_block_workers=blockwise['num_block_workers'],
+            worker_index=blockwise['worker_index'],
+            num_worker_groups=blockwise['num_worker_groups'],
+        )
+
+
+def main():
+    args_blockwise, remaining_argv_blockwise = parse_args()
+
+    if not 0 <= args_blockwise.worker_index < \
+            args_blockwise.num_worker_groups:
+        raise ValueError(
+            f"worker_index {args_blockwise.worker_index} is out of range for "
+            f"{args_blockwise.num_worker_groups} worker groups.")
+
+    ex.add_config('config_prediction.yaml')
+    ex.add_config({
+        'prediction': {
+            'blockwise': {
+                'run_path': args_blockwise.run_path,
+                'ledger_dir': args_blockwise.ledger_dir,
+                'num_block_workers': args_blockwise.num_block_workers,
+                'worker_index': args_blockwise.worker_index,
+                'num_worker_groups': args_blockwise.num_worker_groups,
+            },
+        },
+    })
+
+    sys.argv = [
+        sys.argv[0],
+        *remaining_argv_blockwise
+    ]
+
+    args, remaining_argv = observer_setup()
+
+    with open(args.mongodb_training) as f:
+        db_config = json.load(f)
+    config = get_config_from_database(
+        db_config['url'],
+        db_config['db_name'],
+        args.run_id)
+    ex.add_config(config)
+
+    sacred_default_flags = ['-C', 'no']
+    argv = [
+        sys.argv[0],
+        *sacred_default_flags,
+        *remaining_argv,
+        f'prediction.run_id_training={args.run_id}'
+    ]
+    logger.info(argv)
+
+    ex.run_commandline(argv)
+
+
+if __name__ == '__main__':
+    main()
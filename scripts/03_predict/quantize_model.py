@@ -0,0 +1,306 @@
+"""Post-training static int8 quantization of a trained U-Net for the CPU.
+
+The conv passes of the model are quantized for the fbgemm/x86 backend and
+calibrated on a few blocks of a data config. The float and the quantized
+model are then both run over the blocks of a validation data config, and a
+JSON report with their Jaccard and Dice scores, computed with
+``fos.metrics``, and their time per block is written next to the model.
+
+The quantized model is exported with ``fos.torch.export_torchscript`` for the
+block size of the prediction config. Set ``prediction.torchscript`` in the
+prediction config to the written file to predict with it, on the cpu.
+"""
+
+import json
+import logging
+import os
+from time import time as now
+
+import numpy as np
+import torch
+import yaml
+import configargparse as argparse
+
+import incasem as fos
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def run_blocks(model, dataset):
+    """Predict all cached blocks of a dataset.
+
+    Returns:
+
+        The labels and the class probabilities ``(c, n)`` of all voxels in
+        the mask, and the mean time per block.
+    """
+
+    labels = []
+    probabilities = []
+    seconds = 0.0
+    with torch.inference_mode():
+        for raw, target, mask in zip(
+                dataset['raw'],
+                dataset['labels'],
+                dataset['mask']):
+            start = now()
+            out = fos.torch.models.first_output(model(raw))
+            seconds += now() - start
+
+            probas = torch.softmax(out, dim=1)[0]
+            labels.append(target[mask])
+            probabilities.append(probas.numpy()[:, mask])
+
+    return (
+        np.concatenate(labels),
+        np.concatenate(probabilities, axis=1),
+        seconds / len(dataset['raw'])
+    )
+
+
+def scores(labels, probabilities):
+    result = {}
+    for metric in ['jaccard', 'dice']:
+        result[metric] = [
+            fos.metrics.pairwise_distance_metric_thresholded(
+                target=labels,
+                prediction_probas=probabilities,
+                metric=metric,
+                threshold=0.5,
+                foreground_class=i,
+            )
+            for i in range(probabilities.shape[0])
+        ]
+    return result
+
+
+def compare(float_model, quantized_model, datasets):
+    report = []
+    for dataset in datasets:
+        labels, probas_float, seconds_float = run_blocks(
+            float_model, dataset)
+        _, probas_quantized, seconds_quantized = run_blocks(
+            quantized_model, dataset)
+
+        entry = {
+            'dataset': dataset['name'],
+            'num_blocks': len(dataset['raw']),
+            'float': {
+                'seconds_per_block': seconds_float,
+                **scores(labels, probas_float)
+            },
+            'int8': {
+                'seconds_per_block': seconds_quantized,
+                **scores(labels, probas_quantized)
+            },
+            'speedup': seconds_float / seconds_quantized,
+            'argmax_agreement': float(np.mean(
+                np.argmax(probas_float, axis=0) ==
+                np.argmax(probas_quantized, axis=0)
+            )),
+            'max_probability_difference': float(
+                np.abs(probas_float - probas_quantized).max()),
+        }
+        report.append(entry)
+
+        logger.info((
+            f"{dataset['name']}: speedup {entry['speedup']:.2f}x, "
+            f"argmax agreement {entry['argmax_agreement']:.4f}"
+        ))
+        for metric in ['jaccard', 'dice']:
+            for i, (score_float, score_quantized) in enumerate(zip(
+                    entry['float'][metric],
+                    entry['int8'][metric])):
+                logger.info((
+                    f"{dataset['name']} | {metric} class {i}: "
+                    f"float {score_float:.4f}, int8 {score_quantized:.4f}"
+                ))
+
+    return report
+
+
+def quantize_model(
+        training_config,
+        prediction_config,
+        checkpoint,
+        calibration_data,
+        num_calibration_blocks,
+        validation_data,
+        data_path_prefix,
+        output,
+        report,
+        backend,
+        quantize_heads,
+        num_threads):
+
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    with open(training_config) as f:
+        training_config = yaml.safe_load(f)
+    with open(prediction_config) as f:
+        prediction_config = yaml.safe_load(f)['prediction']
+
+    block_size = {
+        'data_path_prefix': os.path.expanduser(data_path_prefix),
+        'voxel_size': training_config['data']['voxel_size'],
+        'input_size_voxels': prediction_config['input_size_voxels'],
+        'output_size_voxels': prediction_config['output_size_voxels'],
+    }
+
+    model = fos.torch.models.load_model(
+        training_config['model'],
+        training_config['data']['voxel_size'],
+        checkpoint
+    )
+
+    # the output heads are cheap, and quantizing the logits costs accuracy
+    skip = [] if quantize_heads else [
+        name for name, _ in model.named_children() if name != 'unet'
+    ]
+
+    calibration = fos.pipeline.load_blocks(
+        data_config=calibration_data,
+        max_blocks=num_calibration_blocks,
+        **block_size
+    )
+    quantized_model = fos.torch.quantize_static(
+        model,
+        [raw for dataset in calibration for raw in dataset['raw']],
+        backend=backend,
+        skip=skip
+    )
+    del calibration
+
+    validation = fos.pipeline.load_blocks(
+        data_config=validation_data, **block_size)
+    results = {
+        'checkpoint': checkpoint,
+        'backend': torch.backends.quantized.engine,
+        'float_modules': skip,
+        'num_calibration_blocks': num_calibration_blocks,
+        'validation_data': validation_data,
+        'num_threads': torch.get_num_threads(),
+        'datasets': compare(model, quantized_model, validation),
+    }
+
+    if report is None:
+        report = f"{os.path.splitext(output)[0]}_report.json"
+    with open(report, 'w') as f:
+        json.dump(results, f, indent=4)
+    logger.info(f"Wrote report to {report}")
+
+    input_shape = (fos.torch.blocks_per_pass(prediction_config), 1) + \
+        tuple(prediction_config['input_size_voxels'])
+    fos.torch.export_torchscript(
+        quantized_model,
+        input_shape,
+        output,
+        # already fused, the quantized graph is not optimized further
+        optimize=False,
+        metadata={
+            'checkpoint': checkpoint,
+            'model': training_config['model'],
+            'quantized_engine': torch.backends.quantized.engine,
+        }
+    )
+
+
+def parse_args():
+    p = argparse.ArgParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add('--config', is_config_file=True, help='config file path')
+    p.add(
+        '--training_config',
+        default='../02_train/config_training.yaml',
+        help='YAML file with the model and data sections of the training.'
+    )
+    p.add(
+        '--prediction_config',
+        default='config_prediction.yaml',
+        help='Prediction config with the block size to export for.'
+    )
+    p.add(
+        '--checkpoint',
+        '-c',
+        required=True,
+        help='Training checkpoint with the model weights.'
+    )
+    p.add(
+        '--calibration_data',
+        required=True,
+        help='Data config with the blocks to calibrate on.'
+    )
+    p.add(
+        '--num_calibration_blocks',
+        type=int,
+        default=8,
+        help='Number of evenly spaced calibration blocks per dataset.'
+    )
+    p.add(
+        '--validation_data',
+        required=True,
+        help='Data config with the ROIs to compare float and int8 on.'
+    )
+    p.add(
+        '--data_path_prefix',
+        default='~/incasem/data',
+        help='Directory that the data config paths are relative to.'
+    )
+    p.add(
+        '--output',
+        '-o',
+        required=True,
+        help='File to write the quantized TorchScript model to.'
+    )
+    p.add(
+        '--report',
+        default=None,
+        help='JSON report, defaults to <output>_report.json.'
+    )
+    p.add(
+        '--backend',
+        default='x86',
+        choices=['x86', 'fbgemm'],
+        help='Quantized engine.'
+    )
+    p.add(
+        '--quantize_heads',
+        action='store_true',
+        help='Also quantize the output conv passes.'
+    )
+    p.add(
+        '--num_threads',
+        type=int,
+        default=None,
+        help='Number of torch threads.'
+    )
+
+    args = p.parse_args()
+    logger.info(f'\n{p.format_values()}')
+
+    return args
+
+
+def main():
+    args = parse_args()
+    quantize_model(
+        training_config=args.training_config,
+        prediction_config=args.prediction_config,
+        checkpoint=args.checkpoint,
+        calibration_data=args.calibration_data,
+        num_calibration_blocks=args.num_calibration_blocks,
+        validation_data=args.validation_data,
+        data_path_prefix=args.data_path_prefix,
+        output=args.output,
+        report=args.report,
+        backend=args.backend,
+        quantize_heads=args.quantize_heads,
+        num_threads=args.num_threads
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+"""Evaluate a range of checkpoints on cached input blocks.
+
+In contrast to ``predict_multiple.py``, the evaluation ROIs are read and
+preprocessed only once, and kept in memory as tensors. Every checkpoint is
+then loaded into the same model and run over the cached blocks, and the
+metrics of each checkpoint are appended to a CSV table and logged to sacred
+as soon as they are computed. Prediction volumes are only written if
+``--write_predictions`` is given.
+"""
+
+import csv
+import logging
+import os
+import sys
+import json
+from time import time as now
+
+import configargparse as argparse
+import numpy as np
+import torch
+import zarr
+import gunpowder as gp
+
+import incasem as fos
+from incasem.tracking.sacred import ex
+from predict import (
+    torch_setup,
+    model_setup,
+    directory_structure_setup,
+    observer_setup,
+    get_config_from_database,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '--checkpoint_dir',
+        required=True,
+        help='Base directory with model checkpoints.'
+    )
+    parser.add_argument(
+        '--checkpoint_basename',
+        default='model_checkpoint_',
+        help='Prefix of all checkpoint filenames before the iteration number.'
+    )
+    parser.add_argument(
+        '--start',
+        type=int,
+        required=True,
+        help='First checkpoint to use.'
+    )
+    parser.add_argument(
+        '--stop',
+        type=int,
+        required=True,
+        help='Last checkpoint to use, this iteration is included.'
+    )
+    parser.add_argument(
+        '--step',
+        type=int,
+        required=True,
+        help='Interval between checkpoints.'
+    )
+    parser.add_argument(
+        '--results',
+        default=None,
+        help=(
+            'CSV file to append the metrics of each checkpoint to. Defaults '
+            'to sweep.csv in the predictions directory of the run.'
+        )
+    )
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=1,
+        help='Number of cached blocks per forward pass.'
+    )
+    parser.add_argument(
+        '--write_predictions',
+        action='store_true',
+        help='Also write the uint8 probabilities of every checkpoint.'
+    )
+
+    return parser.parse_known_args()
+
+
+def load_checkpoint(model, checkpoint, device):
+    state = torch.load(checkpoint, map_location=device)
+    if 'model_state_dict' in state:
+        state = state['model_state_dict']
+    model.load_state_dict(state)
+
+
+def scores_from_counts(confusion, thresholded):
+    """Same scores as ``log_metrics`` in ``predict.py``."""
+
+    scores = {}
+    for i, score in enumerate(fos.metrics.jaccard_from_counts(thresholded)):
+        scores[f'jaccard_class_{i}'] = score
+    for i, score in enumerate(fos.metrics.dice_from_counts(thresholded)):
+        scores[f'dice_class_{i}'] = score
+    for i, (precision, recall) in enumerate(
+            fos.metrics.precision_recall_from_counts(confusion)):
+        scores[f'precision_{i}'] = precision
+        scores[f'recall_{i}'] = recall
+
+    return scores
+
+
+def create_probabilities_dataset(
+        filename,
+        ds_name,
+        rois,
+        num_classes,
+        voxel_size,
+        chunks):
+    total_roi = rois[0]
+    for roi in rois[1:]:
+        total_roi = total_roi.union(roi)
+
+    dataset = zarr.open(filename, mode='a').create_dataset(
+        ds_name,
+        shape=(num_classes,) + tuple(total_roi.get_shape() / voxel_size),
+        chunks=(num_classes,) + tuple(chunks),
+        dtype=np.uint8,
+        overwrite=True
+    )
+    dataset.attrs['offset'] = list(total_roi.get_offset())
+    dataset.attrs['resolution'] = list(voxel_size)
+
+    return dataset, total_roi
+
+
+def evaluate_checkpoint(
+        model,
+        datasets,
+        num_classes,
+        device,
+        batch_size,
+        voxel_size,
+        predictions_prefix=None,
+        run_path=None):
+    """Run the model over all cached blocks and return the scores per
+    dataset."""
+
+    voxel_size = gp.Coordinate(voxel_size)
+    results = []
+    for dataset in datasets:
+        confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+        thresholded = np.zeros((num_classes, 2, 2), dtype=np.int64)
+
+        probabilities_ds = None
+        if predictions_prefix is not None:
+            output_shape = dataset['rois'][0].get_shape() / voxel_size
+            probabilities_ds, total_roi = create_probabilities_dataset(
+                filename=os.path.join(predictions_prefix, dataset['file']),
+                ds_name=f"volumes/predictions/{run_path}/probabilities",
+                rois=dataset['rois'],
+                num_classes=num_classes,
+                voxel_size=voxel_size,
+                chunks=output_shape / 2
+            )
+
+        num_blocks = len(dataset['rois'])
+        for first in range(0, num_blocks, batch_size):
+            indices = range(first, min(first + batch_size, num_blocks))
+            raw = torch.cat([dataset['raw'][i] for i in indices]).to(
+                device, non_blocking=True)
+
+            with torch.inference_mode():
+                probabilities = torch.softmax(
+                    fos.torch.models.first_output(model(raw)), dim=1)
+
+            for j, i in enumerate(indices):
+                block = probabilities[j].cpu().numpy()
+                confusion += fos.metrics.confusion_counts(
+                    dataset['labels'][i], block, dataset['mask'][i])
+                thresholded += fos.metrics.thresholded_counts(
+                    dataset['labels'][i], block, 0.5, dataset['mask'][i])
+
+                if probabilities_ds is not None:
+                    slices = (
+                        (dataset['rois'][i] - total_roi.get_offset())
+                        / voxel_size
+                    ).to_slices()
+                    probabilities_ds[(slice(None),) + slices] = (
+                        probabilities[j] * 255).round().to(
+                            torch.uint8).cpu().numpy()
+
+        results.append(scores_from_counts(confusion, thresholded))
+
+    return results
+
+
+@ex.main
+def sweep_checkpoints(_config, _run):
+    sweep = _config['prediction']['sweep']
+    checkpoint_dir = _config['prediction']['checkpoint_dir']
+    checkpoint_basename = _config['prediction']['checkpoint_basename']
+    start = _config['prediction']['iteration_start']
+    stop = _config['prediction']['iteration_stop']
+    step = _config['prediction']['iteration_step']
+
+    # include end point
+    iterations = list(range(start, stop + 1, step))
+    logger.info(f"Evaluating iterations {iterations}.")
+
+    torch_setup(_config)
+    _run.add_artifact(_config['prediction']['data'])
+
+    device = str(_config['prediction']['torch']['device'])
+    if device == 'cpu':
+        num_threads = _config['prediction']['torch']['cpu']['num_threads']
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+    else:
+        device = f'cuda:{device}'
+    device = torch.device(device)
+
+    num_classes = int(_config['data']['num_classes'])
+    voxel_size = _config['data']['voxel_size']
+    predictions_prefix = os.path.expanduser(
+        _config['prediction']['directories']['prefix'])
+
+    datasets = fos.pipeline.load_blocks(
+        data_config=_config['prediction']['data'],
+        data_path_prefix=os.path.expanduser(_config['directories']['data']),
+        voxel_size=voxel_size,
+        input_size_voxels=_config['prediction']['input_size_voxels'],
+        output_size_voxels=_config['prediction']['output_size_voxels']
+    )
+    if device.type == 'cuda':
+        for dataset in datasets:
+            dataset['raw'] = [raw.pin_memory() for raw in dataset['raw']]
+
+    model = model_setup(_config, _run).to(device)
+
+    # same layout as predict_multiple.py
+    run_path = directory_structure_setup(_config, _run)
+
+    results_file = sweep['results']
+    if results_file is None:
+        results_file = os.path.join(
+            predictions_prefix, run_path, 'sweep.csv')
+    os.makedirs(os.path.dirname(os.path.abspath(results_file)), exist_ok=True)
+
+    with open(results_file, 'a', newline='') as f:
+        writer = None
+        for iteration in iterations:
+            checkpoint = os.path.join(
+                checkpoint_dir, f"{checkpoint_basename}{iteration}")
+
+            start_time = now()
+            load_checkpoint(model, checkpoint, device)
+            results = evaluate_checkpoint(
+                model,
+                datasets,
+                num_classes=num_classes,
+                device=device,
+                batch_size=sweep['batch_size'],
+                voxel_size=voxel_size,
+                predictions_prefix=(
+                    predictions_prefix if sweep['write_predictions'] else None
+                ),
+                run_path=os.path.join(run_path, f"iteration_{iteration:06d}")
+            )
+            duration = now() - start_time
+
+            for idx, (dataset, scores) in enumerate(zip(datasets, results)):
+                row = {
+                    'iteration': iteration,
+                    'dataset': dataset['name'],
+                    'seconds': round(duration, 3),
+                    **scores
+                }
+                if writer is None:
+                    writer = csv.DictWriter(f, fieldnames=list(row))
+                    if f.tell() == 0:
+                        writer.writeheader()
+                writer.writerow(row)
+
+                for name, score in scores.items():
+                    _run.log_scalar(f"{name}_ds_{idx}", score, iteration)
+            f.flush()
+
+            logger.info((
+                f"Iteration {iteration} in {duration:.1f} s: " + ", ".join(
+                    f"{name} {score:.4f}"
+                    for name, score in results[0].items()
+                    if name.startswith('jaccard')
+                )
+            ))
+
+    logger.info(f"Wrote results to {results_file}")
+
+
+def main():
+    args_sweep, remaining_argv_sweep = parse_args()
+
+    ex.add_config({
+        'prediction': {
+            'checkpoint_dir': args_sweep.checkpoint_dir,
+            'checkpoint_basename': args_sweep.checkpoint_basename,
+            'iteration_start': args_sweep.start,
+            'iteration_stop': args_sweep.stop,
+            'iteration_step': args_sweep.step,
+            'sweep': {
+                'results': args_sweep.results,
+                'batch_size': args_sweep.batch_size,
+                'write_predictions': args_sweep.write_predictions,
+            },
+        },
+    })
+    ex.add_config('../02_train/config_training.yaml')
+    ex.add_config('config_prediction.yaml')
+
+    sys.argv = [
+        sys.argv[0],
+        *remaining_argv_sweep
+    ]
+
+    args, remaining_argv = observer_setup()
+
+    with open(args.mongodb_training) as f:
+        db_config = json.load(f)
+    config = get_config_from_database(
+        db_config['url'],
+        db_config['db_name'],
+        args.run_id)
+    ex.add_config(config)
+
+    sacred_default_flags = ['-C', 'no']
+    argv = [
+        sys.argv[0],
+        *sacred_default_flags,
+        *remaining_argv,
+        f'prediction.run_id_training={args.run_id}'
+    ]
+    logger.info(argv)
+
+    ex.run_commandline(argv)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,7 @@ from funlib.persistence import Array, open_ds, prepare_ds
 from funlib.geometry import Roi, Coordinate
 import daisy
 
+from incasem.utils import decode_probabilities
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -25,10 +26,18 @@ def extract_segmentation_with_threshold_worker(
         probas,
         mask,
         out,
-        threshold):
+        threshold,
+        channel):
+
+    # single-class datasets have no channel dimension
+    if len(probas.data.shape) == len(probas.voxel_size):
+        channel = None
 
     # load the chunk
-    probas = probas[block.read_roi].to_ndarray()
+    probas = decode_probabilities(
+        probas[block.read_roi].to_ndarray(),
+        channel
+    )
     if mask:
         mask = mask[block.read_roi].to_ndarray()
         segmentation = ((probas >= threshold) & (mask != 0))
@@ -50,6 +59,7 @@ def extract_segmentation_with_threshold(
         out_ds_name,
         chunk_shape,
         threshold,
+        channel,
         num_workers):
 
     probas = open_ds(
@@ -98,7 +108,8 @@ def extract_segmentation_with_threshold(
             probas=probas,
             mask=mask,
             out=out,
-            threshold=threshold
+            threshold=threshold,
+            channel=channel
         ),
         read_write_conflict=False,
         fit='shrink',
@@ -161,6 +172,15 @@ def parse_args():
         required=True,
         help='Threshold for positive prediction.'
     )
+    p.add(
+        '--channel',
+        type=int,
+        default=1,
+        help=(
+            'Class channel to threshold if the dataset holds the '
+            'probabilities of all classes.'
+        )
+    )
     p.add(
         '--num_workers',
         '-n',
@@ -185,6 +205,7 @@ def main():
         out_ds_name=args.out_dataset,
         chunk_shape=args.chunk_shape,
         threshold=args.threshold,
+        channel=args.channel,
         num_workers=args.num_workers
     )
 
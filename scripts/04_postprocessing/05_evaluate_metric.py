@@ -41,6 +41,7 @@ def evaluate_metric(
         metric_mask_path,
         roi_padding,
         thresholds,
+        channel=1,
         # num_workers
 ):
     labels = open_ds(
@@ -109,7 +110,13 @@ def evaluate_metric(
     # binarize labels
     labels = (labels != 0).astype(np.uint8)
 
-    probas = probas[roi].to_ndarray()
+    # single-class datasets have no channel dimension
+    if len(probas.data.shape) == len(probas.voxel_size):
+        channel = None
+    probas = fos.utils.decode_probabilities(
+        probas[roi].to_ndarray(),
+        channel
+    )
 
     if metric_mask is not None:
         metric_mask = metric_mask[roi].to_ndarray()
@@ -192,6 +199,15 @@ def parse_args():
         required=True,
         help='Name of the dataset with prediction probabilities.'
     )
+    p.add(
+        '--channel',
+        type=int,
+        default=1,
+        help=(
+            'Class channel to evaluate if the dataset holds the '
+            'probabilities of all classes.'
+        )
+    )
     p.add(
         '--mask',
         help='Binary mask to predict background for all non-cell voxels.'
@@ -266,6 +282,7 @@ def main():
         metric_mask_path=args.metric_mask,
         roi_padding=args.roi_padding,
         thresholds=args.thresholds,
+        channel=args.channel,
         # num_workers=args.num_workers
     )
 
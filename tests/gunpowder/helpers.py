@@ -0,0 +1,68 @@
+"""Sources and models shared by the tests."""
+
+import copy
+import numpy as np
+import torch
+import gunpowder as gp
+
+
+class NumpySource(gp.BatchProvider):
+    """Provides crops of the given ``gp.Array``s."""
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def setup(self):
+        for key, array in self.arrays.items():
+            self.provides(key, array.spec.copy())
+
+    def provide(self, request):
+        outputs = gp.Batch()
+        for key, spec in request.array_specs.items():
+            outputs[key] = self.arrays[key].crop(spec.roi)
+            outputs[key].spec = copy.deepcopy(outputs[key].spec)
+        return outputs
+
+
+class RandomSource(gp.BatchProvider):
+    """Provides uniform random RAW and LABELS in a 10^3 ROI."""
+
+    def __init__(self):
+        self.roi = gp.Roi((0, 0, 0), (10, 10, 10))
+
+        self.raw = gp.ArrayKey("RAW")
+        self.labels = gp.ArrayKey("LABELS")
+
+        self.array_spec = gp.ArraySpec(
+            roi=self.roi,
+            voxel_size=gp.Coordinate((1, 1, 1)),
+            dtype='float32',
+            interpolatable=True
+        )
+
+    def setup(self):
+        self.provides(self.raw, self.array_spec)
+        self.provides(self.labels, self.array_spec)
+
+    def provide(self, request):
+        outputs = gp.Batch()
+        for key in [self.raw, self.labels]:
+            spec = copy.deepcopy(self.array_spec)
+            spec.roi = request[key].roi
+            outputs[key] = gp.Array(
+                np.random.rand(*request[key].roi.get_shape()).astype(
+                    np.float32),
+                spec
+            )
+        return outputs
+
+
+class Model(torch.nn.Module):
+    """Valid-padded two-class model with a single 3x3x3 convolution."""
+
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv3d(1, 2, kernel_size=3)
+
+    def forward(self, x):
+        return self.conv(x)
@@ -0,0 +1,61 @@
+import numpy as np
+import torch
+import gunpowder as gp
+
+import incasem as fos
+from helpers import NumpySource
+
+
+def test_blockwise_loss_matches_whole_volume_loss():
+    predictions = gp.ArrayKey("PREDICTIONS")
+    labels = gp.ArrayKey("LABELS")
+    mask = gp.ArrayKey("MASK")
+    scalings = gp.ArrayKey("LOSS_SCALINGS")
+
+    rng = np.random.default_rng(0)
+    shape = (16, 16, 16)
+    num_classes = 3
+    roi = gp.Roi((0, 0, 0), shape)
+    voxel_size = gp.Coordinate((1, 1, 1))
+
+    # with batch dimension
+    data = {
+        predictions: rng.normal(
+            size=(1, num_classes) + shape).astype(np.float32),
+        labels: rng.integers(0, num_classes, size=(1,) + shape),
+        mask: (rng.random((1,) + shape) > 0.3).astype(np.float32),
+        scalings: rng.random((1,) + shape).astype(np.float32),
+    }
+    source = NumpySource({
+        key: gp.Array(
+            array,
+            gp.ArraySpec(roi=roi, voxel_size=voxel_size, dtype=array.dtype))
+        for key, array in data.items()
+    })
+
+    loss = fos.torch.loss.CrossEntropyLossWithScalingAndMeanReduction(
+        device='cpu')
+    inputs = {0: predictions, 1: labels, 2: mask, 3: scalings}
+    accumulate_loss = fos.gunpowder.torch.AccumulateLoss(loss, inputs)
+
+    reference = gp.BatchRequest()
+    for key in inputs.values():
+        reference[key] = gp.ArraySpec(roi=gp.Roi((0, 0, 0), (4, 8, 8)))
+    pipeline = (
+        source
+        + accumulate_loss
+        + gp.Scan(reference, num_workers=1)
+        + fos.gunpowder.torch.ValidationLoss(accumulator=accumulate_loss)
+    )
+
+    request = gp.BatchRequest()
+    for key in inputs.values():
+        request[key] = gp.ArraySpec(roi=roi)
+
+    with gp.build(pipeline):
+        # reset for each scan
+        for _ in range(2):
+            batch = pipeline.request_batch(request)
+
+    expected = loss(*[torch.as_tensor(data[inputs[i]]) for i in range(4)])
+    assert np.isclose(batch.loss, float(expected), rtol=1e-5)
@@ -0,0 +1,197 @@
+import copy
+import multiprocessing
+import os
+import types
+
+import numpy as np
+import pytest
+import torch
+import gunpowder as gp
+
+import incasem as fos
+from helpers import Model, NumpySource
+
+
+class Gate(gp.BatchFilter):
+    """Signals that a block is requested, and holds it until released."""
+
+    def __init__(self, started, release):
+        self.started = started
+        self.release = release
+
+    def process(self, batch, request):
+        self.started.set()
+        self.release.wait()
+
+
+class Exit(gp.BatchFilter):
+    """Kills the process that runs the pipeline."""
+
+    def process(self, batch, request):
+        os._exit(1)
+
+
+def validation_setup(model, node=None):
+    raw = gp.ArrayKey("RAW")
+    labels = gp.ArrayKey("LABELS")
+    mask = gp.ArrayKey("MASK")
+    scalings = gp.ArrayKey("LOSS_SCALINGS")
+    predictions = gp.ArrayKey("PREDICTIONS")
+
+    rng = np.random.default_rng(0)
+    voxel_size = gp.Coordinate((1, 1, 1))
+    input_roi = gp.Roi((0, 0, 0), (10, 10, 10))
+    output_roi = input_roi.grow((-1, -1, -1), (-1, -1, -1))
+
+    def array(data, roi):
+        return gp.Array(
+            data,
+            gp.ArraySpec(roi=roi, voxel_size=voxel_size, dtype=data.dtype))
+
+    # with batch dimension
+    source = NumpySource({
+        raw: array(rng.random((1, 1, 10, 10, 10), dtype=np.float32),
+                   input_roi),
+        labels: array(rng.integers(0, 2, (1, 8, 8, 8)), output_roi),
+        mask: array(np.ones((1, 8, 8, 8), dtype=np.float32), output_roi),
+        scalings: array(rng.random((1, 8, 8, 8), dtype=np.float32),
+                        output_roi),
+    })
+
+    predict = fos.gunpowder.torch.Predict(
+        model=model,
+        inputs={'x': raw},
+        outputs={0: predictions},
+        array_specs={
+            predictions: gp.ArraySpec(
+                roi=output_roi, dtype=np.float32, voxel_size=voxel_size)
+        },
+        device='cpu',
+        gpus=[],
+    )
+    accumulate_loss = fos.gunpowder.torch.AccumulateLoss(
+        loss=fos.torch.loss.CrossEntropyLossWithScalingAndMeanReduction(
+            device='cpu'),
+        inputs={0: predictions, 1: labels, 2: mask, 3: scalings},
+    )
+
+    reference = gp.BatchRequest()
+    reference.add(raw, (6, 6, 6))
+    for key in [labels, mask, scalings, predictions]:
+        reference.add(key, (4, 4, 4))
+    confusion_counts = fos.gunpowder.ConfusionCounts(
+        labels=labels,
+        predictions=predictions,
+        num_classes=2,
+        masks=[mask],
+    )
+    scan = gp.Scan(reference, num_workers=1)
+    validation_loss = fos.gunpowder.torch.ValidationLoss(
+        accumulator=accumulate_loss)
+
+    pipeline = source + predict
+    if node is not None:
+        pipeline += node
+    pipeline = (
+        pipeline
+        + accumulate_loss
+        + fos.gunpowder.Squeeze([labels, mask, scalings, predictions])
+        + fos.gunpowder.Softmax(predictions)
+        + confusion_counts
+        + scan
+        + validation_loss
+    )
+
+    return types.SimpleNamespace(
+        pipeline=pipeline,
+        request=reference,
+        scan=scan,
+        validation_loss=validation_loss,
+        confusion_counts=confusion_counts,
+        snapshot=None,
+    )
+
+
+def counted_voxels(validation, iteration, mode):
+    return {f'voxels_{mode}': validation.confusion_counts.confusion.sum()}
+
+
+def losses(results):
+    return {
+        iteration: value for name, value, iteration in results
+        if name == 'loss_val_ds_0_type_0'
+    }
+
+
+def test_asynchronous_validation():
+    torch.manual_seed(0)
+    model = Model().train()
+    started = multiprocessing.Event()
+    release = multiprocessing.Event()
+
+    validation = fos.pipeline.BackgroundValidation(
+        model,
+        [validation_setup(model, Gate(started, release))],
+        metrics_fn=counted_voxels,
+        asynchronous=True,
+    )
+    validation.start()
+
+    states = {}
+    try:
+        states[1] = copy.deepcopy(model.state_dict())
+        assert validation.validate(1)
+        assert started.wait(timeout=60)
+
+        # the next validation waits, a further one is skipped
+        with torch.no_grad():
+            model.conv.weight.mul_(2)
+        states[2] = copy.deepcopy(model.state_dict())
+        assert validation.validate(2)
+        assert not validation.validate(3)
+
+        assert validation.poll() == []
+    finally:
+        release.set()
+        results = validation.close()
+
+    assert model.training
+    # all blocks of the ROI are counted once per validation
+    assert sorted(
+        (name, value, iteration) for name, value, iteration in results
+        if name.startswith('voxels_')
+    ) == [
+        ('voxels_validation_ds_0', 8.0 ** 3, 1),
+        ('voxels_validation_ds_0', 8.0 ** 3, 2),
+    ]
+
+    # computed with the weights of their iteration
+    asynchronous = losses(results)
+    assert sorted(asynchronous) == [1, 2]
+    for iteration, state in states.items():
+        model.load_state_dict(state)
+        synchronous = fos.pipeline.BackgroundValidation(
+            model, [validation_setup(model)], asynchronous=False)
+        synchronous.start()
+        synchronous.validate(iteration)
+        expected = losses(synchronous.close())
+        assert np.isclose(asynchronous[iteration], expected[iteration])
+
+
+def test_dead_worker_raises():
+    model = Model().train()
+    validation = fos.pipeline.BackgroundValidation(
+        model,
+        [validation_setup(model, Exit())],
+        asynchronous=True,
+    )
+    validation.start()
+
+    assert validation.validate(1)
+    with pytest.raises(RuntimeError, match="exited with code 1"):
+        validation.poll(block=True)
+    with pytest.raises(RuntimeError):
+        validation.validate(2)
+
+    # does not wait for the dead worker
+    assert validation.close() == []
@@ -0,0 +1,51 @@
+import threading
+
+import pytest
+
+from incasem.utils import BackgroundWriter
+
+
+def test_writes_in_background_threads():
+    written = []
+    release = threading.Event()
+
+    def write(i, value):
+        release.wait()
+        written.append((i, value, threading.current_thread().name))
+
+    writer = BackgroundWriter(
+        write, name='Writer', num_threads=2, queue_size=0)
+    for i in range(4):
+        writer.put(i, i * 10)
+    # the caller continues while the writers are blocked
+    assert written == []
+
+    release.set()
+    writer.wait()
+    assert sorted(w[:2] for w in written) == [(i, i * 10) for i in range(4)]
+    assert {w[2] for w in written} <= {'Writer-0', 'Writer-1'}
+
+    writer.close()
+    # started again by the next put
+    writer.put(4, 40)
+    writer.close()
+    assert len(written) == 5
+
+
+def test_errors_are_raised_once():
+    def write(value):
+        if value < 0:
+            raise ValueError("negative")
+
+    writer = BackgroundWriter(write, name='Writer')
+    writer.put(-1)
+    with pytest.raises(RuntimeError, match="Writing in Writer failed"):
+        writer.wait()
+
+    writer.put(1)
+    writer.put(-1)
+    with pytest.raises(RuntimeError) as e:
+        writer.close()
+    assert isinstance(e.value.__cause__, ValueError)
+
+    writer.close()
@@ -0,0 +1,74 @@
+import copy
+import numpy as np
+import gunpowder as gp
+
+import incasem as fos
+
+
+class CountingSource(gp.BatchProvider):
+    def __init__(self):
+        self.roi = gp.Roi((0, 0, 0), (10, 10, 10))
+        self.raw = gp.ArrayKey("RAW")
+        self.num_requests = 0
+        self.data = np.random.rand(10, 10, 10).astype(np.float32)
+
+        self.array_spec = gp.ArraySpec(
+            roi=self.roi,
+            voxel_size=gp.Coordinate((1, 1, 1)),
+            dtype='float32',
+            interpolatable=True
+        )
+
+    def setup(self):
+        self.provides(self.raw, self.array_spec)
+
+    def provide(self, request):
+        self.num_requests += 1
+
+        outputs = gp.Batch()
+        spec = copy.deepcopy(self.array_spec)
+        spec.roi = request[self.raw].roi
+        outputs[self.raw] = gp.Array(
+            self.data[spec.roi.to_slices()].copy(),
+            spec
+        )
+        return outputs
+
+
+def request_twice(cache_dir=None):
+    raw = gp.ArrayKey("RAW")
+    source = CountingSource()
+    pipeline = source + fos.gunpowder.CacheBatches(cache_dir=cache_dir)
+
+    request = gp.BatchRequest()
+    request[raw] = gp.ArraySpec(roi=gp.Roi((0, 0, 0), (4, 4, 4)))
+    # overlaps the first request
+    other_request = gp.BatchRequest()
+    other_request[raw] = gp.ArraySpec(roi=gp.Roi((2, 4, 6), (4, 4, 4)))
+
+    with gp.build(pipeline):
+        first = pipeline.request_batch(request)
+        # the whole ROI in tiles of the requested shape
+        assert source.num_requests == 3 ** 3
+
+        # downstream modifications do not change the cache
+        first_data = first[raw].data.copy()
+        first[raw].data[:] = 0
+        second = pipeline.request_batch(request)
+        other = pipeline.request_batch(other_request)
+
+    assert source.num_requests == 3 ** 3
+    assert np.array_equal(first_data, source.data[0:4, 0:4, 0:4])
+    assert np.array_equal(second[raw].data, first_data)
+    assert np.array_equal(other[raw].data, source.data[2:6, 4:8, 6:10])
+    assert other[raw].spec.roi == other_request[raw].roi
+
+
+def test_cache_batches():
+    request_twice()
+
+
+def test_cache_batches_memory_mapped(tmp_path):
+    request_twice(cache_dir=str(tmp_path / 'cache'))
+    # removed on teardown
+    assert not any((tmp_path / 'cache').iterdir())
@@ -0,0 +1,68 @@
+import numpy as np
+import gunpowder as gp
+
+import incasem as fos
+from helpers import NumpySource
+
+
+def test_counts_match_whole_volume_metrics():
+    labels = gp.ArrayKey("LABELS")
+    predictions = gp.ArrayKey("PREDICTIONS")
+    mask = gp.ArrayKey("MASK")
+
+    rng = np.random.default_rng(0)
+    shape = (16, 16, 16)
+    num_classes = 3
+    roi = gp.Roi((0, 0, 0), shape)
+    voxel_size = gp.Coordinate((1, 1, 1))
+
+    target = rng.integers(0, num_classes, size=shape).astype(np.uint32)
+    logits = rng.normal(size=(num_classes,) + shape)
+    probas = np.exp(logits) / np.exp(logits).sum(axis=0, keepdims=True)
+    probas = probas.astype(np.float32)
+    mask_data = (rng.random(shape) > 0.3).astype(np.uint8)
+
+    def spec(dtype):
+        return gp.ArraySpec(roi=roi, voxel_size=voxel_size, dtype=dtype)
+
+    source = NumpySource({
+        labels: gp.Array(target, spec(np.uint32)),
+        predictions: gp.Array(probas, spec(np.float32)),
+        mask: gp.Array(mask_data, spec(np.uint8)),
+    })
+    counts = fos.gunpowder.ConfusionCounts(
+        labels=labels,
+        predictions=predictions,
+        num_classes=num_classes,
+        masks=[mask]
+    )
+
+    reference = gp.BatchRequest()
+    for key in [labels, predictions, mask]:
+        reference[key] = gp.ArraySpec(roi=gp.Roi((0, 0, 0), (4, 8, 8)))
+    pipeline = source + counts + gp.Scan(reference, num_workers=2)
+
+    with gp.build(pipeline):
+        pipeline.request_batch(gp.BatchRequest())
+
+    assert counts.num_batches == 4 * 2 * 2
+
+    jaccard = fos.metrics.jaccard_from_counts(counts.thresholded)
+    dice = fos.metrics.dice_from_counts(counts.thresholded)
+    for i in range(num_classes):
+        for metric, scores in [('jaccard', jaccard), ('dice', dice)]:
+            expected = fos.metrics.pairwise_distance_metric_thresholded(
+                target=target,
+                prediction_probas=probas,
+                metric=metric,
+                threshold=0.5,
+                foreground_class=i,
+                mask=mask_data
+            )
+            assert np.isclose(scores[i], expected)
+
+    expected = fos.metrics.precision_recall(target, probas, mask_data)
+    np.testing.assert_allclose(
+        fos.metrics.precision_recall_from_counts(counts.confusion),
+        expected
+    )
@@ -0,0 +1,111 @@
+import json
+import time
+
+import torch
+
+from incasem.tracking import JsonlSink, MetricsLogger
+
+
+class ListSink:
+    def __init__(self):
+        self.writes = []
+        self.closed = False
+
+    def write(self, records):
+        self.writes.append(sorted(records))
+
+    def close(self):
+        self.closed = True
+
+
+class FailingSink:
+    def write(self, records):
+        raise OSError("disk full")
+
+
+def test_windowed_mean_with_last_step():
+    sink = ListSink()
+    metrics = MetricsLogger([sink], flush_every=None)
+
+    for step, value in enumerate([1.0, 2.0, 6.0]):
+        metrics.log_scalar('loss', value, step)
+    metrics.log_scalar('dice', torch.tensor(0.5, dtype=torch.bfloat16), 1)
+    metrics.flush()
+    assert sink.writes == [[('dice', 0.5, 1), ('loss', 3.0, 2)]]
+
+    # nothing buffered, nothing written
+    metrics.flush()
+    assert len(sink.writes) == 1
+
+    # a new window
+    metrics.log_scalar('loss', 4.0, 3)
+    metrics.flush()
+    assert sink.writes[-1] == [('loss', 4.0, 3)]
+
+
+def test_values_without_aggregation():
+    sink = ListSink()
+    metrics = MetricsLogger([sink], flush_every=None)
+
+    metrics.log_scalars({'dice': 0.25, 'loss': 1.0}, 10, aggregate=False)
+    metrics.log_scalar('dice', 0.75, 20, aggregate=False)
+    metrics.log_scalar('loss', 3.0, 20)
+    metrics.flush()
+
+    assert sink.writes == [[
+        ('dice', 0.25, 10),
+        ('dice', 0.75, 20),
+        ('loss', 1.0, 10),
+        ('loss', 3.0, 20),
+    ]]
+
+
+def test_close_flushes_and_closes_sinks():
+    sink = ListSink()
+    metrics = MetricsLogger([sink, FailingSink()], flush_every=None)
+
+    metrics.log_scalar('loss', 1.0, 0)
+    metrics.close()
+
+    # a failing sink does not stop the others
+    assert sink.writes == [[('loss', 1.0, 0)]]
+    assert sink.closed
+
+
+def test_background_flush():
+    sink = ListSink()
+    metrics = MetricsLogger([sink], flush_every=0.05)
+
+    metrics.log_scalar('loss', 1.0, 0)
+    assert not sink.writes
+    time.sleep(0.1)
+    # due, handed to the background thread
+    metrics.log_scalar('loss', 3.0, 1)
+    deadline = time.time() + 10
+    while not sink.writes and time.time() < deadline:
+        time.sleep(0.01)
+    assert sink.writes == [[('loss', 2.0, 1)]]
+
+    metrics.close()
+    assert sink.writes == [[('loss', 2.0, 1)]]
+    assert sink.closed
+
+
+def test_jsonl_sink(tmp_path):
+    filename = tmp_path / 'metrics' / 'run.jsonl'
+
+    for records in [
+            [('loss', 0.5, 1), ('loss', float('nan'), 2)],
+            [('dice', float('inf'), 3)]]:
+        # appends, e.g. for a resumed run
+        sink = JsonlSink(str(filename))
+        sink.write(records)
+        sink.close()
+
+    with open(filename) as f:
+        lines = [json.loads(line) for line in f]
+    assert lines == [
+        {'name': 'loss', 'value': 0.5, 'step': 1},
+        {'name': 'loss', 'value': 'nan', 'step': 2},
+        {'name': 'dice', 'value': 'inf', 'step': 3},
+    ]
@@ -0,0 +1,253 @@
+import numpy as np
+import pytest
+import torch
+import gunpowder as gp
+
+import incasem as fos
+
+
+class CenterCrop(torch.nn.Module):
+    """Mimics a valid-padded network by cropping `context` voxels on each
+    side of the spatial dimensions."""
+
+    def __init__(self, context):
+        super().__init__()
+        self.context = context
+
+    def forward(self, x):
+        c = self.context
+        return 2 * x[..., c:-c, c:-c, c:-c]
+
+
+def test_micro_batch_matches_single_pass():
+    raw = gp.ArrayKey("RAW")
+    predictions = gp.ArrayKey("PREDICTIONS")
+
+    micro_batch = (2, 1, 3)
+    block_input_shape = (8, 8, 8)
+    block_output_shape = (4, 4, 4)
+
+    predict = fos.gunpowder.torch.Predict(
+        model=CenterCrop(context=2).eval(),
+        inputs={'x': raw},
+        outputs={0: predictions},
+        device='cpu',
+        micro_batch=micro_batch,
+        block_input_shape=block_input_shape,
+        block_output_shape=block_output_shape,
+    )
+    predict.device = torch.device('cpu')
+
+    super_shape = tuple(
+        i + (n - 1) * o for n, i, o in zip(
+            micro_batch, block_input_shape, block_output_shape))
+    x = torch.rand((1, 1) + super_shape)
+
+    stacked = predict.stack_blocks(x)
+    assert stacked.shape == (6, 1) + block_input_shape
+
+    out = predict.unstack_blocks(predict.model(stacked))
+    assert out.shape == (1, 1, 8, 4, 12)
+
+    expected = 2 * x[..., 2:-2, 2:-2, 2:-2]
+    assert np.allclose(out.numpy(), expected.numpy())
+
+
+class Asymmetric(torch.nn.Module):
+    """Valid-padded model that is not invariant to mirroring or
+    transposing."""
+
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv3d(1, 2, kernel_size=3)
+
+    def forward(self, x):
+        return self.conv(x)
+
+
+class Symmetric(torch.nn.Module):
+    """Valid-padded model that is equivariant to mirroring and transposing,
+    its kernel weights only depend on the distance from the center."""
+
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv3d(1, 2, kernel_size=3)
+        offsets = torch.stack(
+            torch.meshgrid(*[torch.arange(-1, 2)] * 3, indexing='ij'))
+        distance = offsets.abs().sum(dim=0)
+        with torch.no_grad():
+            weights = torch.randn(2, 4)
+            self.conv.weight.copy_(weights[:, distance].unsqueeze(1))
+
+    def forward(self, x):
+        return torch.relu(self.conv(x))
+
+
+def test_test_time_augmentation_is_equivariant():
+    raw = gp.ArrayKey("RAW")
+    predictions = gp.ArrayKey("PREDICTIONS")
+
+    predict = fos.gunpowder.torch.Predict(
+        model=CenterCrop(context=2).eval(),
+        inputs={'x': raw},
+        outputs={0: predictions},
+        device='cpu',
+        tta_mirror=True,
+        tta_transpose=True,
+    )
+    predict.device = torch.device('cpu')
+
+    x = torch.rand((2, 1, 8, 8, 8))
+    augmented = predict.augment(x)
+    assert augmented.shape == (2 * 8 * 6, 1, 8, 8, 8)
+
+    out = predict.deaugment(predict.model(augmented))
+    assert np.allclose(out.numpy(), 2 * x[..., 2:-2, 2:-2, 2:-2].numpy())
+
+    # a model that is equivariant under mirroring and transposing gives the
+    # same output for each view, their average is a single forward pass
+    predict.model = Symmetric().eval()
+    with torch.no_grad():
+        out = predict.deaugment(predict.model(predict.augment(x)))
+        expected = predict.model(x)
+    assert np.allclose(out.numpy(), expected.numpy(), atol=1e-6)
+
+    # for any other model, the views differ
+    predict.model = Asymmetric().eval()
+    with torch.no_grad():
+        out = predict.deaugment(predict.model(predict.augment(x)))
+        single = predict.model(x)
+    assert not np.allclose(out.numpy(), single.numpy(), atol=1e-6)
+
+
+def test_device_postprocess():
+    raw = gp.ArrayKey("RAW")
+    mask = gp.ArrayKey("MASK")
+    predictions = gp.ArrayKey("PREDICTIONS")
+    segmentation = gp.ArrayKey("SEGMENTATION")
+
+    predict = fos.gunpowder.torch.Predict(
+        model=Asymmetric().eval(),
+        inputs={'x': raw},
+        outputs={0: predictions},
+        device='cpu',
+        softmax=True,
+        output_dtype='uint8',
+        segmentations={predictions: segmentation},
+        segmentation_mask=mask,
+    )
+    assert predict.array_specs[predictions].dtype == np.uint8
+    assert predict.array_specs[segmentation].dtype == np.uint8
+
+    roi = gp.Roi((0, 0, 0), (4, 4, 4))
+    logits = torch.randn((1, 3, 4, 4, 4))
+    mask_data = np.random.randint(0, 2, size=(1, 4, 4, 4)).astype(np.uint8)
+    batch = gp.Batch()
+    batch[mask] = gp.Array(
+        mask_data, gp.ArraySpec(roi=roi, voxel_size=(1, 1, 1)))
+
+    request = gp.BatchRequest()
+    request[predictions] = gp.ArraySpec(roi=roi)
+    request[segmentation] = gp.ArraySpec(roi=roi)
+    processed = predict.postprocess(batch, request, {predictions: logits})
+
+    probabilities = torch.softmax(logits, dim=1).numpy()
+    assert processed[predictions].dtype == torch.uint8
+    assert np.abs(
+        processed[predictions].numpy().astype(float) - probabilities * 255
+    ).max() <= 0.5
+    assert np.array_equal(
+        processed[segmentation].numpy(),
+        np.argmax(probabilities, axis=1) * mask_data)
+
+    # probabilities are only computed for the segmentation
+    del request[predictions]
+    processed = predict.postprocess(batch, request, {predictions: logits})
+    assert list(processed) == [segmentation]
+
+
+class ConvReLU(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv3d(1, 2, kernel_size=3)
+        self.relu = torch.nn.ReLU()
+
+    def forward(self, x):
+        return self.relu(self.conv(x))
+
+
+def test_torchscript_matches_eager(tmp_path):
+    raw = gp.ArrayKey("RAW")
+    predictions = gp.ArrayKey("PREDICTIONS")
+
+    model = ConvReLU().eval()
+    filename = str(tmp_path / "model.pt")
+    fos.torch.export_torchscript(model, (2, 1, 8, 8, 8), filename)
+
+    predict = fos.gunpowder.torch.Predict(
+        model=None,
+        inputs={'x': raw},
+        outputs={0: predictions},
+        device='cpu',
+        torchscript=filename,
+    )
+    predict.start()
+    assert predict.torchscript_metadata['output_shape'] == [2, 2, 6, 6, 6]
+
+    x = torch.rand((2, 1, 8, 8, 8))
+    predict.check_torchscript_inputs({'x': x})
+    with torch.no_grad():
+        out = predict.model(x)
+        expected = model(x)
+    assert np.allclose(out.numpy(), expected.numpy(), atol=1e-5)
+
+    with pytest.raises(ValueError):
+        predict.check_torchscript_inputs({'x': torch.rand((1, 1, 8, 8, 8))})
+
+
+class ConvPass(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv_pass = torch.nn.Sequential(
+            torch.nn.Conv3d(1, 4, kernel_size=3),
+            torch.nn.ReLU(),
+            torch.nn.Conv3d(4, 2, kernel_size=1),
+            torch.nn.ReLU(),
+        )
+
+    def forward(self, x):
+        return self.conv_pass(x)
+
+
+def test_quantized_torchscript(tmp_path):
+    raw = gp.ArrayKey("RAW")
+    predictions = gp.ArrayKey("PREDICTIONS")
+
+    model = ConvPass().eval()
+    quantized = fos.torch.quantize_static(
+        model,
+        [torch.rand((1, 1, 8, 8, 8)) for _ in range(4)]
+    )
+    filename = str(tmp_path / "model_int8.pt")
+    fos.torch.export_torchscript(
+        quantized,
+        (1, 1, 8, 8, 8),
+        filename,
+        optimize=False,
+        metadata={'quantized_engine': torch.backends.quantized.engine}
+    )
+
+    predict = fos.gunpowder.torch.Predict(
+        model=None,
+        inputs={'x': raw},
+        outputs={0: predictions},
+        device='cpu',
+        torchscript=filename,
+    )
+    predict.start()
+
+    x = torch.rand((1, 1, 8, 8, 8))
+    with torch.no_grad():
+        out = predict.model(x)
+        expected = model(x)
+    assert np.allclose(out.numpy(), expected.numpy(), atol=0.05)
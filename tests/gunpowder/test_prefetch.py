@@ -0,0 +1,96 @@
+import logging
+
+import numpy as np
+import pytest
+import gunpowder as gp
+
+import incasem as fos
+from helpers import NumpySource
+
+
+class Double(gp.BatchFilter):
+    """Valid-padded stand-in for ``Predict``, provides twice the raw."""
+
+    def __init__(self, raw, predictions):
+        self.raw = raw
+        self.predictions = predictions
+        self.context = gp.Coordinate((1, 1, 1))
+
+    def setup(self):
+        spec = self.spec[self.raw].copy()
+        spec.roi = spec.roi.grow(-self.context, -self.context)
+        self.provides(self.predictions, spec)
+
+    def prepare(self, request):
+        deps = gp.BatchRequest()
+        deps[self.raw] = gp.ArraySpec(
+            roi=request[self.predictions].roi.grow(
+                self.context, self.context))
+        return deps
+
+    def process(self, batch, request):
+        output = gp.Batch()
+        output[self.predictions] = gp.Array(
+            2 * batch[self.raw].crop(request[self.predictions].roi).data,
+            self.spec[self.predictions].copy()
+        )
+        output[self.predictions].spec.roi = request[self.predictions].roi
+        return output
+
+
+@pytest.mark.parametrize('empty_request', [True, False])
+def test_scan_requests_hit_prefetch_schedule(caplog, empty_request):
+    raw = gp.ArrayKey("RAW")
+    predictions = gp.ArrayKey("PREDICTIONS")
+
+    data = np.arange(12 ** 3, dtype=np.float32).reshape(12, 12, 12)
+    source = NumpySource({
+        raw: gp.Array(data, gp.ArraySpec(
+            roi=gp.Roi((0, 0, 0), (12, 12, 12)),
+            voxel_size=gp.Coordinate((1, 1, 1)),
+            dtype=np.float32
+        ))
+    })
+
+    reference = gp.BatchRequest()
+    reference[raw] = gp.ArraySpec(roi=gp.Roi((0, 0, 0), (6, 6, 6)))
+    reference[predictions] = gp.ArraySpec(roi=gp.Roi((1, 1, 1), (4, 4, 4)))
+    # the predictions are not provided upstream of the prefetch
+    prefetch_reference = gp.BatchRequest()
+    prefetch_reference[raw] = reference[raw].copy()
+
+    prefetch = fos.gunpowder.Prefetch(
+        prefetch_reference, num_workers=2, cache_size=2)
+    pipeline = (
+        source
+        + prefetch
+        + Double(raw, predictions)
+        + fos.gunpowder.Scan(reference, prefetch=prefetch)
+    )
+
+    request = gp.BatchRequest()
+    if not empty_request:
+        # scanned with other shifts than the upstream ROI
+        request[predictions] = gp.ArraySpec(
+            roi=gp.Roi((3, 3, 3), (7, 7, 7)))
+
+    with caplog.at_level(logging.WARNING), gp.build(pipeline):
+        batch = pipeline.request_batch(request)
+
+    assert "not part of the prefetch schedule" not in caplog.text
+    if not empty_request:
+        assert np.array_equal(
+            batch[predictions].data, 2 * data[3:10, 3:10, 3:10])
+
+
+def test_prefetch_requires_single_scan_worker():
+    reference = gp.BatchRequest()
+    reference[gp.ArrayKey("RAW")] = gp.ArraySpec(
+        roi=gp.Roi((0, 0, 0), (6, 6, 6)))
+
+    with pytest.raises(ValueError):
+        fos.gunpowder.Scan(
+            reference,
+            num_workers=2,
+            prefetch=fos.gunpowder.Prefetch(reference)
+        )
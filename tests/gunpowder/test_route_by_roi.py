@@ -0,0 +1,75 @@
+import copy
+import numpy as np
+import gunpowder as gp
+
+import incasem as fos
+
+
+class ConstantSource(gp.BatchProvider):
+    def __init__(self, roi, value):
+        self.roi = roi
+        self.value = value
+
+        self.raw = gp.ArrayKey("RAW")
+        self.array_spec_raw = gp.ArraySpec(
+            roi=self.roi,
+            voxel_size=gp.Coordinate((1, 1, 1)),
+            dtype='uint8',
+            interpolatable=True
+        )
+
+    def setup(self):
+        self.provides(self.raw, self.array_spec_raw)
+
+    def provide(self, request):
+        outputs = gp.Batch()
+
+        raw_spec = copy.deepcopy(self.array_spec_raw)
+        raw_spec.roi = request[self.raw].roi
+        outputs[self.raw] = gp.Array(
+            np.full(
+                request[self.raw].roi.get_shape(),
+                self.value,
+                dtype=raw_spec.dtype
+            ),
+            raw_spec
+        )
+
+        return outputs
+
+
+def test_scan_over_translated_regions():
+    raw = gp.ArrayKey("RAW")
+
+    # two overlapping rois, e.g. from different cells
+    rois = [
+        gp.Roi((10, 10, 10), (20, 10, 10)),
+        gp.Roi((0, 0, 0), (10, 20, 10)),
+    ]
+    shifts = [
+        gp.Coordinate((-10, -10, -10)),
+        gp.Coordinate((30, 0, 0)),
+    ]
+
+    pipeline = tuple(
+        ConstantSource(roi, value=i + 1) + fos.gunpowder.Translate(shift)
+        for i, (roi, shift) in enumerate(zip(rois, shifts))
+    ) + fos.gunpowder.RouteByRoi(raw)
+
+    reference = gp.BatchRequest()
+    reference[raw] = gp.ArraySpec(roi=gp.Roi((0, 0, 0), (4, 4, 4)))
+    regions = [{raw: roi.shift(shift)} for roi, shift in zip(rois, shifts)]
+    pipeline += fos.gunpowder.Scan(reference, regions=regions)
+
+    request = gp.BatchRequest()
+    request[raw] = gp.ArraySpec(roi=gp.Roi((0, 0, 0), (40, 20, 10)))
+
+    with gp.build(pipeline):
+        batch = pipeline.request_batch(request)
+
+    data = batch[raw].data
+    assert np.all(data[0:20, 0:10, 0:10] == 1)
+    assert np.all(data[30:40, 0:20, 0:10] == 2)
+    # never requested between and next to the regions
+    assert np.all(data[20:30] == 0)
+    assert np.all(data[0:20, 10:20] == 0)
@@ -0,0 +1,64 @@
+import gc
+import pickle
+import numpy as np
+import gunpowder as gp
+
+import incasem as fos
+from helpers import RandomSource
+
+
+def test_shared_batch_buffer():
+    raw = gp.ArrayKey("RAW")
+    labels = gp.ArrayKey("LABELS")
+
+    request = gp.BatchRequest()
+    request[raw] = gp.ArraySpec(roi=gp.Roi((0, 0, 0), (4, 4, 4)))
+    request[labels] = gp.ArraySpec(roi=gp.Roi((0, 0, 0), (4, 4, 4)))
+
+    source = RandomSource()
+    with gp.build(source):
+        batch = source.request_batch(request)
+
+    buffer = fos.gunpowder.SharedBatchBuffer(batch, num_slots=1)
+    try:
+        shared_batch = buffer.pack(batch)
+        # arrays are not pickled
+        assert shared_batch.batch[raw].data is None
+        assert len(pickle.dumps(shared_batch)) < batch[raw].data.nbytes
+
+        unpacked = buffer.get(shared_batch)
+        assert np.array_equal(unpacked[raw].data, batch[raw].data)
+        assert np.array_equal(unpacked[labels].data, batch[labels].data)
+        assert buffer.in_use == 1
+
+        # the slot is released once the arrays are garbage collected
+        del unpacked, shared_batch
+        gc.collect()
+        assert buffer.in_use == 0
+    finally:
+        buffer.close()
+
+
+def test_shared_memory_pre_cache():
+    raw = gp.ArrayKey("RAW")
+    labels = gp.ArrayKey("LABELS")
+
+    pipeline = (
+        RandomSource()
+        + fos.gunpowder.SharedMemoryPreCache(cache_size=2, num_workers=2)
+    )
+
+    request = gp.BatchRequest()
+    request[raw] = gp.ArraySpec(roi=gp.Roi((0, 0, 0), (4, 4, 4)))
+    request[labels] = gp.ArraySpec(roi=gp.Roi((0, 0, 0), (4, 4, 4)))
+
+    batches = []
+    with gp.build(pipeline):
+        # hold on to more batches than there are slots
+        for _ in range(6):
+            batches.append(pipeline.request_batch(request))
+
+    for batch in batches:
+        assert batch[raw].data.shape == (4, 4, 4)
+        assert batch[raw].data.dtype == np.float32
+    assert not np.allclose(batches[1][raw].data, batches[2][raw].data)
@@ -0,0 +1,54 @@
+import numpy as np
+import zarr
+import gunpowder as gp
+
+import incasem as fos
+from helpers import NumpySource
+
+
+class Overwrite(gp.BatchFilter):
+    def __init__(self, key):
+        self.key = key
+
+    def process(self, batch, request):
+        batch[self.key].data[:] = 0
+
+
+def test_asynchronous_snapshot(tmp_path):
+    raw = gp.ArrayKey("RAW")
+
+    data = np.random.rand(8, 8, 8).astype(np.float32)
+    roi = gp.Roi((0, 0, 0), (8, 8, 8))
+    source = NumpySource({
+        raw: gp.Array(
+            data.copy(),
+            gp.ArraySpec(
+                roi=roi, voxel_size=gp.Coordinate((1, 1, 1)),
+                dtype=np.float32))
+    })
+
+    pipeline = (
+        source
+        + fos.gunpowder.Snapshot(
+            dataset_names={raw: 'raw'},
+            output_dir=str(tmp_path),
+            output_filename='{id}.zarr',
+            chunk_shape=(4, 4, 4),
+            asynchronous=True,
+            max_pending=1,
+        )
+        # modifies the batch while the snapshot may still be written
+        + Overwrite(raw)
+    )
+
+    request = gp.BatchRequest()
+    request[raw] = gp.ArraySpec(roi=roi)
+
+    with gp.build(pipeline):
+        batches = [pipeline.request_batch(request) for _ in range(3)]
+
+    # all snapshots written on teardown, with the original data
+    for batch in batches:
+        snapshot = zarr.open(
+            str(tmp_path / f'{str(batch.id).zfill(8)}.zarr'), 'r')
+        assert np.array_equal(snapshot['raw'][:], data)
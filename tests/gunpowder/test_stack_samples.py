@@ -0,0 +1,36 @@
+import numpy as np
+import gunpowder as gp
+
+import incasem as fos
+from helpers import RandomSource
+
+
+def test_stack_and_take_sample():
+    raw = gp.ArrayKey("RAW")
+    labels = gp.ArrayKey("LABELS")
+
+    pipeline = (
+        RandomSource()
+        + fos.gunpowder.Unsqueeze([raw])
+        + fos.gunpowder.StackSamples([raw], num_samples=3)
+    )
+
+    request = gp.BatchRequest(random_seed=42)
+    request[raw] = gp.ArraySpec(roi=gp.Roi((0, 0, 0), (4, 4, 4)))
+    request[labels] = gp.ArraySpec(roi=gp.Roi((0, 0, 0), (4, 4, 4)))
+
+    with gp.build(pipeline):
+        batch = pipeline.request_batch(request)
+
+    assert batch[raw].data.shape == (3, 4, 4, 4)
+    # independent samples
+    assert not np.allclose(batch[raw].data[0], batch[raw].data[1])
+    # other arrays are taken from the first sample
+    assert batch[labels].data.shape == (4, 4, 4)
+
+    pipeline += fos.gunpowder.TakeSample([raw])
+
+    with gp.build(pipeline):
+        batch = pipeline.request_batch(request)
+
+    assert batch[raw].data.shape == (1, 4, 4, 4)
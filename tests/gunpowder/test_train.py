@@ -0,0 +1,101 @@
+import os
+import numpy as np
+import torch
+import gunpowder as gp
+
+import incasem as fos
+from helpers import Model, NumpySource
+
+
+def train(tmp_path, iterations=1, **kwargs):
+    raw = gp.ArrayKey("RAW")
+    labels = gp.ArrayKey("LABELS")
+    mask = gp.ArrayKey("MASK")
+    scalings = gp.ArrayKey("LOSS_SCALINGS")
+    predictions = gp.ArrayKey("PREDICTIONS")
+
+    rng = np.random.default_rng(0)
+    voxel_size = gp.Coordinate((1, 1, 1))
+    input_roi = gp.Roi((0, 0, 0), (10, 10, 10))
+    output_roi = input_roi.grow((-1, -1, -1), (-1, -1, -1))
+
+    def array(data, roi):
+        return gp.Array(
+            data,
+            gp.ArraySpec(roi=roi, voxel_size=voxel_size, dtype=data.dtype))
+
+    source = NumpySource({
+        raw: array(rng.random((2, 1, 10, 10, 10), dtype=np.float32),
+                   input_roi),
+        labels: array(rng.integers(0, 2, (2, 8, 8, 8)), output_roi),
+        mask: array(np.ones((2, 8, 8, 8), dtype=np.float32), output_roi),
+        scalings: array(rng.random((2, 8, 8, 8), dtype=np.float32),
+                        output_roi),
+    })
+
+    tmp_path.mkdir()
+    torch.manual_seed(0)
+    model = Model().train()
+    train = fos.gunpowder.torch.Train(
+        model=model,
+        loss=fos.torch.loss.CrossEntropyLossWithScalingAndMeanReduction(
+            device='cpu'),
+        optimizer=torch.optim.SGD(model.parameters(), lr=0.1),
+        inputs={'x': raw},
+        outputs={0: predictions},
+        loss_inputs={0: predictions, 1: labels, 2: mask, 3: scalings},
+        array_specs={predictions: gp.ArraySpec(voxel_size=voxel_size)},
+        checkpoint_basename=str(tmp_path / 'model'),
+        save_every=1,
+        device='cpu',
+        gpus=[],
+        **kwargs
+    )
+    pipeline = source + train
+
+    request = gp.BatchRequest()
+    request[raw] = gp.ArraySpec(roi=input_roi)
+    for key in [labels, mask, scalings, predictions]:
+        request[key] = gp.ArraySpec(roi=output_roi)
+
+    with gp.build(pipeline):
+        for _ in range(iterations):
+            batch = pipeline.request_batch(request)
+
+    return batch, model
+
+
+def test_bfloat16_autocast(tmp_path):
+    batch_fp32, model_fp32 = train(tmp_path / 'fp32')
+    batch_bf16, model_bf16 = train(
+        tmp_path / 'bf16', autocast_dtype='bfloat16')
+
+    predictions = gp.ArrayKey("PREDICTIONS")
+    assert batch_bf16[predictions].data.dtype == np.float32
+    assert np.isfinite(batch_bf16.loss)
+    assert np.isclose(batch_bf16.loss, batch_fp32.loss, rtol=2e-2)
+
+    # weights stay float32, checkpoints have the same format
+    assert model_bf16.conv.weight.dtype == torch.float32
+    checkpoint = torch.load(tmp_path / 'bf16' / 'model_checkpoint_0')
+    assert set(checkpoint) == {'model_state_dict', 'optimizer_state_dict'}
+    assert torch.allclose(
+        model_bf16.conv.weight, model_fp32.conv.weight, atol=1e-2)
+
+
+def test_async_checkpoints_with_retention(tmp_path):
+    _, model = train(
+        tmp_path / 'run',
+        iterations=10,
+        async_checkpoints=True,
+        keep_last_checkpoints=2,
+        keep_checkpoints_every=4,
+    )
+
+    # written completely at teardown, without temporary files left
+    assert sorted(os.listdir(tmp_path / 'run')) == [
+        f'model_checkpoint_{i}' for i in [0, 4, 8, 9]]
+
+    checkpoint = torch.load(tmp_path / 'run' / 'model_checkpoint_9')
+    assert torch.equal(
+        checkpoint['model_state_dict']['conv.weight'], model.conv.weight)
@@ -0,0 +1,168 @@
+import json
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import gunpowder as gp
+
+import incasem as fos
+from helpers import Model, NumpySource
+
+WORLD_SIZE = 2
+RESUME_ITERATION = 5
+LR = 0.1
+
+
+def rank_data(rank):
+    """Different samples for each rank."""
+    rng = np.random.default_rng(rank)
+    return {
+        'raw': rng.random((2, 1, 10, 10, 10), dtype=np.float32),
+        'labels': rng.integers(0, 2, (2, 8, 8, 8)),
+        'mask': np.ones((2, 8, 8, 8), dtype=np.float32),
+        'scalings': rng.random((2, 8, 8, 8), dtype=np.float32),
+    }
+
+
+def loss_fn():
+    return fos.torch.loss.CrossEntropyLossWithScalingAndMeanReduction(
+        device='cpu')
+
+
+def run_rank(rank, tmp_path):
+    dist.init_process_group(
+        backend='gloo',
+        init_method=f"file://{tmp_path / 'init'}",
+        rank=rank,
+        world_size=WORLD_SIZE
+    )
+
+    raw = gp.ArrayKey("RAW")
+    labels = gp.ArrayKey("LABELS")
+    mask = gp.ArrayKey("MASK")
+    scalings = gp.ArrayKey("LOSS_SCALINGS")
+    predictions = gp.ArrayKey("PREDICTIONS")
+
+    voxel_size = gp.Coordinate((1, 1, 1))
+    input_roi = gp.Roi((0, 0, 0), (10, 10, 10))
+    output_roi = input_roi.grow((-1, -1, -1), (-1, -1, -1))
+
+    def array(data, roi):
+        return gp.Array(
+            data,
+            gp.ArraySpec(roi=roi, voxel_size=voxel_size, dtype=data.dtype))
+
+    data = rank_data(rank)
+    source = NumpySource({
+        raw: array(data['raw'], input_roi),
+        labels: array(data['labels'], output_roi),
+        mask: array(data['mask'], output_roi),
+        scalings: array(data['scalings'], output_roi),
+    })
+
+    # differs from the checkpoint of rank 0
+    torch.manual_seed(1 + rank)
+    model = Model().train()
+    rank_dir = tmp_path / f'rank_{rank}'
+    metrics_logger = fos.tracking.MetricsLogger(
+        [fos.tracking.JsonlSink(str(rank_dir / 'metrics.jsonl'))],
+        flush_every=None
+    )
+    train = fos.gunpowder.torch.Train(
+        model=model,
+        loss=loss_fn(),
+        optimizer=torch.optim.SGD(model.parameters(), lr=LR),
+        inputs={'x': raw},
+        outputs={0: predictions},
+        loss_inputs={0: predictions, 1: labels, 2: mask, 3: scalings},
+        array_specs={predictions: gp.ArraySpec(voxel_size=voxel_size)},
+        checkpoint_basename=str(rank_dir / 'model'),
+        save_every=1,
+        metrics_logger=metrics_logger,
+        device='cpu',
+        gpus=[],
+        distributed=True,
+    )
+    pipeline = source + train
+
+    request = gp.BatchRequest()
+    request[raw] = gp.ArraySpec(roi=input_roi)
+    for key in [labels, mask, scalings, predictions]:
+        request[key] = gp.ArraySpec(roi=output_roi)
+
+    with gp.build(pipeline):
+        batch = pipeline.request_batch(request)
+    metrics_logger.close()
+
+    torch.save(
+        {
+            'iteration': batch.iteration,
+            'model_state_dict': model.state_dict(),
+        },
+        tmp_path / f'result_{rank}'
+    )
+    dist.destroy_process_group()
+
+
+def test_distributed_training(tmp_path):
+    # rank 0 resumes from this checkpoint, rank 1 has none
+    for rank in range(WORLD_SIZE):
+        (tmp_path / f'rank_{rank}').mkdir()
+    torch.manual_seed(0)
+    model = Model()
+    optimizer = torch.optim.SGD(model.parameters(), lr=LR)
+    torch.save(
+        {
+            'model_state_dict': model.state_dict(),
+            'optimizer_state_dict': optimizer.state_dict(),
+        },
+        tmp_path / 'rank_0' / f'model_checkpoint_{RESUME_ITERATION}'
+    )
+
+    # one SGD step with the gradient averaged over the ranks
+    gradients = [torch.zeros_like(p) for p in model.parameters()]
+    for rank in range(WORLD_SIZE):
+        data = rank_data(rank)
+        model.zero_grad()
+        loss = loss_fn()(
+            model(torch.as_tensor(data['raw'])),
+            torch.as_tensor(data['labels']),
+            torch.as_tensor(data['mask']),
+            torch.as_tensor(data['scalings']),
+        )
+        loss.backward()
+        for gradient, p in zip(gradients, model.parameters()):
+            gradient += p.grad / WORLD_SIZE
+    with torch.no_grad():
+        for gradient, p in zip(gradients, model.parameters()):
+            p -= LR * gradient
+    expected = model.state_dict()
+
+    torch.multiprocessing.spawn(
+        run_rank, args=(tmp_path,), nprocs=WORLD_SIZE)
+
+    results = [torch.load(tmp_path / f'result_{rank}')
+               for rank in range(WORLD_SIZE)]
+    for result in results:
+        # the checkpoint of rank 0 is broadcast
+        assert result['iteration'] == RESUME_ITERATION
+        # the gradients are all-reduced, the parameters stay identical
+        for name, value in expected.items():
+            assert torch.allclose(
+                result['model_state_dict'][name], value, atol=1e-6)
+
+    # only rank 0 writes checkpoints and metrics
+    assert sorted(p.name for p in (tmp_path / 'rank_0').iterdir()) == [
+        'metrics.jsonl', f'model_checkpoint_{RESUME_ITERATION}']
+    assert sorted(p.name for p in (tmp_path / 'rank_1').iterdir()) == [
+        'metrics.jsonl']
+    checkpoint = torch.load(
+        tmp_path / 'rank_0' / f'model_checkpoint_{RESUME_ITERATION}')
+    for name, value in expected.items():
+        assert torch.allclose(
+            checkpoint['model_state_dict'][name], value, atol=1e-6)
+    with open(tmp_path / 'rank_0' / 'metrics.jsonl') as f:
+        records = [json.loads(line) for line in f]
+    assert [(r['name'], r['step']) for r in records] == [
+        ('loss_0', RESUME_ITERATION)]
+    assert (tmp_path / 'rank_1' / 'metrics.jsonl').read_text() == ''